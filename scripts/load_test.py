@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Concurrent load generator for the Q-SPARC LangServe server.
+
+Each virtual user opens its own session and replays a multi-turn SCKAN
+conversation against /chain/invoke (or /chain/stream). At the end it prints
+p50/p95/p99 latency, time-to-first-byte for streaming, throughput, error
+count and, when --server-pid is given, the server's peak resident memory.
+
+    python scripts/stub_llm_server.py --ttft 0.3 --tps 40 &
+    QSPARC_LLM_BASE_URL=http://localhost:8000/v1 python src/llm_server/server.py &
+    python scripts/load_test.py --url http://localhost:1237 --users 16 --sessions 64
+"""
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import statistics
+from typing import List, Dict, Any, Optional
+
+import httpx
+
+# Realistic conversations: an opening question followed by short follow-ups
+CONVERSATIONS = [
+    [
+        "Is there a connection from inferior mesenteric ganglion to the urinary bladder in rats? Summarize the pathways based on the nerves involved.",
+        "And what about the hypogastric nerve?",
+        "Which of those pathways go through the pelvic ganglion?",
+    ],
+    [
+        "To what organs does the pelvic ganglion project? Summarize the connections categorized by end organs. Only list the end organs.",
+        "Which of those are reproductive organs?",
+    ],
+    [
+        "What connections terminate in the urinary bladder? Concisely summarize the pathways.",
+        "What are the origins of those connections?",
+        "Which nerves are involved?",
+    ],
+    [
+        "What organs are innervated by vagus nerve? Summarize the pathways categorized by the origins and the end organ systems.",
+        "Only list the cardiovascular targets.",
+    ],
+    [
+        "What anatomical structures can be stimulated by inferior mesenteric ganglion? Only list unique origins, destinations, and via structures.",
+    ],
+    [
+        "What connections originate the nucleus of brain? Categorize the pathways based on different brain nucleus.",
+    ],
+    [
+        "Is there a connection from the celiac ganglion to the stomach?",
+        "Via which nerves?",
+    ],
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile; q in [0, 100]."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def read_rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a local process from /proc, in MiB."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        return None
+    return None
+
+
+class Results:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.first_byte: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.rss_samples: List[float] = []
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def send_turn(client: httpx.AsyncClient, args, session_id: str, question: str, results: Results) -> None:
+    payload = {
+        "input": {"input": question},
+        "config": {"configurable": {"session_id": session_id}},
+    }
+    start = time.perf_counter()
+    try:
+        if args.stream:
+            first = None
+            async with client.stream("POST", f"{args.url}/chain/stream", json=payload) as resp:
+                if resp.status_code != 200:
+                    results.error(f"http_{resp.status_code}")
+                    return
+                async for line in resp.aiter_lines():
+                    if first is None and line.startswith("data:"):
+                        first = time.perf_counter() - start
+            if first is not None:
+                results.first_byte.append(first)
+        else:
+            resp = await client.post(f"{args.url}/chain/invoke", json=payload)
+            if resp.status_code != 200:
+                results.error(f"http_{resp.status_code}")
+                return
+        results.latencies.append(time.perf_counter() - start)
+    except httpx.HTTPError as e:
+        results.error(type(e).__name__)
+
+
+async def virtual_user(queue: asyncio.Queue, client: httpx.AsyncClient, args, results: Results) -> None:
+    while True:
+        try:
+            conversation = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        session_id = f"loadtest-{uuid.uuid4().hex[:12]}"
+        for question in conversation[: args.max_turns]:
+            await send_turn(client, args, session_id, question, results)
+            if args.think_time:
+                await asyncio.sleep(random.uniform(0, args.think_time))
+
+
+async def sample_memory(pid: int, results: Results, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        rss = read_rss_mb(pid)
+        if rss is not None:
+            results.rss_samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run(args) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    queue: asyncio.Queue = asyncio.Queue()
+    for _ in range(args.sessions):
+        queue.put_nowait(rng.choice(CONVERSATIONS))
+
+    results = Results()
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_memory(args.server_pid, results, stop)) if args.server_pid else None
+
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    timeout = httpx.Timeout(args.timeout, connect=5.0)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        await asyncio.gather(*(virtual_user(queue, client, args, results) for _ in range(args.users)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    if sampler:
+        await sampler
+
+    report = {
+        "mode": "stream" if args.stream else "invoke",
+        "users": args.users,
+        "sessions": args.sessions,
+        "requests_ok": len(results.latencies),
+        "errors": results.errors,
+        "wall_time_s": round(elapsed, 3),
+        "throughput_rps": round(len(results.latencies) / elapsed, 3) if elapsed else 0.0,
+        "latency_s": {
+            "mean": round(statistics.fmean(results.latencies), 4) if results.latencies else None,
+            "p50": round(percentile(results.latencies, 50), 4),
+            "p95": round(percentile(results.latencies, 95), 4),
+            "p99": round(percentile(results.latencies, 99), 4),
+        },
+    }
+    if results.first_byte:
+        report["first_byte_s"] = {
+            "p50": round(percentile(results.first_byte, 50), 4),
+            "p95": round(percentile(results.first_byte, 95), 4),
+            "p99": round(percentile(results.first_byte, 99), 4),
+        }
+    if results.rss_samples:
+        report["server_rss_mb"] = {
+            "start": round(results.rss_samples[0], 1),
+            "peak": round(max(results.rss_samples), 1),
+            "end": round(results.rss_samples[-1], 1),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:1237", help="Base URL of server.py.")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users.")
+    parser.add_argument("--sessions", type=int, default=32, help="Conversations to replay in total.")
+    parser.add_argument("--max-turns", type=int, default=3, help="Turns replayed per conversation.")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Max random pause between turns (s).")
+    parser.add_argument("--stream", action="store_true", help="Use /chain/stream instead of /chain/invoke.")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request read timeout (s).")
+    parser.add_argument("--server-pid", type=int, help="Sample this process's RSS during the run.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Stand-in for the vLLM OpenAI-compatible endpoint, for benchmarking server.py
+on machines without a GPU. It answers /v1/chat/completions with canned text,
+sleeping to emulate a configurable time-to-first-token and decode rate.
+
+    python scripts/stub_llm_server.py --port 8000 --ttft 0.35 --tps 30
+    QSPARC_LLM_BASE_URL=http://localhost:8000/v1 python src/llm_server/server.py
+"""
+import time
+import uuid
+import json
+import asyncio
+import argparse
+from typing import List, Dict, Any
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Canned answer shaped like the real ones (summary, markdown table, legend)
+CANNED_ANSWER = (
+    "Yes, there is a connection from the inferior mesenteric ganglion to the urinary bladder. "
+    "The pathways are summarized as follows: 1. Via bladder nerve: from inferior mesenteric "
+    "ganglion to dome of the bladder and neck of urinary bladder. 2. Via hypogastric nerve: "
+    "from inferior mesenteric ganglion to dome of the bladder and neck of urinary bladder. "
+    "3. Via pelvic ganglion: from inferior mesenteric ganglion to dome of the bladder and neck "
+    "of urinary bladder.\n\n"
+    "| Origin (A_ID) | Destination (B_ID) | Via (C_ID) |\n|---|---|---|\n"
+    "| A1 | B1 | C1 |\n| A1 | B2 | C1 |\n| A1 | B1 | C2 |\n| A1 | B2 | C2 |\n| A1 | B1 | C3 |\n\n"
+    "Legend: A1 = http://purl.obolibrary.org/obo/UBERON_0005453, "
+    "B1 = http://purl.obolibrary.org/obo/UBERON_0001258, "
+    "B2 = http://uri.interlex.org/base/ilx_0738433, "
+    "C1 = http://uri.interlex.org/base/ilx_0793559, "
+    "C2 = http://purl.obolibrary.org/obo/UBERON_0005303, "
+    "C3 = http://purl.obolibrary.org/obo/UBERON_0016508"
+)
+
+config = argparse.Namespace(ttft=0.3, tps=30.0, output_tokens=256, model="stub-qwen3")
+app = FastAPI(title="Stub OpenAI-compatible LLM server")
+
+
+def approx_tokens(text: str) -> int:
+    """Rough token estimate (about 0.75 words per token)."""
+    return int(len(text.split()) / 0.75) + 1
+
+
+def answer_tokens(max_tokens: int) -> List[str]:
+    """Canned answer split into word 'tokens', repeated up to the budget."""
+    words = CANNED_ANSWER.split(" ")
+    n = min(max_tokens, config.output_tokens)
+    return [(" " if i else "") + words[i % len(words)] for i in range(n)]
+
+
+def prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(approx_tokens(str(m.get("content", ""))) for m in messages)
+
+
+@app.get("/v1/models")
+def list_models():
+    return {"object": "list", "data": [{"id": config.model, "object": "model"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", config.model)
+    cap = body.get("max_tokens") or body.get("max_completion_tokens")
+    tokens = answer_tokens(cap or config.output_tokens)
+    # "length" only when the client set a cap and the answer reached it
+    finish_reason = "length" if cap and len(tokens) >= cap else "stop"
+    usage = {
+        "prompt_tokens": prompt_tokens(body.get("messages", [])),
+        "completion_tokens": len(tokens),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await asyncio.sleep(config.ttft + len(tokens) / config.tps)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        })
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    def chunk(delta: Dict[str, Any], finish=None, with_usage=False) -> str:
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if delta is not None else [],
+        }
+        if with_usage:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload)}\n\n"
+
+    async def event_stream():
+        await asyncio.sleep(config.ttft)
+        yield chunk({"role": "assistant", "content": ""})
+        interval = 1.0 / config.tps
+        for tok in tokens:
+            yield chunk({"content": tok})
+            await asyncio.sleep(interval)
+        yield chunk({}, finish=finish_reason)
+        if include_usage:
+            yield chunk(None, with_usage=True)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--ttft", type=float, default=config.ttft, help="Seconds before the first token.")
+    parser.add_argument("--tps", type=float, default=config.tps, help="Decode rate in tokens per second.")
+    parser.add_argument("--output-tokens", type=int, default=config.output_tokens,
+                        help="Tokens per answer when the request sets no max_tokens.")
+    parser.add_argument("--model", default=config.model)
+    args = parser.parse_args()
+    config.ttft, config.tps, config.output_tokens, config.model = args.ttft, args.tps, args.output_tokens, args.model
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Precomputed answers for the canonical SCKAN question templates.
+
+The offline job enumerates every template over the distinct A/B/C/Target_Organ
+values in the clean_data records and writes the deterministic part of each
+answer (row set, grouped summary, aliased table with legend) into one compact
+key-value file. The server memory-maps that file and answers template-shaped
+questions without retrieval or an LLM call.
+
+    python answer_store.py --data /path/to/a-b-via-c.json --out a-b-via-c.json.answers.qsas
+
+File layout: MAGIC, 8-byte little-endian offset of the index, zlib-compressed
+JSON values back to back, then the zlib-compressed JSON index
+{key: [offset, length]}.
+"""
+import os
+import re
+import sys
+import mmap
+import json
+import zlib
+import struct
+import argparse
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from entity_matcher import EntityMatcher, tokenize
+from request_metrics import Counter, current_trace
+
+MAGIC = b"QSAS1\n"
+_HEADER = struct.Struct("<Q")
+
+# Columns of a stored row, in table order
+ROW_FIELDS = ["A_ID", "A", "C_ID", "C", "C_Type", "B_ID", "B", "Target_Organ_IRI", "Target_Organ"]
+
+PRECOMPUTED_ANSWERS = Counter(
+    "qsparc_precomputed_answers_total",
+    "Questions answered from the precomputed template store.",
+    ["template"],
+)
+
+
+def label_key(label: str) -> str:
+    """Case- and plural-insensitive key for a structure name."""
+    return " ".join(tok for tok, _, _ in tokenize(label))
+
+
+def store_key(template: str, *labels: str) -> str:
+    return "|".join([template] + [label_key(label) for label in labels])
+
+
+# --- 1. Rendering ---
+
+def _numbered(items: Iterable[str], indent: str = "") -> List[str]:
+    return [f"{indent}{i}. {item}" for i, item in enumerate(items, 1)]
+
+
+def render_table(rows: List[List[str]]) -> str:
+    """
+    Markdown table with A/B/C IRIs replaced by short aliases and a legend,
+    following the rules in the server's system prompt.
+    """
+    aliases: Dict[str, "OrderedDict[str, str]"] = {"A": OrderedDict(), "B": OrderedDict(), "C": OrderedDict()}
+
+    def alias(prefix: str, iri: str) -> str:
+        table = aliases[prefix]
+        if iri not in table:
+            table[iri] = f"{prefix}{len(table) + 1}"
+        return table[iri]
+
+    lines = [
+        "| Origin (A_ID) | Origin | Via (C_ID) | Via | Destination (B_ID) | Destination | Target Organ |",
+        "|---|---|---|---|---|---|---|",
+    ]
+    for a_id, a, c_id, c, _c_type, b_id, b, _organ_iri, organ in rows:
+        lines.append(
+            f"| {alias('A', a_id)} | {a} | {alias('C', c_id)} | {c} | {alias('B', b_id)} | {b} | {organ} |"
+        )
+    legend = ["", "Legend:"]
+    for prefix in ("A", "B", "C"):
+        legend.extend(f"- {short}: {iri}" for iri, short in aliases[prefix].items())
+    return "\n".join(lines + legend)
+
+
+def _unique(values: Iterable[str]) -> List[str]:
+    return list(OrderedDict.fromkeys(v for v in values if v and v != "N/A"))
+
+
+def summarize_connection(x: str, y: str, rows: List[List[str]]) -> str:
+    by_via = defaultdict(list)
+    for row in rows:
+        by_via[row[3]].append(f"From {row[1]} to {row[6]}")
+    lines = [f"Yes, there is a connection from {x} to {y}. The pathways are summarized as follows:", ""]
+    for i, (via, paths) in enumerate(by_via.items(), 1):
+        lines.append(f"{i}. Via {via}:")
+        lines.extend(f"   - {p}" for p in _unique(paths))
+    return "\n".join(lines)
+
+
+def summarize_projections(x: str, rows: List[List[str]]) -> str:
+    by_organ = defaultdict(list)
+    for row in rows:
+        by_organ[row[8]].append(row[6])
+    lines = [f"The {x} projects to the following organs:", ""]
+    for i, (organ, parts) in enumerate(by_organ.items(), 1):
+        lines.append(f"{i}. {organ}:")
+        lines.extend(f"   - {p}" for p in _unique(parts))
+    return "\n".join(lines)
+
+
+def summarize_terminations(y: str, rows: List[List[str]]) -> str:
+    lines = [f"The connections that terminate in the {y} can be summarized as follows:", "", "Origins of Connections:"]
+    lines.extend(_numbered(_unique(row[1] for row in rows)))
+    lines += ["", "Parts of the Organ the Connections Terminate:"]
+    lines.extend(_numbered(_unique(row[6] for row in rows)))
+    lines += ["", "Nerves Involved in Those Connections:"]
+    lines.extend(_numbered(_unique(row[3] for row in rows)))
+    return "\n".join(lines)
+
+
+def summarize_innervation(z: str, rows: List[List[str]]) -> str:
+    by_origin = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        by_origin[row[1]][row[8]].append(row[6])
+    lines = [f"The {z} innervates the following organs, categorized by origin:"]
+    for origin, organs in by_origin.items():
+        lines += ["", f"From {origin}:", ""]
+        for i, (organ, parts) in enumerate(organs.items(), 1):
+            lines.append(f"{i}. {organ}:")
+            lines.extend(f"   - {p}" for p in _unique(parts))
+    return "\n".join(lines)
+
+
+# --- 2. Templates ---
+# name -> (question regex with named slots, slot -> record columns it must match)
+
+_END = r"(?=\s+in\s+(?:rats?|mice|mouse|humans?)\b|[?.!,]|$)"
+TEMPLATES: Dict[str, Tuple[re.Pattern, Dict[str, Tuple[str, ...]]]] = {
+    "connection": (
+        re.compile(rf"\bconnections?\s+from\s+(?:the\s+)?(?P<x>.+?)\s+to\s+(?:the\s+)?(?P<y>.+?){_END}", re.I),
+        {"x": ("A",), "y": ("B", "Target_Organ")},
+    ),
+    "projects": (
+        re.compile(
+            rf"\borgans?\s+(?:does|do)\s+(?:the\s+)?(?P<x>.+?)\s+project(?:\s+to)?{_END}"
+            rf"|\borgans?\s+(?:that\s+)?(?:the\s+)?(?P<x2>.+?)\s+projects?\s+to{_END}",
+            re.I,
+        ),
+        {"x": ("A",)},
+    ),
+    "terminates": (
+        re.compile(rf"\bconnections?\s+terminates?\s+(?:in|at)\s+(?:the\s+)?(?P<y>.+?){_END}", re.I),
+        {"y": ("B", "Target_Organ")},
+    ),
+    "innervated_by": (
+        re.compile(rf"\borgans?\s+(?:are\s+|is\s+)?innervated\s+by\s+(?:the\s+)?(?P<z>.+?){_END}", re.I),
+        {"z": ("C",)},
+    ),
+}
+
+# Negations and route qualifiers change what is asked; such questions go to the model
+_QUALIFIER_RE = re.compile(r"\b(?:no|not|never|none|without|except|excluding|via|through|\w+n't)\b", re.I)
+# Tokens a slot may contain besides the structure name itself
+_SLOT_FILLER = {"the", "a", "an"}
+
+
+def _row(record: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(record.get(field, "N/A") for field in ROW_FIELDS)
+
+
+def _present(value: Optional[str]) -> bool:
+    return bool(value) and value != "N/A"
+
+
+def enumerate_answers(records: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Every template instantiated over the distinct values present in the records."""
+    groups: Dict[str, "OrderedDict[Tuple[str, ...], None]"] = defaultdict(OrderedDict)
+    labels: Dict[str, Tuple[str, ...]] = {}
+
+    def add(key_parts: Tuple[str, ...], row: Tuple[str, ...]) -> None:
+        key = store_key(*key_parts)
+        groups[key][row] = None
+        labels.setdefault(key, key_parts)
+
+    for record in records:
+        row = _row(record)
+        a, b, c, organ = record.get("A"), record.get("B"), record.get("C"), record.get("Target_Organ")
+        if _present(a):
+            add(("projects", a), row)
+            for dest in (b, organ):
+                if _present(dest):
+                    add(("connection", a, dest), row)
+        for dest in {b, organ}:
+            if _present(dest):
+                add(("terminates", dest), row)
+        if _present(c):
+            add(("innervated_by", c), row)
+
+    answers = {}
+    for key, rows in groups.items():
+        template, *names = labels[key]
+        rows = [list(r) for r in rows]
+        if template == "connection":
+            summary = summarize_connection(names[0], names[1], rows)
+        elif template == "projects":
+            summary = summarize_projections(names[0], rows)
+        elif template == "terminates":
+            summary = summarize_terminations(names[0], rows)
+        else:
+            summary = summarize_innervation(names[0], rows)
+        answers[key] = {"template": template, "rows": rows, "answer": summary + "\n\n" + render_table(rows)}
+    return answers
+
+
+# --- 3. File format ---
+
+def write_answer_store(answers: Dict[str, Dict[str, Any]], path: str) -> None:
+    tmp_path = f"{path}.tmp"
+    index = {}
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_HEADER.pack(0))
+        for key, value in answers.items():
+            blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+            index[key] = [f.tell(), len(blob)]
+            f.write(blob)
+        index_offset = f.tell()
+        f.write(zlib.compress(json.dumps(index, separators=(",", ":")).encode(), 6))
+        f.seek(len(MAGIC))
+        f.write(_HEADER.pack(index_offset))
+    os.replace(tmp_path, path)
+
+
+class AnswerStore:
+    """Read-only, memory-mapped view of a precomputed answer file."""
+
+    def __init__(self, path: str, matcher: EntityMatcher):
+        self.path = path
+        self.matcher = matcher
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a precomputed answer store")
+        (index_offset,) = _HEADER.unpack_from(self._mm, len(MAGIC))
+        self._index: Dict[str, List[int]] = json.loads(zlib.decompress(self._mm[index_offset:]))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        return json.loads(zlib.decompress(self._mm[offset:offset + length]))
+
+    def _resolve(self, span: str, columns: Tuple[str, ...]) -> Optional[str]:
+        """
+        The structure name a slot span consists of, if it occurs in one of the
+        given columns; None when the span says anything more than that name.
+        """
+        matches = self.matcher.match(span)
+        if len(matches) != 1 or not any(field in columns for field in matches[0].fields):
+            return None
+        match = matches[0]
+        leftover = [
+            tok for tok, start, end in tokenize(span)
+            if (end <= match.start or start >= match.end) and tok not in _SLOT_FILLER
+        ]
+        return None if leftover else match.label
+
+    def lookup(self, question: str) -> Optional[Dict[str, Any]]:
+        """Stored answer for a template-shaped question, or None."""
+        if _QUALIFIER_RE.search(question):
+            return None
+        for template, (pattern, slots) in TEMPLATES.items():
+            m = pattern.search(question)
+            if not m:
+                continue
+            # Alternatives of one slot are numbered (x, x2) since group names must be unique
+            spans = {slot.rstrip("2"): value for slot, value in m.groupdict().items() if value}
+            names = []
+            for slot, columns in slots.items():
+                resolved = self._resolve(spans.get(slot, ""), columns)
+                if resolved is None:
+                    break
+                names.append(resolved)
+            else:
+                value = self.get(store_key(template, *names))
+                if value is not None:
+                    return value
+        return None
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
+
+
+def precomputed_answer(store: Optional[AnswerStore], question: str) -> Optional[str]:
+    """Answer text from the store (counted in metrics), or None to fall through."""
+    if store is None:
+        return None
+    value = store.lookup(question)
+    if value is None:
+        return None
+    PRECOMPUTED_ANSWERS.inc(value["template"])
+    trace = current_trace()
+    if trace is not None:
+        trace.set(precomputed=value["template"], retrieved_docs=len(value["rows"]))
+    return value["answer"]
+
+
+if __name__ == "__main__":
+    from sckan_index import load_and_process_documents
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=os.environ.get("QSPARC_DATA_FILE"), help="SCKAN JSON export.")
+    parser.add_argument("--out", help="Output file (default: <data>.answers.qsas).")
+    args = parser.parse_args()
+    if not args.data:
+        sys.exit("--data (or QSPARC_DATA_FILE) is required")
+
+    documents = load_and_process_documents(args.data)
+    all_answers = enumerate_answers(doc.metadata for doc in documents)
+    out_path = args.out or args.data + ".answers.qsas"
+    write_answer_store(all_answers, out_path)
+    print(f"Wrote {len(all_answers)} precomputed answers to {out_path} ({os.path.getsize(out_path)} bytes).")
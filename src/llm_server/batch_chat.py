@@ -0,0 +1,67 @@
+import json
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
+
+from request_metrics import Counter, Histogram
+
+# --- Batch question answering ---
+# /chat/batch answers many history-free questions in one request. Retrieval
+# for the whole batch runs as one vectorized pass (see
+# DatasetIndex.retrieve_many); each item then runs its own generation, and
+# the results are streamed back as NDJSON, one line per item in completion
+# order. An item that fails produces an error line; the rest of the batch
+# carries on. If the client goes away, unfinished items are cancelled.
+
+BATCH_ITEMS = Counter(
+    "qsparc_batch_items_total",
+    "Batch request items by how they were answered.",
+    ["outcome"],
+)
+BATCH_SIZE = Histogram(
+    "qsparc_batch_size",
+    "Questions per batch request.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+
+
+def ndjson_line(payload: Dict[str, Any]) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+def error_payload(exc: BaseException) -> Dict[str, str]:
+    return {"type": type(exc).__name__, "detail": str(exc)}
+
+
+async def stream_in_completion_order(
+    items: List[Dict[str, Any]],
+    run_item: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+    max_concurrency: int,
+) -> AsyncIterator[bytes]:
+    """
+    Runs run_item for every item, at most max_concurrency at a time, and
+    yields one NDJSON line per item as soon as it finishes. The line carries
+    the item's "index" and "id" plus either run_item's result or an "error".
+    """
+    limit = asyncio.Semaphore(max_concurrency)
+
+    async def guarded(item: Dict[str, Any]) -> Dict[str, Any]:
+        head = {"index": item["index"], "id": item.get("id")}
+        async with limit:
+            try:
+                result = await run_item(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                BATCH_ITEMS.inc("error")
+                return {**head, "error": error_payload(exc)}
+        BATCH_ITEMS.inc(result.get("source", "generated"))
+        return {**head, **result}
+
+    tasks = [asyncio.ensure_future(guarded(item)) for item in items]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield ndjson_line(await next_done)
+    finally:
+        # Client disconnected or the stream was abandoned: stop the remaining work
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from typing import Sequence
+
+from request_metrics import Counter, current_trace, route_label
+
+# --- Cancellation of abandoned requests ---
+# The UI drops a request when the user reloads or sends a new message, but the
+# handler would keep retrieving and generating until the answer is complete.
+# The middleware below runs the handler as a task and watches the ASGI receive
+# channel for http.disconnect. When the client leaves before the response is
+# complete, the handler task is cancelled. The CancelledError unwinds the chain:
+# the upstream vLLM stream is closed (vLLM aborts the sequence and frees its
+# decode slot), scheduler slots are released and coalesced flights without
+# waiters stop. Work already running in a worker thread (e.g. an embedding call)
+# finishes, but no further stage is started.
+
+logger = logging.getLogger("qsparc.requests")
+
+CANCELLED_REQUESTS = Counter(
+    "qsparc_cancelled_requests_total",
+    "Requests cancelled because the client disconnected before the response was complete.",
+    ["path", "phase"],
+)
+
+
+class CancelOnDisconnectMiddleware:
+    """
+    Pure ASGI middleware that cancels the downstream handler as soon as the
+    client disconnects, for both streaming and non-streaming responses.
+    Requests whose path does not start with one of `prefixes` pass through.
+    """
+
+    def __init__(self, app, prefixes: Sequence[str] = ("/chain",)):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        # Every message from the server goes through this queue, so the
+        # handler still sees its body (and the disconnect) while we listen
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = asyncio.Event()
+        response = {"started": False, "complete": False}
+
+        async def forward_receive():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["started"] = True
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                response["complete"] = True
+            await send(message)
+
+        started = time.perf_counter()
+        handler = asyncio.create_task(self.app(scope, messages.get, send_wrapper))
+        reader = asyncio.create_task(forward_receive())
+        watcher = asyncio.create_task(disconnected.wait())
+        try:
+            await asyncio.wait({handler, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not handler.done() and not response["complete"]:
+                handler.cancel()
+                self._record(route_label(scope), response["started"], time.perf_counter() - started)
+                try:
+                    await handler
+                except (asyncio.CancelledError, Exception) as e:
+                    logger.debug("Handler for %s ended after client disconnect: %r", scope["path"], e)
+                return
+            # Finished, or the disconnect arrived after the full response was sent
+            await handler
+        finally:
+            for task in (handler, reader, watcher):
+                if not task.done():
+                    task.cancel()
+
+    @staticmethod
+    def _record(path: str, response_started: bool, elapsed: float) -> None:
+        phase = "streaming" if response_started else "before_response"
+        CANCELLED_REQUESTS.inc(path, phase)
+        trace = current_trace()
+        if trace is not None:
+            trace.set(client_disconnected=True, cancel_phase=phase, cancelled_after_s=round(elapsed, 6))
@@ -0,0 +1,113 @@
+import re
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from request_metrics import Counter, Gauge, current_trace
+
+# --- Single-flight request coalescing ---
+# Identical history-free questions that arrive while one is already being
+# answered attach to the running generation instead of starting their own.
+# The upstream stream runs in its own task; every waiter replays the chunks
+# produced so far and then follows live ones. If every waiter goes away the
+# upstream task is cancelled.
+
+COALESCED_REQUESTS = Counter(
+    "qsparc_coalesced_requests_total",
+    "Requests served by joining an identical in-flight generation.",
+)
+FLIGHTS_IN_PROGRESS = Gauge(
+    "qsparc_coalescing_flights_in_progress",
+    "Distinct upstream generations currently shared by coalescing.",
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Coalescing key: case-folded, whitespace-collapsed, trailing punctuation removed."""
+    return _WHITESPACE_RE.sub(" ", question.casefold()).strip().rstrip("?.! ")
+
+
+class _Flight:
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.meta: Optional[Dict[str, Any]] = None
+        self.waiters = 0
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    """Shares one upstream async stream between concurrent identical requests."""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+
+    async def stream(
+        self,
+        key: str,
+        start: Callable[[], AsyncIterator[str]],
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yields the chunks of the flight for `key`, starting it if needed.
+        `meta` is filled in by the generation that starts the flight; other
+        callers get a copy of it once the flight is complete.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.meta = meta
+            flight.task = asyncio.create_task(self._pump(key, flight, start))
+            FLIGHTS_IN_PROGRESS.inc()
+        else:
+            COALESCED_REQUESTS.inc()
+            trace = current_trace()
+            if trace is not None:
+                trace.set(coalesced=True)
+
+        flight.waiters += 1
+        index = 0
+        try:
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: index < len(flight.chunks) or flight.done)
+                    pending = flight.chunks[index:]
+                    finished = flight.done
+                for chunk in pending:
+                    yield chunk
+                index += len(pending)
+                if finished and index >= len(flight.chunks):
+                    break
+            if flight.error is not None:
+                raise flight.error
+            if meta is not None and flight.meta is not None and flight.meta is not meta:
+                meta.update(flight.meta)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.done and flight.task is not None:
+                # Everyone who wanted this answer has left
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    async def _pump(self, key: str, flight: _Flight, start: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for chunk in start():
+                async with flight.changed:
+                    flight.chunks.append(chunk)
+                    flight.changed.notify_all()
+        except BaseException as e:
+            flight.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            # Later arrivals start a fresh generation
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            FLIGHTS_IN_PROGRESS.dec()
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
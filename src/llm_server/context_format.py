@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+# --- Context formatters ---
+# How retrieved rows are written into the prompt's CONTEXT block.
+#
+#   sentences  each row's page_content, one English paragraph per row
+#   compact    one pipe-delimited table: a header row, IRIs shortened to
+#              CURIEs (UBERON:0001255) with the prefixes listed once, columns
+#              that are N/A in every row left out, and rows that differ only
+#              in their neuron merged into one line
+#
+# The compact table carries the same facts in a fraction of the tokens
+# (compare with `retrieval_bench.py --context-format sentences compact`).
+
+# Longest namespaces first, so the most specific prefix wins
+IRI_PREFIXES: List[Tuple[str, str]] = [
+    ("UBERON:", "http://purl.obolibrary.org/obo/UBERON_"),
+    ("ILX:", "http://uri.interlex.org/base/ilx_"),
+    ("NEURON:", "http://uri.interlex.org/tgbugs/uris/readable/"),
+    ("OBO:", "http://purl.obolibrary.org/obo/"),
+]
+
+# (header, metadata field) in table order; the hierarchy IDs are left out
+COMPACT_COLUMNS: List[Tuple[str, str]] = [
+    ("Neuron", "Neuron_ID"),
+    ("Origin (A)", "A"),
+    ("A_ID", "A_ID"),
+    ("Via (C)", "C"),
+    ("C_ID", "C_ID"),
+    ("C_Type", "C_Type"),
+    ("Destination (B)", "B"),
+    ("B_ID", "B_ID"),
+    ("Target Organ", "Target_Organ"),
+    ("Organ IRI", "Target_Organ_IRI"),
+    ("A_L1", "A_L1"),
+    ("A_L2", "A_L2"),
+    ("A_L3", "A_L3"),
+]
+
+
+def format_sentences(docs: List[Document]) -> str:
+    """One paragraph per row (the page_content that was embedded)."""
+    return "\n\n".join(doc.page_content for doc in docs)
+
+
+def abbreviate_iri(value: str, used: Dict[str, str]) -> str:
+    """CURIE for a known namespace (recorded in `used`), else the value unchanged."""
+    for prefix, namespace in IRI_PREFIXES:
+        if value.startswith(namespace):
+            used[prefix] = namespace
+            return prefix + value[len(namespace):]
+    return value
+
+
+def _cell(value: str) -> str:
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def format_compact_table(docs: List[Document]) -> str:
+    """Deduplicated pipe-delimited table of the rows' metadata."""
+    if not docs:
+        return ""
+    columns = [
+        (header, field) for header, field in COMPACT_COLUMNS
+        if any(doc.metadata.get(field, "N/A") != "N/A" for doc in docs)
+    ]
+    used: Dict[str, str] = {}
+    # Everything but the neuron -> neurons sharing that row, in first-seen order
+    merged: "OrderedDict[Tuple[str, ...], List[str]]" = OrderedDict()
+    for doc in docs:
+        cells = tuple(
+            _cell(abbreviate_iri(str(doc.metadata.get(field, "N/A")), used))
+            for _, field in columns if field != "Neuron_ID"
+        )
+        neurons = merged.setdefault(cells, [])
+        neuron = _cell(abbreviate_iri(str(doc.metadata.get("Neuron_ID", "N/A")), used))
+        if neuron not in neurons:
+            neurons.append(neuron)
+
+    has_neuron = any(field == "Neuron_ID" for _, field in columns)
+    lines = []
+    if used:
+        lines.append("Prefixes: " + "; ".join(f"{prefix} = {namespace}" for prefix, namespace in used.items()))
+    lines.append("|".join(header for header, _ in columns))
+    for cells, neurons in merged.items():
+        lines.append("|".join(((",".join(neurons),) if has_neuron else ()) + cells))
+    return "\n".join(lines)
+
+
+CONTEXT_FORMATTERS: Dict[str, Callable[[List[Document]], str]] = {
+    "sentences": format_sentences,
+    "compact": format_compact_table,
+}
+
+# Extra system-prompt rule per format, so the table/Legend instructions match
+# what the CONTEXT block actually contains (no braces: it becomes part of a template)
+CONTEXT_INSTRUCTIONS: Dict[str, str] = {
+    "sentences": "",
+    "compact": (
+        "5.  The CONTEXT is a pipe-delimited table. Its IDs are CURIEs (e.g., UBERON:0001255): "
+        "expand each one to its full URL with the namespaces on the \"Prefixes:\" line before "
+        "aliasing it, and give the expanded URL in the Legend, never the CURIE. A Neuron cell may "
+        "list several neurons separated by commas; they share the rest of that row.\n"
+    ),
+}
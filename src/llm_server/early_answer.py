@@ -0,0 +1,97 @@
+import math
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from entity_matcher import ENTITY_FIELDS, EntityMatcher, EntityMatch
+from request_metrics import Counter, current_trace
+
+# --- Pre-generation evidence check ---
+# Decides, before any LLM call, whether retrieval found rows that can answer
+# the question. When it clearly did not, the server can reply with a fixed
+# "no results" message (or a small model) instead of a full 32B generation.
+
+# Relevance below this on every retrieved row counts as "nothing relevant"
+DEFAULT_MIN_RELEVANCE = 0.3
+# QSPARC_NO_DATA_MODE values (see server.py)
+NO_DATA_MODES = ("template", "small_model", "off")
+
+NO_DATA_TEMPLATE = (
+    "Based on the information provided, there are no results available from the SCKAN "
+    "autonomous nervous system connectivity knowledge base regarding {topic}. "
+    "Therefore, I am unable to summarize any pathways for this question."
+)
+
+EARLY_ANSWERS = Counter(
+    "qsparc_early_answers_total",
+    "Requests answered without the large model because no relevant rows were found.",
+    ["reason", "mode"],
+)
+
+
+class EvidenceCheck(NamedTuple):
+    has_data: bool
+    reason: str
+    entities: Tuple[EntityMatch, ...]
+    max_relevance: Optional[float]
+
+
+def relevance_from_distance(distance: float) -> float:
+    """
+    Chroma's default L2 distance mapped to a [0, 1] relevance score, the same
+    conversion LangChain applies for unit-normalized embeddings.
+    """
+    return 1.0 - distance / math.sqrt(2)
+
+
+def assess_evidence(
+    question: str,
+    docs: List[Document],
+    matcher: EntityMatcher,
+    has_history: bool = False,
+    min_relevance: float = DEFAULT_MIN_RELEVANCE,
+) -> EvidenceCheck:
+    """
+    Classifies the retrieved rows for a question:
+
+    * structures named in the question appear in a retrieved row -> data
+    * structures are named but none of them appear, and all rows score below
+      min_relevance -> no data ("entities_not_found")
+    * nothing named, no chat history to lean on and all rows score below
+      min_relevance -> no data ("low_relevance")
+    """
+    entities = tuple(matcher.match(question))
+    scores = [doc.metadata["relevance_score"] for doc in docs if "relevance_score" in doc.metadata]
+    max_relevance = max(scores) if scores else None
+    low_relevance = not docs or (max_relevance is not None and max_relevance < min_relevance)
+
+    if not docs:
+        return EvidenceCheck(False, "no_rows", entities, max_relevance)
+    if entities:
+        wanted = {iri for match in entities for iri in match.iris}
+        for doc in docs:
+            if any(doc.metadata.get(iri_key) in wanted for _, iri_key in ENTITY_FIELDS):
+                return EvidenceCheck(True, "entity_match", entities, max_relevance)
+        if low_relevance:
+            return EvidenceCheck(False, "entities_not_found", entities, max_relevance)
+    elif low_relevance and not has_history:
+        return EvidenceCheck(False, "low_relevance", entities, max_relevance)
+    return EvidenceCheck(True, "relevance", entities, max_relevance)
+
+
+def no_data_answer(check: EvidenceCheck) -> str:
+    """Templated reply naming the structures the question asked about."""
+    labels = []
+    for match in check.entities:
+        if match.text not in labels:
+            labels.append(match.text)
+    topic = " and ".join(labels) if labels else "this question"
+    return NO_DATA_TEMPLATE.format(topic=topic)
+
+
+def record_early_answer(check: EvidenceCheck, mode: str) -> None:
+    """Counts a short-circuited request and tags the current trace."""
+    EARLY_ANSWERS.inc(check.reason, mode)
+    trace = current_trace()
+    if trace is not None:
+        trace.set(early_answer=check.reason, early_answer_mode=mode)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Embedding backend benchmark: parity, query latency and startup cost.
+
+Each backend of embedding_provider.py is compared with a reference backend
+(the PyTorch sentence-transformers model the indexes were built with):
+
+  parity    cosine similarity between the two vectors of every gold question
+            and of a sample of documents, and the overlap of the top-k
+            documents each backend ranks for the questions
+  latency   single-query embed_query time, p50/p95 over the gold questions
+  startup   a fresh interpreter importing the provider, loading the model and
+            embedding one query, and whether torch got imported
+
+    python embedding_bench.py --data /path/to/a-b-via-c.json --backends onnx onnx-int8
+
+Exits with status 1 when a backend's minimum cosine falls below --min-cosine,
+so it can gate a switch of QSPARC_EMBEDDING_BACKEND.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+from typing import Any, Dict, List
+
+import numpy as np
+
+from embedding_provider import EMBEDDING_BACKENDS, get_embeddings
+from retrieval_bench import GOLD_SET_PATH, load_gold_set
+from sckan_index import EMBEDDING_MODEL, load_and_process_documents
+
+STARTUP_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+from embedding_provider import get_embeddings
+embeddings = get_embeddings({model!r}, {backend!r})
+embeddings.embed_query("warm up")
+print(json.dumps({{"startup_s": time.perf_counter() - start, "torch_imported": "torch" in sys.modules}}))
+"""
+
+
+def _normalized(vectors: List[List[float]]) -> np.ndarray:
+    array = np.asarray(vectors, dtype=np.float32)
+    return array / np.maximum(np.linalg.norm(array, axis=1, keepdims=True), 1e-12)
+
+
+def measure_startup(backend: str, model_name: str) -> Dict[str, Any]:
+    """Cold start in a separate interpreter, so imports already made here are not reused."""
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP_SNIPPET.format(model=model_name, backend=backend)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_s"] = time.perf_counter() - started
+    return result
+
+
+def measure_latency(embeddings, questions: List[str], repeat: int) -> Dict[str, float]:
+    embeddings.embed_query(questions[0])
+    latencies = []
+    for _ in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            embeddings.embed_query(question)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "latency_p50_ms": round(1000 * latencies[len(latencies) // 2], 2),
+        "latency_p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2),
+    }
+
+
+def measure_parity(
+    reference: Dict[str, np.ndarray], candidate: Dict[str, np.ndarray], top_k: int
+) -> Dict[str, float]:
+    """Per-text cosine between backends, and top-k document overlap for the questions."""
+    cosines = np.concatenate([
+        (reference[part] * candidate[part]).sum(axis=1) for part in ("questions", "documents")
+    ])
+    overlaps = []
+    ref_scores = reference["questions"] @ reference["documents"].T
+    cand_scores = candidate["questions"] @ candidate["documents"].T
+    k = min(top_k, ref_scores.shape[1])
+    for ref_row, cand_row in zip(ref_scores, cand_scores):
+        ref_top = set(np.argsort(-ref_row)[:k].tolist())
+        cand_top = set(np.argsort(-cand_row)[:k].tolist())
+        overlaps.append(len(ref_top & cand_top) / k)
+    return {
+        "cosine_min": round(float(cosines.min()), 5),
+        "cosine_mean": round(float(cosines.mean()), 5),
+        f"top{k}_overlap": round(float(np.mean(overlaps)), 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=os.environ.get("QSPARC_DATA_FILE"), help="SCKAN JSON export.")
+    parser.add_argument("--gold", default=GOLD_SET_PATH, help="Gold question file (query texts).")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--reference", default="huggingface", choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--backends", nargs="+", default=["onnx", "onnx-int8"], choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--samples", type=int, default=500, help="Documents sampled for parity.")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the questions for latency.")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    parser.add_argument("--skip-startup", action="store_true")
+    parser.add_argument("--output", help="Write the result rows as JSON to this file.")
+    args = parser.parse_args()
+    if not args.data:
+        sys.exit("--data (or QSPARC_DATA_FILE) is required")
+
+    questions = [item.question for item in load_gold_set(args.gold)]
+    documents = load_and_process_documents(args.data)
+    sample = random.Random(0).sample(documents, min(args.samples, len(documents)))
+    texts = {"questions": questions, "documents": [doc.page_content for doc in sample]}
+
+    rows, vectors, failed = [], {}, []
+    for backend in [args.reference] + [b for b in args.backends if b != args.reference]:
+        row: Dict[str, Any] = {"backend": backend}
+        if not args.skip_startup:
+            row.update({key: round(value, 3) if isinstance(value, float) else value
+                        for key, value in measure_startup(backend, args.model).items()})
+        embeddings = get_embeddings(args.model, backend)
+        row.update(measure_latency(embeddings, questions, args.repeat))
+        vectors[backend] = {
+            "questions": _normalized([embeddings.embed_query(q) for q in questions]),
+            "documents": _normalized(embeddings.embed_documents(texts["documents"])),
+        }
+        if backend != args.reference:
+            row.update(measure_parity(vectors[args.reference], vectors[backend], args.top_k))
+            if row["cosine_min"] < args.min_cosine:
+                failed.append(backend)
+        rows.append(row)
+        print(json.dumps(row))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+    if failed:
+        sys.exit(f"Parity below {args.min_cosine} for: {', '.join(failed)}")
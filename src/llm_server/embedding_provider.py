@@ -0,0 +1,127 @@
+import os
+import re
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# --- Embedding providers ---
+# Documents and queries are embedded with one sentence-transformer model
+# (EMBEDDING_MODEL in sckan_index.py), through one of these backends:
+#
+#   huggingface  sentence-transformers on PyTorch (HuggingFaceEmbeddings)
+#   onnx         the model's ONNX export on ONNX Runtime: no torch import,
+#                mean pooling and L2 normalization done in NumPy
+#   onnx-int8    the same graph with dynamically quantized int8 weights,
+#                produced once and cached under ONNX_CACHE_DIR
+#
+# All backends return L2-normalized vectors of the same model, so a store
+# built with one can be queried with another (check parity with
+# embedding_bench.py before switching). Providers are cached per
+# (backend, model), so every dataset index shares one loaded model.
+
+EMBEDDING_BACKENDS = ("huggingface", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.environ.get("QSPARC_EMBEDDING_BACKEND", "huggingface")
+ONNX_CACHE_DIR = os.environ.get(
+    "QSPARC_ONNX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "qsparc", "onnx"))
+# sentence-transformers truncates all-MiniLM-L6-v2 inputs at 256 word pieces
+ONNX_MAX_LENGTH = 256
+ONNX_BATCH_SIZE = 64
+
+
+def _model_file(model_name: str, filename: str) -> str:
+    """Path of a model file: from a local model directory, else the Hugging Face Hub cache."""
+    if os.path.isdir(model_name):
+        return os.path.join(model_name, filename)
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(repo_id=model_name, filename=filename)
+
+
+def quantized_model_path(model_name: str, model_path: str) -> str:
+    """int8 copy of an ONNX model (dynamic quantization of the weights), built on first use."""
+    out_dir = os.path.join(ONNX_CACHE_DIR, re.sub(r"[^\w.-]+", "--", model_name.strip("/")))
+    out_path = os.path.join(out_dir, "model_int8.onnx")
+    if not os.path.exists(out_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        os.makedirs(out_dir, exist_ok=True)
+        tmp_path = f"{out_path}.{os.getpid()}.tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, out_path)
+    return out_path
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    Sentence-transformer embeddings on ONNX Runtime (CPU). Mirrors the
+    all-MiniLM-L6-v2 pipeline: word-piece tokens, transformer, attention-masked
+    mean pooling, L2 normalization.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        quantize: bool = False,
+        max_length: int = ONNX_MAX_LENGTH,
+        batch_size: int = ONNX_BATCH_SIZE,
+        threads: Optional[int] = None,
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        model_path = _model_file(model_name, "onnx/model.onnx")
+        if quantize:
+            model_path = quantized_model_path(model_name, model_path)
+        self.model_path = model_path
+
+        self.tokenizer = Tokenizer.from_file(_model_file(model_name, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        encodings = self.tokenizer.encode_batch(texts)
+        ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+        hidden = self.session.run(None, feeds)[0]
+        weights = mask[:, :, None].astype(np.float32)
+        pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors.extend(self._embed(texts[i:i + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+def get_embeddings(model_name: str, backend: Optional[str] = None) -> Embeddings:
+    """Shared embedding provider for a model; backend defaults to QSPARC_EMBEDDING_BACKEND."""
+    # Normalized before the cache, so the default and its explicit name share one model
+    return _load_embeddings(model_name, backend or EMBEDDING_BACKEND)
+
+
+@lru_cache(maxsize=None)
+def _load_embeddings(model_name: str, backend: str) -> Embeddings:
+    if backend == "huggingface":
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=model_name)
+    if backend in ("onnx", "onnx-int8"):
+        return ONNXEmbeddings(model_name, quantize=backend == "onnx-int8")
+    raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {EMBEDDING_BACKENDS}")
@@ -0,0 +1,291 @@
+import os
+import re
+import pickle
+from collections import deque
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Set, Tuple
+
+# --- Dictionary matcher for SCKAN anatomical terms ---
+# An Aho-Corasick automaton over *normalized word tokens* built from every
+# structure name in the `clean_data` records. Scanning a question is linear
+# in its length, independent of how many names are in the dictionary.
+
+# (label column, IRI column) pairs of a clean_data record that name structures
+ENTITY_FIELDS = [
+    ("A", "A_ID"),
+    ("B", "B_ID"),
+    ("C", "C_ID"),
+    ("A_L1", "A_L1_ID"),
+    ("A_L2", "A_L2_ID"),
+    ("A_L3", "A_L3_ID"),
+    ("Target_Organ", "Target_Organ_IRI"),
+]
+
+# Bump when the pickled layout changes so stale caches are rebuilt
+FORMAT_VERSION = 1
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Latin/Greek plurals that are common in anatomy and not handled by suffix rules
+_IRREGULAR_PLURALS = {
+    "ganglia": "ganglion",
+    "nuclei": "nucleus",
+    "plexi": "plexus",
+    "plexuses": "plexus",
+    "bronchi": "bronchus",
+    "bronchioles": "bronchiole",
+    "vertebrae": "vertebra",
+    "testes": "testis",
+    "ovaries": "ovary",
+    "corpora": "corpus",
+    "viscera": "viscus",
+    "rami": "ramus",
+    "radices": "radix",
+    "foramina": "foramen",
+}
+
+
+class EntityMatch(NamedTuple):
+    """A dictionary hit inside a question."""
+    text: str               # the matched span as written in the question
+    start: int              # character offsets into the question
+    end: int
+    label: str              # canonical label from the data
+    iris: Tuple[str, ...]   # every IRI that carries this name
+    fields: Tuple[str, ...] # columns the name occurs in (A, B, C, ...)
+
+
+def normalize_token(token: str) -> str:
+    """Lower-cased singular form of a single word token."""
+    if token in _IRREGULAR_PLURALS:
+        return _IRREGULAR_PLURALS[token]
+    if len(token) <= 3 or token.isdigit() or token.endswith(("ss", "us", "is")):
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith(("ches", "shes", "sses", "xes")):
+        return token[:-2]
+    if token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """Splits text into (normalized token, start, end) triples."""
+    return [
+        (normalize_token(m.group()), m.start(), m.end())
+        for m in _TOKEN_RE.finditer(text.lower())
+    ]
+
+
+def iri_local_name(iri: str) -> str:
+    """'http://purl.obolibrary.org/obo/UBERON_0005453' -> 'UBERON_0005453'."""
+    return re.split(r"[/#]", iri.rstrip("/"))[-1]
+
+
+class EntityMatcher:
+    """
+    Token-level Aho-Corasick automaton mapping structure names to IRIs.
+    Build it with `from_records` at ingest time and persist it with `save`.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+        # entry id -> (label, token length, iris, fields)
+        self._entries: List[Tuple[str, int, Set[str], Set[str]]] = []
+        self._entry_by_key: Dict[Tuple[str, ...], int] = {}
+        self._compiled = False
+
+    # --- Construction ---
+
+    def add(self, name: str, iri: str, field: str) -> None:
+        """Registers one surface name for an IRI."""
+        key = tuple(tok for tok, _, _ in tokenize(name))
+        if not key or not iri or iri == "N/A":
+            return
+        entry_id = self._entry_by_key.get(key)
+        if entry_id is None:
+            entry_id = len(self._entries)
+            self._entries.append((name, len(key), set(), set()))
+            self._entry_by_key[key] = entry_id
+            self._insert(key, entry_id)
+        self._entries[entry_id][2].add(iri)
+        self._entries[entry_id][3].add(field)
+        self._compiled = False
+
+    def _insert(self, key: Tuple[str, ...], entry_id: int) -> None:
+        state = 0
+        for tok in key:
+            nxt = self._goto[state].get(tok)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][tok] = nxt
+            state = nxt
+        self._out[state].append(entry_id)
+
+    def compile(self) -> "EntityMatcher":
+        """Computes failure links (breadth-first) once all names are added."""
+        # Outputs start from the names ending at each state, so compiling
+        # again after add() does not append the fallback outputs twice
+        self._out = [[] for _ in self._goto]
+        for key, entry_id in sorted(self._entry_by_key.items(), key=lambda item: item[1]):
+            state = 0
+            for tok in key:
+                state = self._goto[state][tok]
+            self._out[state].append(entry_id)
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+        while queue:
+            state = queue.popleft()
+            for tok, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and tok not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(tok, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+        self._compiled = True
+        return self
+
+    @classmethod
+    def from_records(
+        cls,
+        records: Iterable[Dict[str, Any]],
+        synonyms: Optional[Dict[str, List[str]]] = None,
+    ) -> "EntityMatcher":
+        """
+        Builds the automaton from clean_data records. Every distinct label and
+        the IRI's local name (e.g. UBERON_0005453) become patterns; `synonyms`
+        optionally maps an IRI to further names.
+        """
+        matcher = cls()
+        seen = set()
+        for record in records:
+            for label_key, iri_key in ENTITY_FIELDS:
+                label, iri = record.get(label_key), record.get(iri_key)
+                if not iri or iri == "N/A" or (label, iri, label_key) in seen:
+                    continue
+                seen.add((label, iri, label_key))
+                if label and label != "N/A":
+                    matcher.add(label, iri, label_key)
+                matcher.add(iri_local_name(iri), iri, label_key)
+        for iri, names in (synonyms or {}).items():
+            for name in names:
+                matcher.add(name, iri, "synonym")
+        return matcher.compile()
+
+    # --- Lookup ---
+
+    def match(self, text: str) -> List[EntityMatch]:
+        """
+        Returns the leftmost-longest, non-overlapping dictionary hits in text.
+        """
+        if not self._compiled:
+            self.compile()
+        tokens = tokenize(text)
+        candidates = []
+        state = 0
+        for i, (tok, _, _) in enumerate(tokens):
+            while state and tok not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(tok, 0)
+            for entry_id in self._out[state]:
+                length = self._entries[entry_id][1]
+                candidates.append((i - length + 1, -length, entry_id))
+
+        matches = []
+        next_free = 0
+        for start_tok, neg_len, entry_id in sorted(candidates):
+            if start_tok < next_free:
+                continue
+            end_tok = start_tok - neg_len - 1
+            label, _, iris, fields = self._entries[entry_id]
+            start, end = tokens[start_tok][1], tokens[end_tok][2]
+            matches.append(EntityMatch(
+                text=text[start:end],
+                start=start,
+                end=end,
+                label=label,
+                iris=tuple(sorted(iris)),
+                fields=tuple(sorted(fields)),
+            ))
+            next_free = end_tok + 1
+        return matches
+
+    def matched_iris(self, text: str) -> Set[str]:
+        """Convenience wrapper returning only the IRIs found in text."""
+        return {iri for m in self.match(text) for iri in m.iris}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # --- Persistence ---
+
+    def save(self, path: str) -> None:
+        """Pickles the compiled automaton so serving can skip the build."""
+        if not self._compiled:
+            self.compile()
+        state = {
+            "version": FORMAT_VERSION,
+            "goto": self._goto,
+            "fail": self._fail,
+            "out": self._out,
+            "entries": self._entries,
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "EntityMatcher":
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported entity dictionary version in {path}")
+        matcher = cls()
+        matcher._goto = state["goto"]
+        matcher._fail = state["fail"]
+        matcher._out = state["out"]
+        matcher._entries = state["entries"]
+        # Each entry's label is the name that created it, so its key re-tokenizes identically
+        matcher._entry_by_key = {
+            tuple(tok for tok, _, _ in tokenize(label)): entry_id
+            for entry_id, (label, _, _, _) in enumerate(matcher._entries)
+        }
+        matcher._compiled = True
+        return matcher
+
+
+def load_or_build_entity_matcher(
+    records: Iterable[Dict[str, Any]],
+    cache_path: str,
+    source_path: Optional[str] = None,
+) -> EntityMatcher:
+    """
+    Loads the pickled dictionary at cache_path if it is newer than the source
+    data file; otherwise builds it from records and writes the cache.
+    """
+    try:
+        fresh = os.path.exists(cache_path) and (
+            source_path is None
+            or os.path.getmtime(cache_path) >= os.path.getmtime(source_path)
+        )
+        if fresh:
+            return EntityMatcher.load(cache_path)
+    except (OSError, ValueError, pickle.UnpicklingError) as e:
+        print(f"Rebuilding entity dictionary ({e})")
+
+    matcher = EntityMatcher.from_records(records)
+    try:
+        matcher.save(cache_path)
+    except OSError as e:
+        print(f"Could not write entity dictionary cache: {e}")
+    return matcher
@@ -0,0 +1,160 @@
+import re
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+from entity_matcher import tokenize
+from request_metrics import Counter
+
+try:
+    import cairosvg
+except ImportError:  # thumbnails are optional
+    cairosvg = None
+
+# --- Flatmap highlighting ---
+# The whole-rat flatmap SVG is read once from a local file. Element ids are
+# Adobe Illustrator-encoded ("small_x5F_intestine", "uterus_x2D_vagina"), so
+# they are decoded into names and indexed by their normalized tokens. A
+# highlighted variant is the original document with one <style> block
+# inserted after the root tag, which overrides fill/stroke of the matched
+# elements and their children without re-serializing the 900KB of paths.
+# Variants (gzip-compressed SVG and an optional PNG thumbnail) are kept in an
+# LRU cache keyed by the frozen set of highlighted ids.
+
+HIGHLIGHT_FILL = "#ff6b6b"
+HIGHLIGHT_STROKE = "#c0392b"
+THUMBNAIL_WIDTH = 600
+LABEL_COLUMNS = ("A", "B", "C", "Target_Organ")
+
+# Illustrator helper layers and gradients that do not name anatomy
+_SKIP_ID_RE = re.compile(r"^(?:_x2E_|Triangle_|path_x5F_|Layer_|SVGID_)")
+_HEX_ESCAPE_RE = re.compile(r"_x([0-9A-Fa-f]{2})_")
+# Illustrator de-duplication suffixes: "_1_", "_00000072248629933262375940000008340445965545761448_"
+_DUP_SUFFIX_RE = re.compile(r"(?:_\d+_|__\d{20,}_)$")
+_ID_ATTR_RE = re.compile(r'\sid="([^"]+)"')
+_SVG_OPEN_RE = re.compile(r"<svg\b[^>]*>")
+_STOPWORDS = frozenset({"of", "the", "and", "to", "in"})
+
+FLATMAP_CACHE = Counter(
+    "qsparc_flatmap_cache_total",
+    "Flatmap variant lookups by cache result.",
+    ["result"],
+)
+
+
+def decode_svg_id(raw_id: str) -> str:
+    """'small_x5F_intestine' -> 'small intestine', 'uterus_x2D_vagina' -> 'uterus-vagina'."""
+    name = _DUP_SUFFIX_RE.sub("", raw_id)
+    name = _HEX_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), name)
+    return name.replace("_", " ").strip()
+
+
+def _token_set(name: str) -> FrozenSet[str]:
+    return frozenset(tok for tok, _, _ in tokenize(name) if tok not in _STOPWORDS)
+
+
+def structures_from_table(table_data: Optional[Dict[str, Any]]) -> List[str]:
+    """Structure names in the A/B/C/Target_Organ columns of a response table."""
+    if not table_data or not table_data.get("rows"):
+        return []
+    head = table_data["head"]
+    columns = [head.index(c) for c in LABEL_COLUMNS if c in head]
+    names = OrderedDict()
+    for row in table_data["rows"]:
+        for i in columns:
+            if i < len(row) and row[i] and row[i] != "N/A":
+                names[row[i]] = None
+    return list(names)
+
+
+class FlatmapVariant(NamedTuple):
+    key: str                    # short digest used in URLs
+    ids: FrozenSet[str]
+    svg_gzip: bytes
+    png: Optional[bytes]
+
+
+class FlatmapService:
+    """Highlighted flatmap variants of one SVG, cached in memory."""
+
+    def __init__(self, svg_path: str, cache_size: int = 64, key_cache_size: int = 4096):
+        with open(svg_path, encoding="utf-8") as f:
+            self.svg = f.read()
+        root = _SVG_OPEN_RE.search(self.svg)
+        if root is None:
+            raise ValueError(f"{svg_path} has no <svg> root element")
+        self._insert_at = root.end()
+        # element id -> normalized tokens of its decoded name
+        self.elements: Dict[str, FrozenSet[str]] = {}
+        for raw_id in _ID_ATTR_RE.findall(self.svg):
+            if _SKIP_ID_RE.match(raw_id):
+                continue
+            tokens = _token_set(decode_svg_id(raw_id))
+            if tokens:
+                self.elements[raw_id] = tokens
+        self.cache_size = cache_size
+        self.key_cache_size = key_cache_size
+        self._variants: "OrderedDict[FrozenSet[str], FlatmapVariant]" = OrderedDict()
+        # URL key -> id set; tiny, so many more are kept than rendered variants
+        # and recently used URLs still resolve after their variant was evicted
+        self._ids_by_key: "OrderedDict[str, FrozenSet[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def match_ids(self, structures: Iterable[str]) -> FrozenSet[str]:
+        """
+        Ids of the elements whose name is contained in a structure name, e.g.
+        "bladder_dome" for "Dome of the Bladder" and "colon" for "sigmoid colon".
+        """
+        wanted = [_token_set(s) for s in structures]
+        return frozenset(
+            raw_id for raw_id, tokens in self.elements.items()
+            if any(tokens <= structure for structure in wanted if structure)
+        )
+
+    def render(self, ids: FrozenSet[str]) -> str:
+        """SVG text with the given element ids highlighted."""
+        if not ids:
+            return self.svg
+        selectors = ", ".join(f"#{i}, #{i} *" for i in sorted(ids))
+        style = (
+            f"\n<style>{selectors} "
+            f"{{ fill: {HIGHLIGHT_FILL} !important; stroke: {HIGHLIGHT_STROKE} !important; }}</style>"
+        )
+        return self.svg[: self._insert_at] + style + self.svg[self._insert_at:]
+
+    def variant(self, ids: FrozenSet[str]) -> FlatmapVariant:
+        with self._lock:
+            cached = self._variants.get(ids)
+            if cached is not None:
+                self._variants.move_to_end(ids)
+                FLATMAP_CACHE.inc("hit")
+                return cached
+        FLATMAP_CACHE.inc("miss")
+        svg = self.render(ids)
+        png = None
+        if cairosvg is not None:
+            png = cairosvg.svg2png(bytestring=svg.encode("utf-8"), output_width=THUMBNAIL_WIDTH)
+        key = hashlib.sha1("\n".join(sorted(ids)).encode()).hexdigest()[:16]
+        variant = FlatmapVariant(key, ids, gzip.compress(svg.encode("utf-8"), 6), png)
+        with self._lock:
+            self._variants[ids] = variant
+            self._ids_by_key[key] = ids
+            self._ids_by_key.move_to_end(key)
+            while len(self._variants) > self.cache_size:
+                self._variants.popitem(last=False)
+            while len(self._ids_by_key) > self.key_cache_size:
+                self._ids_by_key.popitem(last=False)
+        return variant
+
+    def highlight(self, structures: Iterable[str]) -> FlatmapVariant:
+        return self.variant(self.match_ids(structures))
+
+    def get(self, key: str) -> Optional[FlatmapVariant]:
+        """Variant by URL key (re-rendered if it was evicted); None for unknown or long-unused keys."""
+        with self._lock:
+            ids = self._ids_by_key.get(key)
+            if ids is not None:
+                self._ids_by_key.move_to_end(key)
+        return None if ids is None else self.variant(ids)
@@ -0,0 +1,429 @@
+import os
+import json
+import math
+import shutil
+import hashlib
+import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from embedding_provider import EMBEDDING_BACKEND, get_embeddings
+from entity_matcher import EntityMatcher, tokenize
+from answer_store import enumerate_answers, write_answer_store
+from sckan_index import EMBEDDING_MODEL, RECORD_FIELDS, load_and_process_documents, page_content_for
+
+# --- Versioned, memory-mapped index bundles ---
+# The offline builder (lc_vector_offiline.py) turns one SCKAN export into a
+# self-describing directory, so serving processes never embed documents:
+#
+#   <out>/<name>-<build time>-<source hash>/
+#       manifest.json       format, source path and sha256, model, counts, build time
+#       vectors.npy         float32 [n, dim], L2-normalized, memory-mapped
+#       vectors_int8.npy / vectors_int8_scale.npy   int8 [n, dim] + float32 [dim]
+#       vectors_binary.npy  uint8 [n, dim / 8], sign bits packed
+#       metadata_codes.npy  int32 [n, fields], index into metadata_values.json
+#       metadata_values.json  distinct values per RECORD_FIELDS column
+#       lexical.json        term -> [start, end) into the postings arrays
+#       lexical_postings.npy / lexical_tf.npy / lexical_doclen.npy
+#       entities.pkl        EntityMatcher
+#       answers.qsas        precomputed template answers (see answer_store.py)
+#   <out>/LATEST            name of the newest bundle directory
+#
+# Workers memory-map the arrays, so the page cache holds one copy per machine.
+# With a quantization selected, searches scan only the int8 or binary copy
+# (4x / 32x smaller) and rescore the best RESCORE_FACTOR * k candidates with
+# the float32 rows, so only those pages of vectors.npy are ever touched.
+
+BUNDLE_FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+LATEST = "LATEST"
+# Columns indexed for keyword search (labels, not IRIs)
+LEXICAL_FIELDS = ("A", "A_L1", "A_L2", "A_L3", "B", "C", "C_Type", "Target_Organ")
+BM25_K1 = 1.2
+BM25_B = 0.75
+QUANTIZATIONS = ("int8", "binary")
+# Candidates kept from the quantized scan, per requested result
+RESCORE_FACTOR = 8
+# Rows per block of the int8 scan, bounding the float32 temporaries
+SCAN_BLOCK_ROWS = 65536
+# Queries scored together by search_many (a [QUERY_BLOCK, n] float32 score matrix)
+QUERY_BLOCK = 64
+# Set bits per byte value, for Hamming distances over packed sign bits
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def resolve_bundle(path: str) -> Optional[str]:
+    """Bundle directory for `path` (a bundle, or a build directory with LATEST), else None."""
+    if os.path.isfile(os.path.join(path, MANIFEST)):
+        return path
+    latest = os.path.join(path, LATEST)
+    if os.path.isfile(latest):
+        with open(latest) as f:
+            return resolve_bundle(os.path.join(path, f.read().strip()))
+    return None
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-dimension int8 codes and the float32 scale of each dimension."""
+    scales = np.abs(vectors).max(axis=0) / 127.0 if len(vectors) else np.ones(vectors.shape[1])
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """One sign bit per dimension, packed eight to a byte."""
+    return np.packbits(vectors > 0, axis=1)
+
+
+class VectorIndex:
+    """
+    Nearest-neighbour search over L2-normalized vectors: an exact scan of the
+    float32 rows, or a quantized first stage (int8 dot product or Hamming
+    distance) whose top candidates are rescored with the float32 rows.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        quantization: Optional[str] = None,
+        int8_codes: Optional[np.ndarray] = None,
+        int8_scales: Optional[np.ndarray] = None,
+        binary_codes: Optional[np.ndarray] = None,
+        rescore_factor: int = RESCORE_FACTOR,
+    ):
+        if quantization not in (None,) + QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}; expected one of {QUANTIZATIONS}")
+        self.vectors = vectors
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        if quantization == "int8" and int8_codes is None:
+            int8_codes, int8_scales = quantize_int8(np.asarray(vectors))
+        if quantization == "binary" and binary_codes is None:
+            binary_codes = quantize_binary(np.asarray(vectors))
+        self.int8_codes, self.int8_scales = int8_codes, int8_scales
+        self.binary_codes = binary_codes
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def scan_bytes(self) -> int:
+        """Bytes read by every query's first stage (resident when serving)."""
+        if self.quantization == "int8":
+            return self.int8_codes.nbytes + self.int8_scales.nbytes
+        if self.quantization == "binary":
+            return self.binary_codes.nbytes
+        return self.vectors.nbytes
+
+    def _first_stage(self, query: np.ndarray) -> np.ndarray:
+        """Approximate similarity of every row (higher is closer)."""
+        if self.quantization == "binary":
+            packed = quantize_binary(query[None, :])[0]
+            return -_POPCOUNT[np.bitwise_xor(self.binary_codes, packed)].sum(axis=1, dtype=np.int32)
+        # Asymmetric int8: codes * scales approximates each row, the query stays float
+        weighted = query * self.int8_scales
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_ROWS):
+            block = self.int8_codes[start:start + SCAN_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ weighted
+        return scores
+
+    def search_many(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """`search` for several queries; exact search scores a block of queries per pass over the rows."""
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.quantization is not None:
+            return [self.search(query, k) for query in queries]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        results = []
+        for start in range(0, len(queries), QUERY_BLOCK):
+            scores = queries[start:start + QUERY_BLOCK] @ self.vectors.T
+            for row in scores:
+                top = _top_k(row, k)
+                results.append((top, row[top]))
+        return results
+
+    def search(self, query: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Row ids of the k nearest rows (best first) and their exact cosine
+        similarities. `mask` optionally restricts the search to rows where it is True.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if self.quantization is None:
+            scores = self.vectors @ query
+            if mask is not None:
+                scores = np.where(mask, scores, -np.inf)
+            top = _top_k(scores, k)
+            if mask is not None:
+                top = top[np.isfinite(scores[top])]
+            return top, scores[top]
+        approx = self._first_stage(query).astype(np.float32)
+        if mask is not None:
+            approx = np.where(mask, approx, -np.inf)
+        candidates = _top_k(approx, k * self.rescore_factor)
+        if mask is not None:
+            candidates = candidates[np.isfinite(approx[candidates])]
+        # Sorted ids keep the reads of the float32 rows sequential
+        candidates = np.sort(candidates)
+        exact = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+        order = _top_k(exact, k)
+        return candidates[order], exact[order]
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+# --- 1. Building ---
+
+def _write_lexical_index(records: List[Dict[str, str]], bundle_dir: str) -> int:
+    postings: Dict[str, Dict[int, int]] = {}
+    doc_lengths = np.zeros(len(records), dtype=np.int32)
+    for doc_id, record in enumerate(records):
+        for field in LEXICAL_FIELDS:
+            value = record.get(field, "N/A")
+            if value == "N/A":
+                continue
+            for tok, _, _ in tokenize(value):
+                postings.setdefault(tok, {})
+                postings[tok][doc_id] = postings[tok].get(doc_id, 0) + 1
+                doc_lengths[doc_id] += 1
+
+    terms, ids, tfs, start = {}, [], [], 0
+    for term in sorted(postings):
+        docs = sorted(postings[term].items())
+        terms[term] = [start, start + len(docs)]
+        ids.extend(doc_id for doc_id, _ in docs)
+        tfs.extend(tf for _, tf in docs)
+        start += len(docs)
+    np.save(os.path.join(bundle_dir, "lexical_postings.npy"), np.asarray(ids, dtype=np.int32))
+    np.save(os.path.join(bundle_dir, "lexical_tf.npy"), np.asarray(tfs, dtype=np.int32))
+    np.save(os.path.join(bundle_dir, "lexical_doclen.npy"), doc_lengths)
+    with open(os.path.join(bundle_dir, "lexical.json"), "w") as f:
+        json.dump({"terms": terms}, f, separators=(",", ":"))
+    return len(terms)
+
+
+def _write_metadata(records: List[Dict[str, str]], bundle_dir: str) -> None:
+    values: Dict[str, List[str]] = {field: [] for field in RECORD_FIELDS}
+    lookup: Dict[str, Dict[str, int]] = {field: {} for field in RECORD_FIELDS}
+    codes = np.zeros((len(records), len(RECORD_FIELDS)), dtype=np.int32)
+    for row, record in enumerate(records):
+        for col, field in enumerate(RECORD_FIELDS):
+            value = record.get(field, "N/A")
+            code = lookup[field].get(value)
+            if code is None:
+                code = lookup[field][value] = len(values[field])
+                values[field].append(value)
+            codes[row, col] = code
+    np.save(os.path.join(bundle_dir, "metadata_codes.npy"), codes)
+    with open(os.path.join(bundle_dir, "metadata_values.json"), "w") as f:
+        json.dump({"fields": RECORD_FIELDS, "values": values}, f, separators=(",", ":"))
+
+
+def build_bundle(
+    source_path: str,
+    out_dir: str,
+    name: Optional[str] = None,
+    model_name: str = EMBEDDING_MODEL,
+    batch_size: int = 256,
+    with_answers: bool = True,
+    embedding_backend: str = EMBEDDING_BACKEND,
+) -> str:
+    """
+    Builds a bundle from a SCKAN JSON export into a new versioned directory
+    under out_dir, then points out_dir/LATEST at it. Returns the bundle path.
+    """
+    started = datetime.datetime.now(datetime.timezone.utc)
+    source_sha = file_sha256(source_path)
+    name = name or os.path.splitext(os.path.basename(source_path))[0]
+    version = f"{name}-{started:%Y%m%dT%H%M%SZ}-{source_sha[:8]}"
+    bundle_dir = os.path.join(out_dir, version)
+    tmp_dir = bundle_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    docs = load_and_process_documents(source_path)
+    records = [doc.metadata for doc in docs]
+
+    print(f"Embedding {len(docs)} documents with {model_name} ({embedding_backend})...")
+    embeddings = get_embeddings(model_name, embedding_backend)
+    texts = [doc.page_content for doc in docs]
+    chunks = [
+        np.asarray(embeddings.embed_documents(texts[i:i + batch_size]), dtype=np.float32)
+        for i in range(0, len(texts), batch_size)
+    ]
+    vectors = _normalize(np.concatenate(chunks)) if chunks else np.zeros((0, 0), dtype=np.float32)
+    vectors = vectors.astype(np.float32)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+    if len(vectors):
+        int8_codes, int8_scales = quantize_int8(vectors)
+        np.save(os.path.join(tmp_dir, "vectors_int8.npy"), int8_codes)
+        np.save(os.path.join(tmp_dir, "vectors_int8_scale.npy"), int8_scales)
+        np.save(os.path.join(tmp_dir, "vectors_binary.npy"), quantize_binary(vectors))
+
+    _write_metadata(records, tmp_dir)
+    term_count = _write_lexical_index(records, tmp_dir)
+    matcher = EntityMatcher.from_records(records)
+    matcher.save(os.path.join(tmp_dir, "entities.pkl"))
+    answer_count = 0
+    if with_answers:
+        answers = enumerate_answers(records)
+        write_answer_store(answers, os.path.join(tmp_dir, "answers.qsas"))
+        answer_count = len(answers)
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "name": name,
+        "version": version,
+        "source_path": os.path.abspath(source_path),
+        "source_sha256": source_sha,
+        "embedding_model": model_name,
+        "embedding_backend": embedding_backend,
+        "dim": int(vectors.shape[1]) if vectors.size else 0,
+        "normalized": True,
+        "quantizations": list(QUANTIZATIONS) if len(vectors) else [],
+        "counts": {
+            "documents": len(docs),
+            "distinct": {field: len({r[field] for r in records}) for field in ("A", "B", "C", "Target_Organ")},
+            "lexical_terms": term_count,
+            "entity_names": len(matcher),
+            "precomputed_answers": answer_count,
+        },
+        "built_at": started.isoformat(),
+        "build_seconds": round((datetime.datetime.now(datetime.timezone.utc) - started).total_seconds(), 3),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    os.replace(tmp_dir, bundle_dir)
+    latest_tmp = os.path.join(out_dir, LATEST + ".tmp")
+    with open(latest_tmp, "w") as f:
+        f.write(version)
+    os.replace(latest_tmp, os.path.join(out_dir, LATEST))
+    return bundle_dir
+
+
+# --- 2. Serving ---
+
+class BundleVectorStore:
+    """
+    Read-only retriever over a bundle: cosine search in NumPy over the
+    memory-mapped vectors (exact, or quantized with float32 rescoring), plus
+    BM25 keyword search over the label columns. Scores follow Chroma's
+    default (squared L2 distance), so relevance thresholds are unchanged when
+    a server switches to bundles.
+    """
+
+    def __init__(
+        self,
+        bundle_dir: str,
+        embeddings: Any = None,
+        quantization: Optional[str] = None,
+        rescore_factor: int = RESCORE_FACTOR,
+    ):
+        self.bundle_dir = bundle_dir
+        with open(os.path.join(bundle_dir, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["format_version"] != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"{bundle_dir}: unsupported bundle format {self.manifest['format_version']}")
+        self.vectors = np.load(os.path.join(bundle_dir, "vectors.npy"), mmap_mode="r")
+        if quantization is not None and quantization not in self.manifest.get("quantizations", []):
+            raise ValueError(f"{bundle_dir} has no {quantization} vectors; rebuild it with lc_vector_offiline.py")
+        quantized = {}
+        if quantization == "int8":
+            quantized["int8_codes"] = np.load(os.path.join(bundle_dir, "vectors_int8.npy"), mmap_mode="r")
+            quantized["int8_scales"] = np.load(os.path.join(bundle_dir, "vectors_int8_scale.npy"))
+        elif quantization == "binary":
+            quantized["binary_codes"] = np.load(os.path.join(bundle_dir, "vectors_binary.npy"), mmap_mode="r")
+        self.index = VectorIndex(self.vectors, quantization, rescore_factor=rescore_factor, **quantized)
+        self.codes = np.load(os.path.join(bundle_dir, "metadata_codes.npy"), mmap_mode="r")
+        with open(os.path.join(bundle_dir, "metadata_values.json")) as f:
+            meta = json.load(f)
+        self.fields: List[str] = meta["fields"]
+        self.values: Dict[str, List[str]] = meta["values"]
+        with open(os.path.join(bundle_dir, "lexical.json")) as f:
+            self.terms: Dict[str, List[int]] = json.load(f)["terms"]
+        self.postings = np.load(os.path.join(bundle_dir, "lexical_postings.npy"), mmap_mode="r")
+        self.term_freqs = np.load(os.path.join(bundle_dir, "lexical_tf.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(os.path.join(bundle_dir, "lexical_doclen.npy"), mmap_mode="r")
+        self.avg_doc_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+        # Queries may use another backend than the build (QSPARC_EMBEDDING_BACKEND): same model, same vectors
+        self.embeddings = embeddings or get_embeddings(self.manifest["embedding_model"])
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def approx_bytes(self) -> int:
+        """
+        Mapped array sizes plus the decoded value tables. With quantization
+        the float32 vectors are only read for rescoring, so the scanned copy
+        is counted instead.
+        """
+        arrays = (self.codes, self.postings, self.term_freqs, self.doc_lengths)
+        values = sum(len(v) for column in self.values.values() for v in column)
+        return self.index.scan_bytes + sum(a.nbytes for a in arrays) + 2 * values
+
+    def record(self, i: int) -> Dict[str, str]:
+        row = self.codes[i]
+        return {field: self.values[field][int(row[col])] for col, field in enumerate(self.fields)}
+
+    def document(self, i: int) -> Document:
+        record = self.record(i)
+        return Document(page_content=page_content_for(record), metadata=record)
+
+    def records(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        ids, cosine = self.index.search(np.asarray(embedding, dtype=np.float32), k)
+        return [(self.document(int(i)), float(2.0 - 2.0 * c)) for i, c in zip(ids, cosine)]
+
+    def similarity_search_by_vectors_with_relevance_scores(
+        self, embeddings: List[List[float]], k: int = 4
+    ) -> List[List[Tuple[Document, float]]]:
+        """Batch form of the above, used for batch requests."""
+        return [
+            [(self.document(int(i)), float(2.0 - 2.0 * c)) for i, c in zip(ids, cosine)]
+            for ids, cosine in self.index.search_many(np.asarray(embeddings, dtype=np.float32), k)
+        ]
+
+    def keyword_search(self, text: str, k: int = 4) -> List[Tuple[Document, float]]:
+        """BM25 over the label columns; returns (document, score) pairs."""
+        scores = np.zeros(len(self), dtype=np.float32)
+        n = len(self)
+        for tok in {tok for tok, _, _ in tokenize(text)}:
+            span = self.terms.get(tok)
+            if span is None:
+                continue
+            ids = self.postings[span[0]:span[1]]
+            tf = self.term_freqs[span[0]:span[1]].astype(np.float32)
+            idf = math.log(1.0 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_lengths[ids] / max(self.avg_doc_length, 1e-9))
+            scores[ids] += idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+        top = [i for i in _top_k(scores, k) if scores[i] > 0]
+        return [(self.document(int(i)), float(scores[i])) for i in top]
@@ -0,0 +1,385 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import itertools
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from answer_store import AnswerStore
+from early_answer import relevance_from_distance
+from entity_matcher import EntityMatcher, load_or_build_entity_matcher
+from index_bundle import BundleVectorStore, resolve_bundle
+from request_metrics import Counter, Gauge, current_trace, trace_stage
+from sckan_index import load_and_process_documents, create_vector_store
+
+# --- Registry of per-dataset indexes ---
+# Each configured SCKAN export (a species or a release) gets its own index:
+# documents, vector store, entity dictionary and optional precomputed answers.
+# Indexes are loaded on first use and handed out as leases. `reload` builds a
+# replacement next to the live index and swaps it in atomically; requests that
+# already hold the old generation keep using it, and it is closed once the
+# last lease is returned. When the estimated footprint of loaded indexes
+# exceeds the memory cap, idle ones are evicted least recently used first.
+# A dataset path may name a SCKAN JSON export (embedded at load time) or a
+# prebuilt index bundle directory (memory-mapped, see index_bundle.py).
+
+logger = logging.getLogger("qsparc.indexes")
+
+INDEX_LOADS = Counter(
+    "qsparc_index_loads_total", "Dataset indexes loaded (first use, reload or after eviction).", ["dataset"])
+INDEX_EVICTIONS = Counter(
+    "qsparc_index_evictions_total", "Idle dataset indexes evicted under the memory cap.", ["dataset"])
+INDEX_BYTES = Gauge(
+    "qsparc_index_estimated_bytes", "Estimated memory held by a loaded dataset index.", ["dataset"])
+INDEX_LEASES = Gauge(
+    "qsparc_index_active_leases", "Requests currently using a dataset index.", ["dataset"])
+
+
+class UnknownDataset(KeyError):
+    """Raised when a request selects a dataset that is not configured."""
+
+
+class DatasetIndex:
+    """Everything retrieval needs for one SCKAN export, at one generation."""
+
+    def __init__(
+        self,
+        name: str,
+        source_path: str,
+        vector_store: Any,
+        entity_matcher: EntityMatcher,
+        answer_store: Optional[AnswerStore] = None,
+        document_count: int = 0,
+        approx_bytes: int = 0,
+        version: Optional[str] = None,
+    ):
+        self.name = name
+        self.source_path = source_path
+        self.vector_store = vector_store
+        self.entity_matcher = entity_matcher
+        self.answer_store = answer_store
+        self.document_count = document_count
+        self.approx_bytes = approx_bytes
+        self.version = version
+        self.generation = 0
+        self.loaded_at = time.time()
+
+    def retrieve(self, question: str, k: int) -> List[Document]:
+        """
+        Embeds the question and searches the vector store, timing both steps
+        separately so slow embedding and slow vector queries can be told apart.
+        """
+        with trace_stage("embedding"):
+            query_vector = self.vector_store.embeddings.embed_query(question)
+        with trace_stage("vector_search"):
+            results = self.vector_store.similarity_search_by_vector_with_relevance_scores(query_vector, k=k)
+        docs = _with_relevance(results)
+        trace = current_trace()
+        if trace is not None:
+            trace.set(dataset=self.name, index_generation=self.generation, retrieved_docs=len(docs))
+        return docs
+
+    def retrieve_many(self, questions: List[str], k: int) -> List[List[Document]]:
+        """
+        Batch form of `retrieve`: all questions are embedded in one call, and
+        searched in one matrix product when the store supports it (bundles).
+        """
+        with trace_stage("embedding"):
+            query_vectors = self.vector_store.embeddings.embed_documents(questions)
+        with trace_stage("vector_search"):
+            search_many = getattr(self.vector_store, "similarity_search_by_vectors_with_relevance_scores", None)
+            if search_many is not None:
+                results = search_many(query_vectors, k=k)
+            else:
+                results = [
+                    self.vector_store.similarity_search_by_vector_with_relevance_scores(vector, k=k)
+                    for vector in query_vectors
+                ]
+        trace = current_trace()
+        if trace is not None:
+            trace.set(dataset=self.name, index_generation=self.generation)
+        return [_with_relevance(result) for result in results]
+
+    def close(self) -> None:
+        # In-memory Chroma collections live in a process-wide client until deleted
+        delete = getattr(self.vector_store, "delete_collection", None)
+        if delete is not None:
+            delete()
+        if self.answer_store is not None:
+            self.answer_store.close()
+
+
+def _with_relevance(results: List[Tuple[Document, float]]) -> List[Document]:
+    docs = []
+    for doc, distance in results:
+        # Kept in metadata so later stages (no-data check, trimming) can use it
+        doc.metadata["relevance_score"] = relevance_from_distance(distance)
+        docs.append(doc)
+    return docs
+
+
+_collection_ids = itertools.count()
+
+
+def _estimate_bytes(docs: List[Document], vector_store: Any) -> int:
+    """Vectors plus stored text, doubled for index and object overhead."""
+    # Dimension of a stored vector, so the reload path does no model inference
+    stored = vector_store.get(limit=1, include=["embeddings"]).get("embeddings")
+    dim = len(stored[0]) if stored is not None and len(stored) else 0
+    text = sum(
+        len(doc.page_content) + sum(len(str(v)) for v in doc.metadata.values())
+        for doc in docs
+    )
+    return 2 * (len(docs) * dim * 4 + text)
+
+
+def load_bundle_index(name: str, bundle_dir: str, quantization: Optional[str] = None) -> DatasetIndex:
+    """
+    Memory-maps a prebuilt bundle (see index_bundle.py); no embedding work.
+    `quantization` ("int8" or "binary") scans the quantized vectors and rescores
+    the best candidates with the float32 ones.
+    """
+    store = BundleVectorStore(bundle_dir, quantization=quantization)
+    matcher = EntityMatcher.load(os.path.join(bundle_dir, "entities.pkl"))
+    answers_path = os.path.join(bundle_dir, "answers.qsas")
+    answer_store = AnswerStore(answers_path, matcher) if os.path.exists(answers_path) else None
+    return DatasetIndex(
+        name, bundle_dir, store, matcher, answer_store,
+        document_count=len(store),
+        approx_bytes=store.approx_bytes,
+        version=store.manifest["version"],
+    )
+
+
+def load_dataset_index(name: str, source_path: str, quantization: Optional[str] = None) -> DatasetIndex:
+    """
+    Loads a dataset from an index bundle (or a build directory whose LATEST
+    names one), or else builds it from a SCKAN JSON export and its sidecar
+    files. Quantization only applies to bundles.
+    """
+    bundle_dir = resolve_bundle(source_path) if os.path.isdir(source_path) else None
+    if bundle_dir is not None:
+        return load_bundle_index(name, bundle_dir, quantization)
+    if quantization is not None:
+        logger.warning("Dataset %s is not a bundle; ignoring %s quantization", name, quantization)
+    docs = load_and_process_documents(source_path)
+    # A unique collection per generation, so a reload never writes into the live one
+    vector_store = create_vector_store(docs, collection_name=f"sckan-{name}-{next(_collection_ids)}")
+    matcher = load_or_build_entity_matcher(
+        (doc.metadata for doc in docs),
+        cache_path=source_path + '.entities.pkl',
+        source_path=source_path,
+    )
+    answers_path = source_path + '.answers.qsas'
+    answer_store = AnswerStore(answers_path, matcher) if os.path.exists(answers_path) else None
+    return DatasetIndex(
+        name, source_path, vector_store, matcher, answer_store,
+        document_count=len(docs),
+        approx_bytes=_estimate_bytes(docs, vector_store),
+    )
+
+
+def load_dataset_config(default_path: str) -> Dict[str, str]:
+    """
+    Dataset name -> SCKAN export path, from QSPARC_DATASETS (JSON), e.g.
+    {"rat": "/data/rat/a-b-via-c.json", "mouse": "/data/mouse/a-b-via-c.json"}.
+    Without it the single `default_path` is served as "default".
+    """
+    raw = os.environ.get("QSPARC_DATASETS")
+    return json.loads(raw) if raw else {"default": default_path}
+
+
+class _Slot:
+    """Live generation of one dataset plus lease bookkeeping."""
+
+    def __init__(self):
+        self.index: Optional[DatasetIndex] = None
+        self.load_lock = threading.Lock()
+        self.last_used = 0.0
+        self.generations = 0
+
+
+class IndexRegistry:
+    def __init__(
+        self,
+        datasets: Dict[str, str],
+        default: Optional[str] = None,
+        memory_cap_bytes: Optional[int] = None,
+        loader: Callable[[str, str], DatasetIndex] = load_dataset_index,
+    ):
+        if not datasets:
+            raise ValueError("At least one dataset must be configured")
+        self.datasets = dict(datasets)
+        self.default = default or next(iter(self.datasets))
+        if self.default not in self.datasets:
+            raise UnknownDataset(self.default)
+        self.memory_cap_bytes = memory_cap_bytes
+        self.loader = loader
+        self._slots = {name: _Slot() for name in self.datasets}
+        # id(index) -> active lease count, for live and retired generations alike
+        self._leases: Dict[int, int] = {}
+        self._retired: Dict[int, DatasetIndex] = {}
+        self._lock = threading.Lock()
+
+    # --- Leases ---
+
+    def resolve(self, name: Optional[str]) -> str:
+        name = name or self.default
+        if name not in self.datasets:
+            raise UnknownDataset(name)
+        return name
+
+    def _try_acquire(self, name: str) -> Optional[DatasetIndex]:
+        slot = self._slots[name]
+        with self._lock:
+            index = slot.index
+            if index is None:
+                return None
+            self._leases[id(index)] = self._leases.get(id(index), 0) + 1
+            slot.last_used = time.monotonic()
+        INDEX_LEASES.inc(name)
+        return index
+
+    def acquire(self, name: Optional[str] = None) -> DatasetIndex:
+        """Leases the live index of a dataset, loading it first if needed (blocking)."""
+        name = self.resolve(name)
+        index = self._try_acquire(name)
+        while index is None:
+            self._ensure_loaded(name)
+            index = self._try_acquire(name)
+        return index
+
+    def release(self, index: DatasetIndex) -> None:
+        with self._lock:
+            remaining = self._leases.get(id(index), 1) - 1
+            if remaining:
+                self._leases[id(index)] = remaining
+                drained = None
+            else:
+                self._leases.pop(id(index), None)
+                drained = self._retired.pop(id(index), None)
+        INDEX_LEASES.dec(index.name)
+        if drained is not None:
+            logger.info("Closing drained index %s generation %d", drained.name, drained.generation)
+            drained.close()
+
+    @contextmanager
+    def lease(self, name: Optional[str] = None) -> Iterator[DatasetIndex]:
+        index = self.acquire(name)
+        try:
+            yield index
+        finally:
+            self.release(index)
+
+    @asynccontextmanager
+    async def alease(self, name: Optional[str] = None):
+        """Async lease; a cold dataset is loaded in a worker thread."""
+        name = self.resolve(name)
+        index = self._try_acquire(name)
+        if index is None:
+            index = await asyncio.to_thread(self.acquire, name)
+        try:
+            yield index
+        finally:
+            self.release(index)
+
+    # --- Loading, swapping, eviction ---
+
+    def _ensure_loaded(self, name: str) -> None:
+        slot = self._slots[name]
+        with slot.load_lock:
+            if slot.index is None:
+                self._install(name, self._load(name))
+
+    def _load(self, name: str, source_path: Optional[str] = None) -> DatasetIndex:
+        started = time.perf_counter()
+        index = self.loader(name, source_path or self.datasets[name])
+        INDEX_LOADS.inc(name)
+        logger.info(
+            "Loaded index %s from %s in %.1fs (~%d MB)",
+            name, index.source_path, time.perf_counter() - started, index.approx_bytes // 2**20,
+        )
+        return index
+
+    def _install(self, name: str, index: DatasetIndex) -> None:
+        slot = self._slots[name]
+        with self._lock:
+            slot.generations += 1
+            index.generation = slot.generations
+            old, slot.index = slot.index, index
+            slot.last_used = time.monotonic()
+            close_now = old is not None and id(old) not in self._leases
+            if old is not None and not close_now:
+                # Still serving in-flight requests; closed by the last release
+                self._retired[id(old)] = old
+        INDEX_BYTES.set(index.approx_bytes, name)
+        if close_now:
+            old.close()
+        self._evict_over_cap(keep=name)
+
+    def preload(self, name: Optional[str] = None) -> None:
+        """Loads a dataset ahead of its first request (e.g. the default at startup)."""
+        self._ensure_loaded(self.resolve(name))
+
+    def reload(self, name: str, source_path: Optional[str] = None) -> DatasetIndex:
+        """
+        Rebuilds a dataset (optionally from a new export) and swaps it in.
+        Serving continues on the old generation until the swap; if the build
+        fails, the old generation and its configured path stay in place.
+        """
+        name = self.resolve(name)
+        slot = self._slots[name]
+        with slot.load_lock:
+            try:
+                index = self._load(name, source_path)
+                self._install(name, index)
+            except Exception:
+                logger.exception("Reload of index %s from %s failed", name, source_path or self.datasets[name])
+                raise
+            if source_path is not None:
+                self.datasets[name] = source_path
+        return index
+
+    def _evict_over_cap(self, keep: str) -> None:
+        if self.memory_cap_bytes is None:
+            return
+        evicted = []
+        with self._lock:
+            loaded = [(name, slot) for name, slot in self._slots.items() if slot.index is not None]
+            total = sum(slot.index.approx_bytes for _, slot in loaded)
+            for name, slot in sorted(loaded, key=lambda item: item[1].last_used):
+                if total <= self.memory_cap_bytes:
+                    break
+                if name == keep or id(slot.index) in self._leases:
+                    continue
+                total -= slot.index.approx_bytes
+                evicted.append(slot.index)
+                slot.index = None
+        for index in evicted:
+            logger.info("Evicting idle index %s (~%d MB) under the memory cap", index.name, index.approx_bytes // 2**20)
+            INDEX_EVICTIONS.inc(index.name)
+            INDEX_BYTES.set(0, index.name)
+            index.close()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    "dataset": name,
+                    "source_path": self.datasets[name],
+                    "default": name == self.default,
+                    "loaded": slot.index is not None,
+                    "generation": slot.index.generation if slot.index is not None else None,
+                    "version": slot.index.version if slot.index is not None else None,
+                    "documents": slot.index.document_count if slot.index is not None else None,
+                    "approx_bytes": slot.index.approx_bytes if slot.index is not None else 0,
+                    "active_leases": self._leases.get(id(slot.index), 0) if slot.index is not None else 0,
+                    "retired_generations_draining": sum(1 for r in self._retired.values() if r.name == name),
+                }
+                for name, slot in self._slots.items()
+            ]
@@ -1,96 +1,66 @@
+#!/usr/bin/env python
+"""
+Offline index builder: turns a SCKAN JSON export into a versioned index bundle
+(normalized float32 vectors, encoded metadata, BM25 postings, entity
+dictionary and precomputed answers) that serving workers memory-map instead
+of embedding the documents at startup. See index_bundle.py for the layout.
+
+    python lc_vector_offiline.py --data /path/to/a-b-via-c.json --out /data/indexes/rat
+
+Point a dataset at the output directory (QSPARC_DATA_FILE or QSPARC_DATASETS);
+the server follows its LATEST file to the newest bundle.
+"""
+import os
+import sys
 import json
-from langchain_community.document_loaders import JSONLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings # You can replace with OpenAIEmbeddings or another model
-from langchain.schema import Document
-from langchain_chroma import Chroma
-
-# --- 1. Load and parse the original JSON data ---
-
-# Define file path and JQ schema
-file_path = '/hpc/fxu244/Documents/Code/LLMs/a-b-via-c.json'
-jq_schema = '.results.bindings[]'
-
-# text_content=False is critical; it preserves each element's JSON structure
-loader = JSONLoader(
-    file_path=file_path,
-    jq_schema=jq_schema,
-    text_content=False 
-)
-
-# Load documents; each document's page_content is a JSON string
-raw_docs = loader.load()
-
-# --- 2. Transform data to the target format and create LangChain Document objects ---
-def get_val(record, key):
-    """Safely extract the 'value' for the given key from the record"""
-    if key in record and isinstance(record.get(key), dict):
-        return record[key].get('value')
-    return None # Return None if key doesn't exist or format is invalid
-
-final_documents = []
-for doc in raw_docs:
-    # Parse page_content (JSON string) into a Python dictionary
-    record = json.loads(doc.page_content)
-
-    # Extract and transform data in the desired format
-    clean_data = {
-        "Neuron_ID": get_val(record, "Neuron_ID"),
-        "A": get_val(record, "A"),
-        "B": get_val(record, "B"),
-        "C": get_val(record, "C"),
-        "Target_Organ": get_val(record, "Target_Organ"),
-        # Special handling for C_Type; set to "N/A" if missing
-        "C_Type": get_val(record, "C_Type") if "C_Type" in record else "N/A",
-    }
-    
-    # For better semantic search, convert structured data to meaningful text
-    # This text will be used to generate vector embeddings
-    page_content = (
-        f"Neuron connection info: Neuron ID is {clean_data['Neuron_ID']}."
-        f" It connects from {clean_data['A']} to {clean_data['B']} via {clean_data['C']}."
-        f" The target organ is {clean_data['Target_Organ']}."
-        f" Connection type (C_Type) is {clean_data['C_Type']}."
+import time
+import argparse
+
+from embedding_provider import EMBEDDING_BACKEND, EMBEDDING_BACKENDS
+from index_bundle import BundleVectorStore, build_bundle
+from sckan_index import EMBEDDING_MODEL
+
+DEMO_QUERY = 'Is there a connection from inferior mesenteric ganglion to the urinary bladder in rats? Summarize the pathways based on the nerves involved.'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Same variable as server.py
+    parser.add_argument("--data", default=os.environ.get("QSPARC_DATA_FILE"), help="SCKAN JSON export.")
+    parser.add_argument("--out", required=True, help="Build directory; each build is a new subdirectory.")
+    parser.add_argument("--name", help="Bundle name prefix (default: data file name).")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="Embedding model.")
+    parser.add_argument("--embedding-backend", default=EMBEDDING_BACKEND, choices=EMBEDDING_BACKENDS,
+                        help="Runtime used to embed the documents (see embedding_provider.py).")
+    parser.add_argument("--batch-size", type=int, default=256, help="Documents per embedding batch.")
+    parser.add_argument("--no-answers", action="store_true", help="Skip precomputed template answers.")
+    parser.add_argument("--query", nargs="?", const=DEMO_QUERY, help="Run a search against the new bundle.")
+    args = parser.parse_args()
+    if not args.data:
+        sys.exit("--data (or QSPARC_DATA_FILE) is required")
+
+    bundle_dir = build_bundle(
+        args.data,
+        args.out,
+        name=args.name,
+        model_name=args.model,
+        batch_size=args.batch_size,
+        with_answers=not args.no_answers,
+        embedding_backend=args.embedding_backend,
     )
-
-    # Create a new LangChain Document object
-    # page_content is used for vector search
-    # metadata stores clean structured data for filtering or use
-    final_documents.append(
-        Document(page_content=page_content, metadata=clean_data)
-    )
-
-# Print the first processed document as a check
-if final_documents:
-    print("--- Sample of first processed Document ---")
-    print(f"Page Content: {final_documents[0].page_content}")
-    print(f"Metadata: {final_documents[0].metadata}")
-    print("-" * 30)
-
-
-# --- 3. Initialize embedding model and vector database, then add documents ---
-
-# Initialize an embedding model. This uses HuggingFace's open-source model, which runs locally.
-# The model will be downloaded automatically the first time.
-# You can also replace it with OpenAIEmbeddings(openai_api_key="sk-...") or other models.
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-
-# from_documents handles embedding and indexing of all documents
-print("Creating vector database, this might take a while...")
-
-vector_store = Chroma.from_documents(
-    final_documents,
-    # embedding = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2"),
-    embedding = embeddings
-)
-
-print("Vector database created successfully!")
-
-# --- 4. (Optional) Demo: How to use the vector database ---
-print("\n--- Similarity Search Demo ---")
-
-query = 'Is there a connection from inferior mesenteric ganglion to the urinary bladder in rats? Summarize the pathways based on the nerves involved.'
-results = vector_store.similarity_search(query, k=10)
-
-if results:
-    print(f"Query: '{query}'")
-    print("\nTop relevant result:",results)
+    with open(os.path.join(bundle_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    print(f"Wrote {bundle_dir} in {manifest['build_seconds']}s:")
+    print(json.dumps(manifest["counts"], indent=2))
+
+    if args.query:
+        started = time.perf_counter()
+        store = BundleVectorStore(bundle_dir)
+        print(f"\nBundle opened in {time.perf_counter() - started:.2f}s ({store.approx_bytes} bytes mapped)")
+        query_vector = store.embeddings.embed_query(args.query)
+        print(f"Query: '{args.query}'")
+        for doc, distance in store.similarity_search_by_vector_with_relevance_scores(query_vector, k=10):
+            print(f"  {distance:.3f}  {doc.page_content}")
+        print("Keyword matches:")
+        for doc, score in store.keyword_search(args.query, k=5):
+            print(f"  {score:.2f}  {doc.page_content}")
@@ -33,6 +33,9 @@ BASE_URL = "http://localhost:8000/v1"
 API_KEY = "EMPTY"
 MODEL_ID = "/hpc/fxu244/Documents/Code/LLMs/Qwen3-32B"
 
+# Data Configuration (same variable as server.py)
+DATA_FILE_PATH = os.environ.get("QSPARC_DATA_FILE", '/hpc/fxu244/Documents/Code/LLMs/a-b-via-c.json')
+
 # --- 2. Data Loading and Vector Store Creation (Executed on Server Startup) ---
 
 def get_val(record: Dict[str, Any], key: str) -> str:
@@ -46,7 +49,7 @@ def load_and_process_documents() -> List[Document]:
     Loads data from a JSON file, processes it into a structured format,
     and creates LangChain Document objects ready for embedding.
     """
-    file_path = '/hpc/fxu244/Documents/Code/LLMs/a-b-via-c.json'
+    file_path = DATA_FILE_PATH
     jq_schema = '.results.bindings[]'
     
     print("Loading raw data from JSON...")
@@ -0,0 +1,120 @@
+import os
+import re
+import json
+from typing import List, Dict, Any, NamedTuple, Sequence
+
+from langchain_core.documents import Document
+
+from entity_matcher import ENTITY_FIELDS, EntityMatch
+from request_metrics import Counter, current_trace
+
+# --- Model routing tier ---
+# Simple listing / yes-no questions over a handful of rows go to a small Qwen
+# endpoint; multi-pathway synthesis stays on the 32B model. Endpoints are
+# OpenAI-compatible (vLLM) and configured by name; QSPARC_MODEL_ROUTES maps
+# each request class onto any of them.
+
+# Request class -> endpoint name
+DEFAULT_ROUTES = {"simple": "small", "synthesis": "large"}
+
+# Above these a request is treated as synthesis regardless of wording
+SIMPLE_MAX_ROWS = 8
+SIMPLE_MAX_ENTITIES = 2
+
+# Wording that asks the model to organise many rows
+_SYNTHESIS_RE = re.compile(
+    r"\b(summari[sz]e|categori[sz]e|classif|compare|comparison|explain|why|how does|how do|"
+    r"pathways|organ systems|grouped|group by|describe)\w*",
+    re.IGNORECASE,
+)
+# Yes/no and short listing shapes
+_SIMPLE_RE = re.compile(
+    r"^\s*(is there|are there|does|do|is|are|can|list|which|what is the|name)\b|\bonly list\b",
+    re.IGNORECASE,
+)
+
+ROUTE_DECISIONS = Counter(
+    "qsparc_route_decisions_total",
+    "Model routing decisions by request class, endpoint and reason.",
+    ["route", "endpoint", "reason"],
+)
+
+
+class RouteDecision(NamedTuple):
+    route: str      # "simple" or "synthesis"
+    endpoint: str   # key into the endpoint configuration
+    reason: str
+
+
+def load_model_endpoints(defaults: Dict[str, Dict[str, str]]) -> Dict[str, Dict[str, str]]:
+    """
+    Endpoint table ({name: {"base_url", "model"[, "api_key"]}}). Entries in the
+    QSPARC_MODEL_ENDPOINTS JSON override or extend the defaults.
+    """
+    endpoints = {name: dict(cfg) for name, cfg in defaults.items()}
+    raw = os.environ.get("QSPARC_MODEL_ENDPOINTS")
+    if raw:
+        for name, cfg in json.loads(raw).items():
+            endpoints.setdefault(name, {}).update(cfg)
+    return endpoints
+
+
+def load_model_routes(endpoints: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+    """
+    Request class -> endpoint name: DEFAULT_ROUTES overridden by the
+    QSPARC_MODEL_ROUTES JSON, e.g. {"simple": "medium"}. Fails at startup if a
+    class is unknown or a route names an endpoint that is not configured.
+    """
+    routes = dict(DEFAULT_ROUTES)
+    raw = os.environ.get("QSPARC_MODEL_ROUTES")
+    if raw:
+        routes.update(json.loads(raw))
+    unknown_classes = set(routes) - set(DEFAULT_ROUTES)
+    if unknown_classes:
+        raise ValueError(f"QSPARC_MODEL_ROUTES: unknown request classes {sorted(unknown_classes)}")
+    for route, endpoint in routes.items():
+        if endpoint not in endpoints:
+            raise ValueError(
+                f"QSPARC_MODEL_ROUTES: {route!r} routes to {endpoint!r}, "
+                f"which is not a configured endpoint ({sorted(endpoints)})"
+            )
+    return routes
+
+
+def relevant_row_count(docs: List[Document], entities: Sequence[EntityMatch]) -> int:
+    """Rows mentioning a named structure, or all rows if nothing was named."""
+    if not entities:
+        return len(docs)
+    wanted = {iri for match in entities for iri in match.iris}
+    return sum(
+        1 for doc in docs
+        if any(doc.metadata.get(iri_key) in wanted for _, iri_key in ENTITY_FIELDS)
+    )
+
+
+def classify_request(
+    question: str,
+    docs: List[Document],
+    entities: Sequence[EntityMatch],
+    routes: Dict[str, str] = DEFAULT_ROUTES,
+) -> RouteDecision:
+    """Classifies a request as simple lookup or synthesis and picks its endpoint."""
+    rows = relevant_row_count(docs, entities)
+    if _SYNTHESIS_RE.search(question):
+        route, reason = "synthesis", "synthesis_wording"
+    elif len(entities) > SIMPLE_MAX_ENTITIES:
+        route, reason = "synthesis", "many_entities"
+    elif rows > SIMPLE_MAX_ROWS:
+        route, reason = "synthesis", "many_rows"
+    elif _SIMPLE_RE.search(question):
+        route, reason = "simple", "lookup_wording"
+    else:
+        route, reason = "synthesis", "default"
+    return RouteDecision(route, routes[route], reason)
+
+
+def record_route(decision: RouteDecision) -> None:
+    ROUTE_DECISIONS.inc(decision.route, decision.endpoint, decision.reason)
+    trace = current_trace()
+    if trace is not None:
+        trace.set(route=decision.route, endpoint=decision.endpoint, route_reason=decision.reason)
@@ -0,0 +1,113 @@
+import os
+import json
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableGenerator
+
+from request_metrics import Counter, current_trace
+
+# --- Output-token budgets ---
+# Every generation gets a max_tokens cap chosen by endpoint and question class
+# ("simple" lookups vs "synthesis", see model_router). When vLLM stops at the
+# cap the answer ends with TRUNCATION_MARKER, and /chain/continue can resume it.
+
+DEFAULT_OUTPUT_BUDGETS: Dict[str, Dict[str, int]] = {
+    "large": {"simple": 512, "synthesis": 1536},
+    "small": {"simple": 384, "synthesis": 768},
+}
+# Used for endpoints/classes missing from the table
+FALLBACK_OUTPUT_BUDGET = 1024
+
+TRUNCATION_MARKER = (
+    "\n\n[Answer truncated at the output budget. "
+    "Call /chain/continue with the same session_id to continue.]"
+)
+
+BUDGET_REQUESTS = Counter(
+    "qsparc_output_budget_requests_total",
+    "Generations run under an output budget.",
+    ["endpoint", "question_class"],
+)
+BUDGET_EXCEEDED = Counter(
+    "qsparc_output_budget_exceeded_total",
+    "Generations stopped by their output budget (finish_reason=length).",
+    ["endpoint", "question_class"],
+)
+
+
+def load_output_budgets() -> Dict[str, Dict[str, int]]:
+    """Budget table, overridable per endpoint/class as JSON in QSPARC_OUTPUT_BUDGETS."""
+    budgets = {name: dict(classes) for name, classes in DEFAULT_OUTPUT_BUDGETS.items()}
+    raw = os.environ.get("QSPARC_OUTPUT_BUDGETS")
+    if raw:
+        for name, classes in json.loads(raw).items():
+            budgets.setdefault(name, {}).update(classes)
+    return budgets
+
+
+def output_budget(budgets: Dict[str, Dict[str, int]], endpoint: str, question_class: str) -> int:
+    return budgets.get(endpoint, {}).get(question_class, FALLBACK_OUTPUT_BUDGET)
+
+
+def is_truncated(text: str) -> bool:
+    return text.endswith(TRUNCATION_MARKER)
+
+
+def strip_truncation_marker(text: str) -> str:
+    return text[: -len(TRUNCATION_MARKER)] if is_truncated(text) else text
+
+
+class _BudgetWatcher:
+    """Tracks finish_reason across streamed message chunks."""
+
+    def __init__(self, endpoint: str, question_class: str):
+        self.endpoint = endpoint
+        self.question_class = question_class
+        self.finish_reason: Optional[str] = None
+        BUDGET_REQUESTS.inc(endpoint, question_class)
+
+    def text(self, chunk: BaseMessage) -> str:
+        reason = (getattr(chunk, "response_metadata", None) or {}).get("finish_reason")
+        if reason:
+            self.finish_reason = reason
+        content = chunk.content
+        return content if isinstance(content, str) else ""
+
+    def tail(self) -> str:
+        trace = current_trace()
+        if trace is not None and self.finish_reason:
+            trace.set(finish_reason=self.finish_reason)
+        if self.finish_reason != "length":
+            return ""
+        BUDGET_EXCEEDED.inc(self.endpoint, self.question_class)
+        return TRUNCATION_MARKER
+
+
+def budget_parser(endpoint: str, question_class: str) -> RunnableGenerator:
+    """
+    Output parser for a budgeted model: streams message text like
+    StrOutputParser and appends TRUNCATION_MARKER if the budget was hit.
+    """
+
+    def transform(chunks: Iterator[BaseMessage]) -> Iterator[str]:
+        watcher = _BudgetWatcher(endpoint, question_class)
+        for chunk in chunks:
+            text = watcher.text(chunk)
+            if text:
+                yield text
+        tail = watcher.tail()
+        if tail:
+            yield tail
+
+    async def atransform(chunks: AsyncIterator[BaseMessage]) -> AsyncIterator[str]:
+        watcher = _BudgetWatcher(endpoint, question_class)
+        async for chunk in chunks:
+            text = watcher.text(chunk)
+            if text:
+                yield text
+        tail = watcher.tail()
+        if tail:
+            yield tail
+
+    return RunnableGenerator(transform, atransform)
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from collections import Counter as Tally
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from request_metrics import Counter, _current_trace, current_trace
+
+# --- On-demand sampling profiler ---
+# An admin arms the profiler for the next N requests and/or a random fraction
+# of them (POST /admin/profiling). While at least one profiled request is in
+# flight, a daemon thread samples every Python thread with
+# sys._current_frames() every few milliseconds. Samples are attributed to
+# requests like this:
+#
+#   event loop thread  the sample goes to the request whose asyncio task is
+#                      running at that moment; while profiling, a task factory
+#                      records which request created each task (handler tasks,
+#                      RunnableParallel branches). Samples taken while the
+#                      loop waits for I/O are dropped
+#   worker threads     samples of busy threads (to_thread, sync runnables,
+#                      embedding) go to every profiled request in flight;
+#                      idle pool threads are skipped
+#
+# When the request finishes, its samples are written to PROFILE_DIR as
+# <stem>.collapsed (one "frame;frame;frame count" line per stack, for
+# flamegraph.pl / speedscope) and <stem>.speedscope.json (one profile per
+# thread, with the request's ID, stage timings and trace attributes under
+# "qsparc"). The stem is a server-side timestamp and sequence number: the
+# request ID may come from the client's X-Request-ID header, so it never
+# becomes part of a path. When the profiler is not armed the middleware checks one
+# attribute, no thread runs and the loop's task factory is left alone.
+
+PROFILE_DIR = os.environ.get("QSPARC_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_S = float(os.environ.get("QSPARC_PROFILE_INTERVAL_MS", "5")) / 1000.0
+# Oldest profiles are deleted beyond this many requests
+PROFILE_KEEP = int(os.environ.get("QSPARC_PROFILE_KEEP", "200"))
+# Stack depth kept per sample (innermost frames)
+MAX_STACK_DEPTH = 128
+
+# A thread whose innermost frame is in one of these files is waiting, not working
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+
+logger = logging.getLogger("qsparc.profiling")
+
+PROFILES_WRITTEN = Counter(
+    "qsparc_profiles_written_total",
+    "Per-request profiles written by the sampling profiler.",
+)
+
+Frame = Tuple[str, str, int]  # (function, file, first line)
+
+
+def _frame_key(code) -> Frame:
+    return (getattr(code, "co_qualname", code.co_name), code.co_filename, code.co_firstlineno)
+
+
+def _stack(frame) -> Tuple[Frame, ...]:
+    """Outermost-first stack of a thread's current frame."""
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(_frame_key(frame.f_code))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+
+def _is_idle(frame) -> bool:
+    return frame.f_code.co_filename.endswith(_IDLE_FILES)
+
+
+class RequestProfile:
+    """
+    Samples collected for one request, by thread name. Once closed, samples
+    from a sampling tick still in progress are ignored, so the writer can
+    read `samples` without the sampler changing it.
+    """
+
+    def __init__(self, trace, loop: asyncio.AbstractEventLoop, loop_thread: int):
+        self.trace = trace
+        self.loop = loop
+        self.loop_thread = loop_thread
+        self.samples: Dict[str, Tally] = {}
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def add(self, thread_name: str, stack: Tuple[Frame, ...]) -> None:
+        with self._lock:
+            if not self.closed:
+                self.samples.setdefault(thread_name, Tally())[stack] += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+
+    @property
+    def sample_count(self) -> int:
+        return sum(sum(tally.values()) for tally in self.samples.values())
+
+
+def _collapsed(profile: RequestProfile) -> str:
+    lines = []
+    for thread_name, tally in profile.samples.items():
+        for stack, count in tally.most_common():
+            names = [thread_name] + [f"{name} ({os.path.basename(path)}:{line})" for name, path, line in stack]
+            lines.append(f"{';'.join(n.replace(';', ':') for n in names)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def _speedscope(profile: RequestProfile, interval_s: float) -> Dict[str, Any]:
+    frames: List[Dict[str, Any]] = []
+    frame_index: Dict[Frame, int] = {}
+    profiles = []
+    weight = interval_s * 1000.0
+    for thread_name, tally in profile.samples.items():
+        samples, weights = [], []
+        for stack, count in tally.items():
+            ids = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                ids.append(frame_index[frame])
+            samples.append(ids)
+            weights.append(count * weight)
+        profiles.append({
+            "type": "sampled",
+            "name": thread_name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        })
+    trace = profile.trace
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{trace.path} {trace.request_id}",
+        "exporter": "qsparc",
+        "activeProfileIndex": 0,
+        "shared": {"frames": frames},
+        "profiles": profiles,
+        "qsparc": trace.to_dict(),
+    }
+
+
+class SamplingProfiler:
+    """
+    Arming state and the sampler thread. `enabled` is the only thing the
+    request path reads when profiling is off.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR, interval_s: float = PROFILE_INTERVAL_S, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.interval_s = interval_s
+        self.keep = keep
+        self.enabled = False
+        self.remaining = 0
+        self.sample_rate = 0.0
+        self.written: List[str] = []
+        self._sequence = itertools.count(1)
+        self._active: Dict[int, RequestProfile] = {}
+        # Tasks created by profiled requests -> their profile
+        self._tasks: Dict[asyncio.Task, RequestProfile] = {}
+        self._previous_factory = None
+        self._factory_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def arm(self, requests: int = 0, sample_rate: float = 0.0) -> Dict[str, Any]:
+        """Profiles the next `requests` requests and a `sample_rate` fraction of the rest."""
+        with self._lock:
+            self.remaining = max(0, int(requests))
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+            self.enabled = self.remaining > 0 or self.sample_rate > 0.0
+        logger.info("Profiling %s (next %d requests, sample rate %.3f)",
+                    "armed" if self.enabled else "disarmed", self.remaining, self.sample_rate)
+        return self.status()
+
+    def disarm(self) -> Dict[str, Any]:
+        return self.arm(0, 0.0)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "remaining": self.remaining,
+            "sample_rate": self.sample_rate,
+            "in_flight": len(self._active),
+            "directory": os.path.abspath(self.directory),
+            "recent": self.written[-10:],
+        }
+
+    def _claim(self) -> bool:
+        with self._lock:
+            if self.remaining > 0:
+                self.remaining -= 1
+                self.enabled = self.remaining > 0 or self.sample_rate > 0.0
+                return True
+            return self.sample_rate > 0.0 and random.random() < self.sample_rate
+
+    def start(self, trace) -> Optional[RequestProfile]:
+        """Starts profiling the current request if the arming rules select it."""
+        if trace is None or not self._claim():
+            return None
+        loop = asyncio.get_running_loop()
+        profile = RequestProfile(trace, loop, threading.get_ident())
+        trace.set(profiled=True)
+        if self._factory_loop is None:
+            self._previous_factory = loop.get_task_factory()
+            self._factory_loop = loop
+            loop.set_task_factory(self._task_factory)
+        self._tasks[asyncio.current_task()] = profile
+        with self._lock:
+            self._active[id(trace)] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="qsparc-profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile: RequestProfile) -> None:
+        profile.close()
+        with self._lock:
+            self._active.pop(id(profile.trace), None)
+            idle = not self._active
+        for task in [t for t, p in self._tasks.items() if p is profile]:
+            del self._tasks[task]
+        if idle and self._factory_loop is not None:
+            self._factory_loop.set_task_factory(self._previous_factory)
+            self._factory_loop = self._previous_factory = None
+
+    def _task_factory(self, loop, coro, **kwargs):
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        trace = context.get(_current_trace) if context is not None else current_trace()
+        profile = self._active.get(id(trace)) if trace is not None else None
+        if profile is not None:
+            self._tasks[task] = profile
+        return task
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                profiles = list(self._active.values())
+                if not profiles:
+                    # Nothing to sample: the thread exits until the next profiled request
+                    self._thread = None
+                    return
+            names = {t.ident: t.name for t in threading.enumerate()}
+            loop_threads = {p.loop_thread: p.loop for p in profiles}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or _is_idle(frame):
+                    continue
+                thread_name = names.get(ident, str(ident))
+                if ident in loop_threads:
+                    task = asyncio.current_task(loop_threads[ident])
+                    profile = self._tasks.get(task) if task is not None else None
+                    if profile is not None:
+                        profile.add(thread_name, _stack(frame))
+                    continue
+                stack = _stack(frame)
+                for profile in profiles:
+                    profile.add(thread_name, stack)
+            time.sleep(self.interval_s)
+
+    def write(self, profile: RequestProfile) -> Optional[str]:
+        """Writes the collapsed stacks and speedscope JSON; returns the file stem."""
+        if not profile.samples:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stem = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._sequence):06d}")
+        with open(f"{stem}.collapsed", "w", encoding="utf-8") as f:
+            f.write(_collapsed(profile))
+        with open(f"{stem}.speedscope.json", "w", encoding="utf-8") as f:
+            json.dump(_speedscope(profile, self.interval_s), f, default=str)
+        PROFILES_WRITTEN.inc()
+        logger.info("Wrote profile %s for request %s (%d samples)", stem, profile.trace.request_id, profile.sample_count)
+        with self._lock:
+            self.written.append(stem)
+            expired, self.written = self.written[:-self.keep], self.written[-self.keep:]
+        for old in expired:
+            for suffix in (".collapsed", ".speedscope.json"):
+                try:
+                    os.remove(old + suffix)
+                except OSError:
+                    pass
+        return stem
+
+
+class ProfilingMiddleware:
+    """
+    Profiles selected requests whose path starts with one of `prefixes`.
+    Added inside RequestTraceMiddleware, so the request's trace (and its
+    stage timings, complete once the response is sent) is available.
+    """
+
+    def __init__(self, app, profiler: SamplingProfiler, prefixes: Sequence[str] = ("/chain",)):
+        self.app = app
+        self.profiler = profiler
+        self.prefixes = tuple(prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if not self.profiler.enabled or scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        profile = self.profiler.start(current_trace())
+        if profile is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.stop(profile)
+            try:
+                await asyncio.to_thread(self.profiler.write, profile)
+            except Exception:
+                logger.exception("Writing the profile of %s failed", profile.trace.request_id)
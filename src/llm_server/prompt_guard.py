@@ -0,0 +1,154 @@
+import os
+import logging
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+
+from request_metrics import Counter, current_trace, trace_stage
+from token_counter import count_tokens
+
+# --- Preflight prompt-size guard ---
+# Before a request is queued for a model, the prompt is measured with the
+# served model's tokenizer (see token_counter.py) against that endpoint's
+# max_model_len minus the output budget. Segment counts are memoized: the
+# system prompt and few-shot block are counted once per process, history
+# messages and the question by their text (the context is counted per request,
+# since it is rarely repeated). If the prompt does not fit, the
+# lowest-priority segments are dropped until it does: the oldest history
+# turns first, then the retrieved rows with the lowest relevance_score.
+# A request that cannot fit even with no history and no rows is rejected
+# before it reaches vLLM.
+
+DEFAULT_MAX_MODEL_LEN = int(os.environ.get("QSPARC_MAX_MODEL_LEN", "32768"))
+# Chat-template tokens around each message (<|im_start|>role ... <|im_end|>)
+MESSAGE_OVERHEAD_TOKENS = 8
+# Headroom for tokenizer/template differences between here and vLLM
+SAFETY_MARGIN_TOKENS = 64
+
+logger = logging.getLogger("qsparc.prompt_guard")
+
+PROMPT_TRIMS = Counter(
+    "qsparc_prompt_trimmed_segments_total",
+    "Prompt segments dropped by the preflight size guard.",
+    ["segment"],
+)
+PROMPT_REJECTED = Counter(
+    "qsparc_prompt_rejected_total",
+    "Requests rejected because the prompt cannot fit the model context.",
+)
+
+
+class PromptTooLarge(Exception):
+    """Raised when the question alone does not fit the model context."""
+
+
+@lru_cache(maxsize=8192)
+def segment_tokens(text: str) -> int:
+    """Token count of one prompt segment, memoized by its text."""
+    return count_tokens(text)
+
+
+def _message_tokens(message: BaseMessage) -> int:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return segment_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def prompt_token_limit(endpoint: Dict[str, Any], max_tokens: int) -> int:
+    """Prompt tokens an endpoint accepts when max_tokens are reserved for the answer."""
+    max_model_len = int(endpoint.get("max_model_len", DEFAULT_MAX_MODEL_LEN))
+    return max_model_len - max_tokens - SAFETY_MARGIN_TOKENS
+
+
+class PromptGuard:
+    """
+    Fits {"input", "history", "docs", "context"} prompt inputs into a token
+    limit. `system_template` is the system prompt with its {context} slot,
+    `fixed_messages` the few-shot block, `format_context` renders the rows.
+    """
+
+    def __init__(
+        self,
+        system_template: str,
+        fixed_messages: Sequence[BaseMessage],
+        format_context: Callable[[List[Document]], str],
+    ):
+        self.system_template = system_template
+        self.fixed_messages = list(fixed_messages)
+        self.format_context = format_context
+        self._fixed_tokens = None
+
+    @property
+    def fixed_tokens(self) -> int:
+        """System prompt (without context) and few-shot block, counted on first use."""
+        if self._fixed_tokens is None:
+            self._fixed_tokens = (
+                segment_tokens(self.system_template.replace("{context}", ""))
+                + MESSAGE_OVERHEAD_TOKENS
+                + sum(_message_tokens(m) for m in self.fixed_messages)
+            )
+        return self._fixed_tokens
+
+    def measure(self, question: str, history: Sequence[BaseMessage], context_tokens: int) -> int:
+        return (
+            self.fixed_tokens
+            + segment_tokens(question) + MESSAGE_OVERHEAD_TOKENS
+            + sum(_message_tokens(m) for m in history)
+            + context_tokens
+        )
+
+    def fit(self, inputs: Dict[str, Any], limit: int) -> Dict[str, Any]:
+        """Inputs with history and rows trimmed so the prompt is at most `limit` tokens."""
+        with trace_stage("prompt_preflight"):
+            question = inputs["input"]
+            history = list(inputs.get("history") or [])
+            docs = list(inputs.get("docs") or [])
+            context = inputs.get("context")
+            if context is None:
+                context = self.format_context(docs)
+            context_tokens = count_tokens(context)
+            before = total = self.measure(question, history, context_tokens)
+
+            dropped_history = 0
+            while total > limit and history:
+                # Oldest turn first (question and answer together)
+                drop = 2 if len(history) >= 2 else 1
+                history = history[drop:]
+                dropped_history += drop
+                total = self.measure(question, history, context_tokens)
+
+            dropped_docs = []
+            if total > limit and docs:
+                by_score = sorted(docs, key=lambda d: d.metadata.get("relevance_score", 0.0))
+                while total > limit and by_score:
+                    dropped_docs.append(by_score.pop(0))
+                    kept = {id(d) for d in by_score}
+                    docs = [d for d in docs if id(d) in kept]
+                    context = self.format_context(docs)
+                    context_tokens = count_tokens(context)
+                    total = self.measure(question, history, context_tokens)
+
+        trace = current_trace()
+        if trace is not None:
+            trace.set(prompt_tokens_preflight=total, prompt_token_limit=limit)
+        if total > limit:
+            PROMPT_REJECTED.inc()
+            raise PromptTooLarge(
+                f"The question needs about {total} prompt tokens; the model accepts {limit}."
+            )
+        if not dropped_history and not dropped_docs:
+            return inputs
+
+        if dropped_history:
+            PROMPT_TRIMS.inc("history", amount=dropped_history)
+        if dropped_docs:
+            PROMPT_TRIMS.inc("docs", amount=len(dropped_docs))
+        logger.info(
+            "Prompt trimmed from %d to %d tokens (limit %d): dropped %d history messages, %d rows %s",
+            before, total, limit, dropped_history, len(dropped_docs),
+            [(d.metadata.get("Neuron_ID"), round(d.metadata.get("relevance_score", 0.0), 3)) for d in dropped_docs],
+        )
+        if trace is not None:
+            trace.set(prompt_dropped_history=dropped_history, prompt_dropped_docs=len(dropped_docs))
+        return {**inputs, "history": history, "docs": docs, "context": context}
@@ -0,0 +1,134 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage
+from langchain_core.runnables import Runnable, RunnableLambda, RunnableParallel
+
+from entity_matcher import EntityMatcher
+from request_metrics import Counter, current_trace, trace_stage
+from sckan_index import RECORD_FIELDS
+
+# --- History-aware retrieval fan-out ---
+# A follow-up such as "and what about the hypogastric nerve?" names only the
+# new structure, so embedding it alone loses the pathway the conversation is
+# about. Instead of asking an LLM to rewrite the question, up to three query
+# variants are built from the entity dictionary:
+#
+#   raw       the question as typed
+#   history   the question plus structures named in the last user turns
+#   entities  only the structure labels (question and recent turns)
+#
+# Each variant is searched concurrently (RunnableParallel), and the ranked
+# lists are merged with reciprocal rank fusion, one entry per data row.
+
+QUERY_VARIANTS = ("raw", "history", "entities")
+# User turns of the history whose structures are carried into the variants
+HISTORY_TURNS = 2
+# Reciprocal rank fusion constant: score = sum of 1 / (RRF_K + rank)
+RRF_K = 60
+
+QUERY_VARIANT_SEARCHES = Counter(
+    "qsparc_query_variant_searches_total",
+    "Vector searches run per query variant of the retrieval fan-out.",
+    ["variant"],
+)
+
+
+def _labels(matcher: EntityMatcher, text: str) -> List[str]:
+    labels = []
+    for match in matcher.match(text):
+        if match.label not in labels:
+            labels.append(match.label)
+    return labels
+
+
+def build_query_variants(
+    question: str,
+    history: Sequence[BaseMessage],
+    matcher: EntityMatcher,
+    turns: int = HISTORY_TURNS,
+) -> Dict[str, str]:
+    """Distinct query texts by variant name; variants that add nothing are left out."""
+    question_labels = _labels(matcher, question)
+    recent = [m.content for m in history if isinstance(m, HumanMessage)][-turns:] if turns else []
+    history_labels = []
+    for text in reversed(recent):
+        for label in _labels(matcher, text):
+            if label not in question_labels and label not in history_labels:
+                history_labels.append(label)
+
+    candidates = [("raw", question)]
+    if history_labels:
+        candidates.append(("history", f"{question} {', '.join(history_labels)}"))
+    if question_labels or history_labels:
+        candidates.append(("entities", ", ".join(question_labels + history_labels)))
+    variants, seen = {}, set()
+    for name, text in candidates:
+        key = text.casefold().strip()
+        if key not in seen:
+            seen.add(key)
+            variants[name] = text
+    return variants
+
+
+def row_key(doc: Document) -> tuple:
+    """Identity of a data row, ignoring per-search fields such as relevance_score."""
+    return tuple(doc.metadata.get(field) for field in RECORD_FIELDS)
+
+
+def fuse_results(results: Dict[str, List[Document]], k: int) -> List[Document]:
+    """
+    Reciprocal rank fusion of the per-variant rankings, deduplicated by row.
+    A row keeps its best relevance_score across variants.
+    """
+    scores: Dict[tuple, float] = {}
+    best: Dict[tuple, Document] = {}
+    for name in QUERY_VARIANTS:
+        for rank, doc in enumerate(results.get(name) or (), 1):
+            key = row_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            kept = best.get(key)
+            if kept is None:
+                best[key] = doc
+            elif doc.metadata.get("relevance_score", 0.0) > kept.metadata.get("relevance_score", 0.0):
+                kept.metadata["relevance_score"] = doc.metadata["relevance_score"]
+    # sorted() is stable, so ties keep first-seen order (raw variant first)
+    ranked = sorted(best, key=lambda key: -scores[key])
+    return [best[key] for key in ranked[:k]]
+
+
+def _search_variant(name: str, k: int):
+    def search(inputs: Dict[str, Any]) -> Optional[List[Document]]:
+        query = inputs["queries"].get(name)
+        if query is None:
+            return None
+        QUERY_VARIANT_SEARCHES.inc(name)
+        return inputs["index"].retrieve(query, k)
+    return search
+
+
+def fanout_retriever(k: int) -> Runnable:
+    """
+    Runnable mapping {"input", "history", "index"} to the fused top-k rows.
+    Each variant retrieves k rows, so the raw question alone still fills k.
+    """
+
+    def with_queries(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with trace_stage("query_variants"):
+            queries = build_query_variants(
+                inputs["input"], inputs.get("history") or [], inputs["index"].entity_matcher)
+        return {**inputs, "queries": queries}
+
+    def merge(results: Dict[str, List[Document]]) -> List[Document]:
+        with trace_stage("fusion"):
+            docs = fuse_results(results, k)
+        trace = current_trace()
+        if trace is not None:
+            trace.set(
+                query_variants=[name for name in QUERY_VARIANTS if results.get(name) is not None],
+                retrieved_docs=len(docs),
+            )
+        return docs
+
+    searches = RunnableParallel({name: RunnableLambda(_search_variant(name, k)) for name in QUERY_VARIANTS})
+    return RunnableLambda(with_queries) | searches | RunnableLambda(merge)
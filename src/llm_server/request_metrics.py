@@ -0,0 +1,373 @@
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+# --- Request-level latency instrumentation ---
+# Each HTTP request gets a RequestTrace stored in a context variable. Chain
+# steps record stage timings and attributes into it, and when the response
+# finishes the trace is folded into Prometheus histograms and logged as a
+# single JSON line. Everything is in-process and lock-light on purpose.
+
+logger = logging.getLogger("qsparc.requests")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+# --- 1. Minimal Prometheus metric types ---
+
+def _escape_label(value: Any) -> str:
+    """Label value escaped as the text exposition format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def dec(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in snapshot.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                label_str = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {series[-1]}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render_prometheus() -> str:
+    """Text exposition format (version 0.0.4) of every registered metric."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- 2. Metric definitions ---
+
+REQUEST_SECONDS = Histogram(
+    "qsparc_request_duration_seconds", "End-to-end request latency.", ["path", "status"])
+STAGE_SECONDS = Histogram(
+    "qsparc_stage_duration_seconds", "Latency of individual chain stages.", ["stage"])
+RETRIEVED_DOCS = Histogram(
+    "qsparc_retrieved_documents", "Documents returned by retrieval per request.", buckets=COUNT_BUCKETS)
+PROMPT_TOKENS = Histogram(
+    "qsparc_llm_prompt_tokens", "Prompt tokens sent to the LLM per request.", buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = Histogram(
+    "qsparc_llm_output_tokens", "Completion tokens generated per LLM call.",
+    ["endpoint", "thinking"], buckets=TOKEN_BUCKETS)
+TTFT_SECONDS = Histogram(
+    "qsparc_llm_time_to_first_token_seconds", "Time from LLM call to first streamed token (prefill).")
+DECODE_SECONDS = Histogram(
+    "qsparc_llm_decode_seconds", "Time from first to last streamed token (decode).")
+TOKENS_PER_SECOND = Histogram(
+    "qsparc_llm_tokens_per_second", "Decode throughput per request.", buckets=RATE_BUCKETS)
+IN_FLIGHT = Gauge(
+    "qsparc_requests_in_flight", "Requests currently being processed.")
+
+
+# --- 3. Per-request trace ---
+
+class RequestTrace:
+    """Stage timings and attributes collected for one request."""
+
+    __slots__ = ("request_id", "path", "started", "stages", "attrs")
+
+    def __init__(self, path: str, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.path = path
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.attrs: Dict[str, Any] = {}
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "path": self.path,
+            "stages": {k: round(v, 6) for k, v in self.stages.items()},
+            **self.attrs,
+        }
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("qsparc_request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """The trace of the request being served, or None outside a request."""
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_stage(name: str):
+    """Times the enclosed block as a named stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_stage(name, elapsed)
+
+
+def route_label(scope) -> str:
+    """
+    Metric label for a request path: the matched route template (path
+    parameters shown as {name}), or "unmatched". Raw paths would let any
+    client create new time series.
+    """
+    if scope.get("endpoint") is None:
+        return "unmatched"
+    params = {str(value): name for name, value in (scope.get("path_params") or {}).items()}
+    return "/".join(
+        "{" + params[segment] + "}" if segment in params else segment
+        for segment in scope["path"].split("/")
+    )
+
+
+def finish_trace(trace: RequestTrace, status: int, route: str = "unmatched") -> None:
+    """Exports a finished trace to the histograms and the request log."""
+    total = time.perf_counter() - trace.started
+    trace.set(status=status, duration_s=round(total, 6))
+    REQUEST_SECONDS.observe(total, route, str(status))
+    if "retrieved_docs" in trace.attrs:
+        RETRIEVED_DOCS.observe(trace.attrs["retrieved_docs"])
+    logger.info(json.dumps(trace.to_dict(), default=str))
+
+
+# --- 4. LLM callback for prefill/decode timing and token counts ---
+
+class LatencyCallbackHandler(BaseCallbackHandler):
+    """
+    Records time-to-first-token, decode time, token usage and throughput of
+    each LLM call into the current request trace. The model must stream
+    (streaming=True) for TTFT to be observable.
+    """
+
+    run_inline = True
+
+    def __init__(self, endpoint: str = "default", thinking: bool = False):
+        self.endpoint = endpoint
+        self.thinking = "on" if thinking else "off"
+        # run_id -> [trace, start, first token]; one request (e.g. /chat/batch)
+        # can have several LLM calls in flight under the same trace
+        self._runs: Dict[Any, list] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id=None, **kwargs) -> None:
+        trace = _current_trace.get()
+        if trace is not None:
+            self._runs[run_id] = [trace, time.perf_counter(), None]
+
+    def on_llm_start(self, serialized, prompts, *, run_id=None, **kwargs) -> None:
+        self.on_chat_model_start(serialized, prompts, run_id=run_id, **kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id=None, **kwargs) -> None:
+        run = self._runs.get(run_id)
+        if run is not None and run[2] is None:
+            trace, start, _ = run
+            run[2] = time.perf_counter()
+            ttft = run[2] - start
+            trace.add_stage("llm_prefill", ttft)
+            trace.set(ttft_s=round(ttft, 6))
+            TTFT_SECONDS.observe(ttft)
+
+    def on_llm_end(self, response: LLMResult, *, run_id=None, **kwargs) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        trace, start, first_token = run
+        end = time.perf_counter()
+        prompt_tokens, output_tokens = _token_usage(response)
+        if first_token is not None:
+            decode = end - first_token
+            trace.add_stage("llm_decode", decode)
+            DECODE_SECONDS.observe(decode)
+            if output_tokens and decode > 0:
+                tps = output_tokens / decode
+                trace.set(tokens_per_second=round(tps, 2))
+                TOKENS_PER_SECOND.observe(tps)
+        else:
+            trace.add_stage("llm", end - start)
+        if prompt_tokens is not None:
+            trace.set(prompt_tokens=prompt_tokens)
+            PROMPT_TOKENS.observe(prompt_tokens)
+        if output_tokens is not None:
+            trace.set(output_tokens=output_tokens)
+            OUTPUT_TOKENS.observe(output_tokens, self.endpoint, self.thinking)
+
+    def on_llm_error(self, error: BaseException, *, run_id=None, **kwargs) -> None:
+        self._runs.pop(run_id, None)
+
+
+def _token_usage(response: LLMResult) -> Tuple[Optional[int], Optional[int]]:
+    """Pulls (prompt, completion) token counts from an LLM result."""
+    for generations in response.generations:
+        for gen in generations:
+            usage = getattr(getattr(gen, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+# --- 5. ASGI middleware ---
+
+class RequestTraceMiddleware:
+    """
+    Opens a RequestTrace for every HTTP request whose path starts with one of
+    `prefixes`, and finishes it once the last body chunk has been sent (so
+    streaming responses are measured end to end).
+    """
+
+    def __init__(
+        self,
+        app,
+        prefixes: Sequence[str] = ("/chain",),
+        priorities: Sequence[str] = ("interactive", "batch"),
+    ):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+        # Known scheduling classes; the first is used for anything else
+        self.priorities = tuple(priorities)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode() or None
+        trace = RequestTrace(scope["path"], request_id)
+        # Scheduling class requested by the client ("interactive" UI or "batch"),
+        # limited to the known classes since it becomes a metric label
+        priority = headers.get(b"x-priority", b"").decode("latin-1")
+        trace.set(priority=priority if priority in self.priorities else self.priorities[0])
+        token = _current_trace.set(trace)
+        status = {"code": 500}
+        finished = False
+
+        async def send_wrapper(message):
+            nonlocal finished
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-request-id", trace.request_id.encode())
+                ]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body") and not finished:
+                finished = True
+                finish_trace(trace, status["code"], route_label(scope))
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec()
+            if not finished:
+                # 499: the client went away before the response was complete
+                finish_trace(
+                    trace,
+                    499 if trace.attrs.get("client_disconnected") else status["code"],
+                    route_label(scope),
+                )
+            _current_trace.reset(token)
@@ -0,0 +1,200 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.runnables import Runnable, RunnableGenerator
+
+from request_metrics import Counter, Gauge, Histogram, current_trace
+
+# --- Fair-share scheduling in front of the model call ---
+# A fixed number of upstream slots per endpoint is handed out by weighted
+# fair queuing over session IDs: each request gets a virtual finish tag
+# max(now_vtime, session's last tag) + 1/weight, and the smallest eligible
+# tag goes next. Priority classes set the weight, a per-session cap stops one
+# user from holding every slot, and requests waiting longer than max_wait_s
+# are rejected instead of piling up.
+
+DEFAULT_CLASS_WEIGHTS = {"interactive": 4.0, "batch": 1.0}
+
+QUEUE_DEPTH = Gauge(
+    "qsparc_scheduler_queue_depth", "Requests waiting for an upstream slot.", ["endpoint", "priority"])
+ACTIVE_SLOTS = Gauge(
+    "qsparc_scheduler_active_slots", "Upstream slots currently in use.", ["endpoint"])
+QUEUE_WAIT_SECONDS = Histogram(
+    "qsparc_scheduler_wait_seconds", "Time spent waiting for an upstream slot.", ["endpoint", "priority"])
+REJECTED = Counter(
+    "qsparc_scheduler_rejected_total", "Requests rejected after exceeding the maximum wait.", ["endpoint", "priority"])
+
+
+class SchedulerTimeout(Exception):
+    """Raised when a request waited longer than max_wait_s for a slot."""
+
+
+class _Waiter:
+    __slots__ = ("tag", "seq", "session_id", "priority", "future", "abandoned")
+
+    def __init__(self, tag: float, seq: int, session_id: str, priority: str, future: asyncio.Future):
+        self.tag = tag
+        self.seq = seq
+        self.session_id = session_id
+        self.priority = priority
+        self.future = future
+        self.abandoned = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+class FairScheduler:
+    """Weighted fair queue of upstream slots for one model endpoint."""
+
+    def __init__(
+        self,
+        endpoint: str,
+        max_concurrency: int = 16,
+        per_session_limit: int = 2,
+        max_wait_s: float = 60.0,
+        class_weights: Optional[Dict[str, float]] = None,
+    ):
+        self.endpoint = endpoint
+        self.max_concurrency = max_concurrency
+        self.per_session_limit = per_session_limit
+        self.max_wait_s = max_wait_s
+        self.class_weights = dict(class_weights or DEFAULT_CLASS_WEIGHTS)
+        self._heap: List[_Waiter] = []
+        self._active = 0
+        self._active_by_session: Dict[str, int] = {}
+        self._last_tag: Dict[str, float] = {}
+        self._vtime = 0.0
+        self._seq = itertools.count()
+
+    def _weight(self, priority: str) -> float:
+        return self.class_weights.get(priority, min(self.class_weights.values()))
+
+    def _eligible(self, session_id: str) -> bool:
+        return self._active_by_session.get(session_id, 0) < self.per_session_limit
+
+    def _grant(self, session_id: str) -> None:
+        self._active += 1
+        self._active_by_session[session_id] = self._active_by_session.get(session_id, 0) + 1
+        ACTIVE_SLOTS.set(self._active, self.endpoint)
+
+    def _dispatch(self) -> None:
+        skipped = []
+        while self._heap and self._active < self.max_concurrency:
+            waiter = heapq.heappop(self._heap)
+            if waiter.abandoned:
+                continue
+            if not self._eligible(waiter.session_id):
+                skipped.append(waiter)
+                continue
+            self._vtime = max(self._vtime, waiter.tag - 1.0 / self._weight(waiter.priority))
+            QUEUE_DEPTH.dec(self.endpoint, waiter.priority)
+            self._grant(waiter.session_id)
+            waiter.future.set_result(None)
+        for waiter in skipped:
+            heapq.heappush(self._heap, waiter)
+
+    async def acquire(self, session_id: str, priority: str = "interactive") -> None:
+        if not self._heap and self._active < self.max_concurrency and self._eligible(session_id):
+            self._grant(session_id)
+            QUEUE_WAIT_SECONDS.observe(0.0, self.endpoint, priority)
+            return
+
+        start_tag = max(self._vtime, self._last_tag.get(session_id, 0.0))
+        tag = start_tag + 1.0 / self._weight(priority)
+        self._last_tag[session_id] = tag
+        waiter = _Waiter(tag, next(self._seq), session_id, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        QUEUE_DEPTH.inc(self.endpoint, priority)
+        self._dispatch()
+
+        started = time.perf_counter()
+        try:
+            done, _ = await asyncio.wait({waiter.future}, timeout=self.max_wait_s)
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self.release(session_id)
+            else:
+                self._abandon(waiter)
+            raise
+        waited = time.perf_counter() - started
+        QUEUE_WAIT_SECONDS.observe(waited, self.endpoint, priority)
+        if not done:
+            self._abandon(waiter)
+            REJECTED.inc(self.endpoint, priority)
+            raise SchedulerTimeout(
+                f"No {self.endpoint} model slot became free within {self.max_wait_s:g}s"
+            )
+        trace = current_trace()
+        if trace is not None:
+            trace.set(queue_wait_s=round(waited, 6))
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        waiter.abandoned = True
+        waiter.future.cancel()
+        QUEUE_DEPTH.dec(self.endpoint, waiter.priority)
+
+    def release(self, session_id: str) -> None:
+        self._active -= 1
+        remaining = self._active_by_session.get(session_id, 1) - 1
+        if remaining:
+            self._active_by_session[session_id] = remaining
+        else:
+            self._active_by_session.pop(session_id, None)
+            if self._last_tag.get(session_id, 0.0) <= self._vtime:
+                # Idle session with no credit left: forget it
+                self._last_tag.pop(session_id, None)
+        ACTIVE_SLOTS.set(self._active, self.endpoint)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, session_id: str, priority: str = "interactive"):
+        await self.acquire(session_id, priority)
+        try:
+            yield
+        finally:
+            self.release(session_id)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "endpoint": self.endpoint,
+            "active": self._active,
+            "waiting": sum(1 for w in self._heap if not w.abandoned),
+            "max_concurrency": self.max_concurrency,
+            "per_session_limit": self.per_session_limit,
+            "max_wait_s": self.max_wait_s,
+        }
+
+
+def request_identity(config: Optional[Dict[str, Any]]) -> tuple:
+    """(session_id, priority) of the running request, from the chain config and trace."""
+    session_id = ((config or {}).get("configurable") or {}).get("session_id", "anonymous")
+    trace = current_trace()
+    priority = trace.attrs.get("priority", "interactive") if trace is not None else "interactive"
+    return session_id, priority
+
+
+def scheduled(runnable: Runnable, scheduler: FairScheduler) -> RunnableGenerator:
+    """
+    Wraps a (model) runnable so each async call holds a scheduler slot for
+    the whole stream. The sync path is not scheduled.
+    """
+
+    def transform(inputs: Iterator[Any], config) -> Iterator[Any]:
+        for chunk in runnable.stream(list(inputs)[-1], config):
+            yield chunk
+
+    async def atransform(inputs: AsyncIterator[Any], config) -> AsyncIterator[Any]:
+        value = None
+        async for item in inputs:
+            value = item
+        session_id, priority = request_identity(config)
+        async with scheduler.slot(session_id, priority):
+            async for chunk in runnable.astream(value, config):
+                yield chunk
+
+    return RunnableGenerator(transform, atransform)
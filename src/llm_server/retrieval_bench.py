@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+Retrieval quality-and-speed benchmark over a gold set of SCKAN questions.
+
+Every gold question lists the A/B/C IRIs a correct answer needs. Each
+combination of retrieval backend, embedding model and k is run over the gold
+set and scored on recall@k, context tokens sent to the LLM and per-query
+latency, so the cheapest configuration that keeps recall can be picked.
+
+    python retrieval_bench.py --data /path/to/a-b-via-c.json --k 5 10 20 \
+        --backends dense hybrid --filters
+
+The bundle backends search the vectors the way index bundles are served
+(exact float32, or int8/binary scan with float32 rescoring); their rows also
+report the bytes scanned per query and the recall change against exact search.
+`--context-format sentences compact` counts the prompt tokens of each context
+layout (context_format.py) for the same retrieved rows.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+from collections import defaultdict
+from typing import List, Dict, Any, Callable, NamedTuple, Optional, Sequence, Set
+
+import numpy as np
+from langchain_core.documents import Document
+
+from embedding_provider import get_embeddings
+from context_format import CONTEXT_FORMATTERS
+from entity_matcher import ENTITY_FIELDS, EntityMatcher
+from index_bundle import VectorIndex
+from sckan_index import EMBEDDING_MODEL, load_and_process_documents, create_vector_store
+from token_counter import count_tokens
+
+GOLD_SET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gold_questions.json")
+
+# A search function takes (question, k, metadata filter) and returns documents
+SearchFn = Callable[[str, int, Optional[Dict[str, Any]]], List[Document]]
+
+
+class GoldQuestion(NamedTuple):
+    question: str
+    expected: Dict[str, Set[str]]          # "A"/"B"/"C" -> IRIs that must be retrieved
+    metadata_filter: Optional[Dict[str, Any]]
+
+
+def load_gold_set(path: str = GOLD_SET_PATH) -> List[GoldQuestion]:
+    """Reads the gold set; questions without expectations are skipped."""
+    with open(path) as f:
+        items = json.load(f)
+    gold = []
+    for item in items:
+        expected = {field: set(iris) for field, iris in item.get("expected", {}).items() if iris}
+        if expected:
+            gold.append(GoldQuestion(item["question"], expected, item.get("filter")))
+    return gold
+
+
+def recall(expected: Dict[str, Set[str]], docs: List[Document]) -> float:
+    """Fraction of expected (column, IRI) pairs present in the retrieved rows."""
+    found = defaultdict(set)
+    for doc in docs:
+        for field in expected:
+            found[field].add(doc.metadata.get(f"{field}_ID"))
+    total = sum(len(iris) for iris in expected.values())
+    hits = sum(len(iris & found[field]) for field, iris in expected.items())
+    return hits / total if total else 1.0
+
+
+# --- Retrieval backends ---
+# A backend factory receives the documents, the embedding model name and a
+# cache shared by all factories (so vector stores are built once per model)
+# and returns a SearchFn.
+
+RETRIEVAL_BACKENDS: Dict[str, Callable[[List[Document], str, Dict[str, Any]], SearchFn]] = {}
+
+
+def register_backend(name: str):
+    def decorator(factory):
+        RETRIEVAL_BACKENDS[name] = factory
+        return factory
+    return decorator
+
+
+def _chroma_filter(metadata_filter: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Chroma needs an explicit $and when filtering on several columns."""
+    if not metadata_filter or len(metadata_filter) == 1:
+        return metadata_filter or None
+    return {"$and": [{key: value} for key, value in metadata_filter.items()]}
+
+
+def _row_key(doc: Document) -> tuple:
+    return tuple(sorted(doc.metadata.items()))
+
+
+def _cached_vector_store(docs: List[Document], embedding_model: str, cache: Dict[str, Any]):
+    key = f"chroma:{embedding_model}"
+    if key not in cache:
+        # One collection per model: in-memory stores share a process-wide client
+        cache[key] = create_vector_store(docs, embedding_model, collection_name=f"bench-{len(cache)}")
+    return cache[key]
+
+
+@register_backend("dense")
+def dense_backend(docs: List[Document], embedding_model: str, cache: Dict[str, Any]) -> SearchFn:
+    """Plain Chroma similarity search, as used by the server."""
+    store = _cached_vector_store(docs, embedding_model, cache)
+
+    def search(question: str, k: int, metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        return store.similarity_search(question, k=k, filter=_chroma_filter(metadata_filter))
+    return search
+
+
+@register_backend("hybrid")
+def hybrid_backend(docs: List[Document], embedding_model: str, cache: Dict[str, Any]) -> SearchFn:
+    """
+    Rows containing structures named in the question (entity dictionary)
+    first, ranked by how many of the named IRIs they contain, then dense
+    results to fill up to k.
+    """
+    dense = dense_backend(docs, embedding_model, cache)
+    if "entity_matcher" not in cache:
+        rows_by_iri = defaultdict(set)
+        for i, doc in enumerate(docs):
+            for _, iri_key in ENTITY_FIELDS:
+                rows_by_iri[doc.metadata.get(iri_key)].add(i)
+        cache["entity_matcher"] = EntityMatcher.from_records(doc.metadata for doc in docs)
+        cache["rows_by_iri"] = rows_by_iri
+    matcher, rows_by_iri = cache["entity_matcher"], cache["rows_by_iri"]
+
+    def search(question: str, k: int, metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        scores = defaultdict(int)
+        for iri in matcher.matched_iris(question):
+            for i in rows_by_iri.get(iri, ()):
+                scores[i] += 1
+        exact = [
+            docs[i] for i in sorted(scores, key=lambda i: (-scores[i], i))
+            if not metadata_filter
+            or all(docs[i].metadata.get(key) == value for key, value in metadata_filter.items())
+        ][:k]
+        seen = {_row_key(doc) for doc in exact}
+        results = list(exact)
+        if len(results) < k:
+            for doc in dense(question, k, metadata_filter):
+                if len(results) >= k:
+                    break
+                key = _row_key(doc)
+                if key not in seen:
+                    seen.add(key)
+                    results.append(doc)
+        return results
+    return search
+
+
+def _vector_index(docs: List[Document], embedding_model: str, cache: Dict[str, Any], quantization: Optional[str]):
+    """Normalized document vectors of one model, embedded once and shared by the bundle backends."""
+    if "bundle_vectors" not in cache:
+        embeddings = get_embeddings(embedding_model)
+        vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        cache["bundle_embeddings"], cache["bundle_vectors"] = embeddings, vectors
+    return cache["bundle_embeddings"], VectorIndex(cache["bundle_vectors"], quantization)
+
+
+def _bundle_backend(quantization: Optional[str]):
+    def factory(docs: List[Document], embedding_model: str, cache: Dict[str, Any]) -> SearchFn:
+        embeddings, index = _vector_index(docs, embedding_model, cache, quantization)
+
+        def search(question: str, k: int, metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+            mask = None
+            if metadata_filter:
+                mask = np.fromiter(
+                    (all(doc.metadata.get(key) == value for key, value in metadata_filter.items()) for doc in docs),
+                    dtype=bool, count=len(docs),
+                )
+            ids, _ = index.search(np.asarray(embeddings.embed_query(question)), k, mask)
+            return [docs[int(i)] for i in ids]
+        search.vector_bytes = index.scan_bytes
+        return search
+    return factory
+
+
+register_backend("bundle")(_bundle_backend(None))
+register_backend("bundle_int8")(_bundle_backend("int8"))
+register_backend("bundle_binary")(_bundle_backend("binary"))
+
+
+# --- Benchmark driver ---
+
+def run_benchmark(
+    docs: List[Document],
+    gold: List[GoldQuestion],
+    backends: List[str],
+    ks: List[int],
+    embedding_models: List[str],
+    use_filters: bool = False,
+    context_formats: Sequence[str] = ("sentences",),
+) -> List[Dict[str, Any]]:
+    """
+    Runs every configuration over the gold set and returns one row per
+    configuration and context format (the same retrieved rows, formatted each way).
+    """
+    rows = []
+    for embedding_model in embedding_models:
+        cache: Dict[str, Any] = {}
+        for backend in backends:
+            build_start = time.perf_counter()
+            search = RETRIEVAL_BACKENDS[backend](docs, embedding_model, cache)
+            build_s = time.perf_counter() - build_start
+            # One untimed query so lazy model loading is not billed to the first question
+            search(gold[0].question, 1, None)
+            for k in ks:
+                recalls, latencies = [], []
+                tokens: Dict[str, List[int]] = {name: [] for name in context_formats}
+                for item in gold:
+                    start = time.perf_counter()
+                    retrieved = search(item.question, k, item.metadata_filter if use_filters else None)
+                    latencies.append(time.perf_counter() - start)
+                    recalls.append(recall(item.expected, retrieved))
+                    for name in context_formats:
+                        tokens[name].append(count_tokens(CONTEXT_FORMATTERS[name](retrieved)))
+                latencies.sort()
+                for name in context_formats:
+                    rows.append({
+                        "backend": backend,
+                        "embedding_model": embedding_model,
+                        "k": k,
+                        "filters": use_filters,
+                        "context_format": name,
+                        "recall": round(statistics.fmean(recalls), 4),
+                        "context_tokens": round(statistics.fmean(tokens[name]), 1),
+                        "latency_p50_ms": round(1000 * latencies[len(latencies) // 2], 2),
+                        "latency_p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2),
+                        "build_s": round(build_s, 2),
+                        "vector_bytes": getattr(search, "vector_bytes", None),
+                    })
+    return rows
+
+
+def cheapest_configuration(rows: List[Dict[str, Any]], tolerance: float = 0.0) -> Dict[str, Any]:
+    """Fewest context tokens among configurations within tolerance of the best recall."""
+    best_recall = max(row["recall"] for row in rows)
+    eligible = [row for row in rows if row["recall"] >= best_recall - tolerance]
+    return min(eligible, key=lambda row: (row["context_tokens"], row["latency_p50_ms"]))
+
+
+def quantization_report(rows: List[Dict[str, Any]], baseline: str = "bundle") -> List[Dict[str, Any]]:
+    """Memory saved and recall lost by each quantized bundle backend against exact search."""
+    exact = {
+        (row["embedding_model"], row["k"], row["context_format"]): row
+        for row in rows if row["backend"] == baseline
+    }
+    report = []
+    for row in rows:
+        base = exact.get((row["embedding_model"], row["k"], row["context_format"]))
+        if row["backend"] == baseline or base is None or row["vector_bytes"] is None:
+            continue
+        report.append({
+            "backend": row["backend"],
+            "embedding_model": row["embedding_model"],
+            "k": row["k"],
+            "vector_bytes": row["vector_bytes"],
+            "memory_ratio": round(base["vector_bytes"] / row["vector_bytes"], 1),
+            "recall_delta": round(row["recall"] - base["recall"], 4),
+            "latency_p50_delta_ms": round(row["latency_p50_ms"] - base["latency_p50_ms"], 2),
+        })
+    return report
+
+
+def print_table(rows: List[Dict[str, Any]], columns: Optional[List[str]] = None) -> None:
+    columns = columns or [
+        "backend", "embedding_model", "k", "context_format", "recall", "context_tokens", "latency_p50_ms", "latency_p95_ms",
+    ]
+    widths = {c: max(len(c), *(len(str(row[c])) for row in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=os.environ.get("QSPARC_DATA_FILE"), help="SCKAN JSON export.")
+    parser.add_argument("--gold", default=GOLD_SET_PATH, help="Gold question file.")
+    parser.add_argument("--backends", nargs="+", default=["dense", "hybrid"], choices=sorted(RETRIEVAL_BACKENDS))
+    parser.add_argument("--k", nargs="+", type=int, default=[5, 10, 20])
+    parser.add_argument("--embedding-models", nargs="+", default=[EMBEDDING_MODEL])
+    parser.add_argument("--filters", action="store_true", help="Apply the gold set's metadata filters.")
+    parser.add_argument("--context-format", nargs="+", default=["sentences"], choices=sorted(CONTEXT_FORMATTERS),
+                        help="Context layouts to count prompt tokens for (model tokenizer).")
+    parser.add_argument("--tolerance", type=float, default=0.0, help="Recall loss accepted when picking the cheapest configuration.")
+    parser.add_argument("--output", help="Write all result rows as JSON to this file.")
+    args = parser.parse_args()
+    if not args.data:
+        sys.exit("--data (or QSPARC_DATA_FILE) is required")
+
+    documents = load_and_process_documents(args.data)
+    gold_set = load_gold_set(args.gold)
+    results = run_benchmark(
+        documents, gold_set, args.backends, args.k, args.embedding_models,
+        use_filters=args.filters, context_formats=args.context_format,
+    )
+    print_table(results)
+    quantized = quantization_report(results)
+    if quantized:
+        print("\nQuantized vectors against exact search:")
+        print_table(quantized, list(quantized[0]))
+    print("\nCheapest configuration keeping recall:", json.dumps(cheapest_configuration(results, args.tolerance)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,100 @@
+import json
+from typing import List, Dict, Any
+
+from langchain_core.documents import Document
+from langchain_community.document_loaders import JSONLoader
+from langchain_community.vectorstores import Chroma
+
+from embedding_provider import get_embeddings
+
+# --- SCKAN data loading and vector store creation ---
+# Shared by the server and the offline tools (benchmarks, index builders) so
+# every consumer sees the same clean_data records and page_content.
+
+# Sentence-transformer model used for document and query embeddings
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+def get_val(record: Dict[str, Any], key: str) -> str:
+    """Safely extracts the 'value' from a record's key."""
+    if key in record and isinstance(record.get(key), dict):
+        return record[key].get('value', 'N/A')
+    return 'N/A'
+
+# Columns of a clean_data record, in export order
+RECORD_FIELDS = [
+    "Neuron_ID",
+    "A_L1_ID", "A_L1", "A_L2_ID", "A_L2", "A_L3_ID", "A_L3",
+    "A_ID", "A",
+    "C_ID", "C", "C_Type",
+    "B_ID", "B",
+    "Target_Organ_IRI", "Target_Organ",
+]
+
+def page_content_for(clean_data: Dict[str, str]) -> str:
+    """Meaningful text content of a record for semantic search."""
+    return (
+        f"Neuron Connection Info: Neuron ID is {clean_data['Neuron_ID']}. "
+        f"It connects from {clean_data['A']} (A_ID: {clean_data['A_ID']}) "
+        f"to {clean_data['B']} (B_ID: {clean_data['B_ID']}) "
+        f"via {clean_data['C']} (C_ID: {clean_data['C_ID']}). "
+        f"The target organ is {clean_data['Target_Organ']} (IRI: {clean_data['Target_Organ_IRI']}). "
+        f"The connection type C_Type is {clean_data['C_Type']}. "
+        f"Hierarchical structure: A_L1: {clean_data['A_L1']} (ID: {clean_data['A_L1_ID']}), "
+        f"A_L2: {clean_data['A_L2']} (ID: {clean_data['A_L2_ID']}), "
+        f"A_L3: {clean_data['A_L3']} (ID: {clean_data['A_L3_ID']})."
+    )
+
+def load_and_process_documents(file_path: str) -> List[Document]:
+    """
+    Loads data from a JSON file, processes it into a structured format,
+    and creates LangChain Document objects ready for embedding.
+    """
+    jq_schema = '.results.bindings[]'
+    
+    print("Loading raw data from JSON...")
+    loader = JSONLoader(
+        file_path=file_path,
+        jq_schema=jq_schema,
+        text_content=False
+    )
+    raw_docs = loader.load()
+    
+    final_documents = []
+    print(f"Processing {len(raw_docs)} records...")
+    for doc in raw_docs:
+        record = json.loads(doc.page_content)
+
+        clean_data = {field: get_val(record, field) for field in RECORD_FIELDS}
+
+        # Store both the text and the structured data
+        final_documents.append(
+            Document(page_content=page_content_for(clean_data), metadata=clean_data)
+        )
+        
+    print("Document processing complete.")
+    return final_documents
+
+def create_vector_store(
+    documents: List[Document],
+    model_name: str = EMBEDDING_MODEL,
+    collection_name: str = "langchain",
+) -> Chroma:
+    """
+    Initializes an embedding model and creates a Chroma vector store
+    from the processed documents. In-memory stores share one Chroma client
+    per process, so stores that must coexist need distinct collection names.
+    """
+    print("Initializing embedding model...")
+    # Use a sentence-transformer model for creating embeddings. It runs locally,
+    # on the backend selected by QSPARC_EMBEDDING_BACKEND (see embedding_provider.py).
+    embeddings = get_embeddings(model_name)
+    
+    print("Creating Chroma vector store in memory...")
+    # Chroma is used as the vector store. It's fast and efficient for this use case.
+    vector_store = Chroma.from_documents(
+        documents=documents,
+        embedding=embeddings,
+        collection_name=collection_name,
+    )
+    print("Vector store created successfully!")
+    return vector_store
@@ -1,14 +1,21 @@
 import os
+import hmac
+import asyncio
+import gzip
 import json
-from fastapi import FastAPI
-from typing import List, Dict, Any
+import logging
+import functools
+from contextlib import AsyncExitStack
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from typing import List, Dict, Any, AsyncIterator, Iterator, Optional, Union
 from pydantic import BaseModel, Field
-from typing_extensions import TypedDict
+from typing_extensions import NotRequired, TypedDict
 
 # --- LangChain Core Imports ---
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableBranch, RunnableGenerator
 from langchain_core.documents import Document
 from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.chat_history import BaseChatMessageHistory
@@ -16,127 +23,188 @@ from langchain_core.chat_history import BaseChatMessageHistory
 # --- LangChain Community & Integrations ---
 from langchain_community.document_loaders import JSONLoader
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_openai import ChatOpenAI
 from langserve import add_routes
 from langchain.memory import ConversationBufferWindowMemory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
+# --- Local Modules ---
+from answer_store import precomputed_answer
+from flatmap_service import FlatmapService, structures_from_table
+from index_registry import IndexRegistry, UnknownDataset, load_dataset_config, load_dataset_index
+from early_answer import (
+    DEFAULT_MIN_RELEVANCE,
+    NO_DATA_MODES,
+    assess_evidence,
+    no_data_answer,
+    record_early_answer,
+)
+from model_router import RouteDecision, classify_request, load_model_endpoints, load_model_routes, record_route
+from thinking_filter import think_filter, thinking_request_kwargs
+from output_budget import (
+    budget_parser,
+    is_truncated,
+    load_output_budgets,
+    output_budget,
+    strip_truncation_marker,
+)
+from coalescing import SingleFlight, normalize_question
+from batch_chat import BATCH_SIZE, stream_in_completion_order
+from session_snapshot import SessionStore
+from context_format import CONTEXT_FORMATTERS, CONTEXT_INSTRUCTIONS
+from prompt_guard import PromptGuard, PromptTooLarge, prompt_token_limit, segment_tokens
+from query_fanout import fanout_retriever
+from client_disconnect import CancelOnDisconnectMiddleware
+from profiling import ProfilingMiddleware, SamplingProfiler
+from request_scheduler import DEFAULT_CLASS_WEIGHTS, FairScheduler, SchedulerTimeout, request_identity, scheduled
+from request_metrics import (
+    LatencyCallbackHandler,
+    RequestTraceMiddleware,
+    current_trace,
+    render_prometheus,
+    trace_stage,
+)
+
 # --- 1. Environment and Model Configuration ---
 # Set environment variables to ensure the model is loaded correctly
 os.environ["CUDA_VISIBLE_DEVICES"] = "0,2"
 os.environ["NO_PROXY"] = "localhost,127.0.0.1"
 
+# Per-request log lines are emitted on the "qsparc.requests" logger
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
 # LLM Configuration
-BASE_URL = "http://localhost:8000/v1"
+# QSPARC_LLM_BASE_URL points the server at another endpoint, e.g. scripts/stub_llm_server.py
+BASE_URL = os.environ.get("QSPARC_LLM_BASE_URL", "http://localhost:8000/v1")
 API_KEY = "EMPTY"
 MODEL_ID = "/hpc/fxu244/Documents/Code/LLMs/Qwen3-32B"
 
-# --- 2. Data Loading and Vector Store Creation (Executed on Server Startup) ---
-
-def get_val(record: Dict[str, Any], key: str) -> str:
-    """Safely extracts the 'value' from a record's key."""
-    if key in record and isinstance(record.get(key), dict):
-        return record[key].get('value', 'N/A')
-    return 'N/A'
+# Small model for simple lookups and "no results" answers
+SMALL_BASE_URL = os.environ.get("QSPARC_SMALL_LLM_BASE_URL", "http://localhost:8001/v1")
+SMALL_MODEL_ID = "/hpc/fxu244/Documents/Code/LLMs/Qwen3-0.6B"
+
+# Named OpenAI-compatible endpoints; add more via QSPARC_MODEL_ENDPOINTS (JSON).
+# Each entry may set "enable_thinking" to turn Qwen3 reasoning on for that route,
+# "max_concurrency" / "per_session_limit" to size its scheduler, and
+# "max_model_len" to match the context length vLLM serves it with.
+MODEL_ENDPOINTS = load_model_endpoints({
+    "large": {"base_url": BASE_URL, "model": MODEL_ID},
+    "small": {"base_url": SMALL_BASE_URL, "model": SMALL_MODEL_ID},
+})
+
+# Share one generation between identical history-free questions in flight ("on"/"off")
+REQUEST_COALESCING = os.environ.get("QSPARC_REQUEST_COALESCING", "on") == "on"
+# Search the question, question + structures from recent turns and structures
+# alone in parallel, fusing the rankings ("on"/"off"; see query_fanout.py)
+QUERY_FANOUT = os.environ.get("QSPARC_QUERY_FANOUT", "on") == "on"
+# /chat/batch: questions accepted per request, and items generating at once.
+# Items are spread over BATCH_LANES scheduler sessions at "batch" priority, so
+# a batch gets at most BATCH_LANES * per_session_limit model slots and
+# interactive requests still go first.
+BATCH_MAX_QUESTIONS = int(os.environ.get("QSPARC_BATCH_MAX_QUESTIONS", "1000"))
+BATCH_LANES = int(os.environ.get("QSPARC_BATCH_LANES", "4"))
+
+# Count prompt tokens before queueing and trim history/rows to fit ("on"/"off").
+# The limit is the endpoint's "max_model_len" (default QSPARC_MAX_MODEL_LEN)
+# minus its output budget.
+PROMPT_GUARD = os.environ.get("QSPARC_PROMPT_GUARD", "on") == "on"
+
+# Route simple listing / yes-no requests to the small endpoint ("on"/"off").
+# QSPARC_MODEL_ROUTES (JSON) points the "simple" / "synthesis" classes at any
+# configured endpoint, e.g. {"simple": "medium"}; checked at startup.
+MODEL_ROUTING = os.environ.get("QSPARC_MODEL_ROUTING", "off") == "on"
+MODEL_ROUTES = load_model_routes(MODEL_ENDPOINTS)
+
+# Longest a request may queue for a model slot before it is rejected (seconds)
+SCHEDULER_MAX_WAIT_S = float(os.environ.get("QSPARC_SCHEDULER_MAX_WAIT_S", "60"))
+
+# max_tokens per endpoint and question class; override via QSPARC_OUTPUT_BUDGETS (JSON)
+OUTPUT_BUDGETS = load_output_budgets()
+
+# What to do when retrieval finds nothing relevant: "template" answers without
+# any LLM call, "small_model" routes to the small model, "off" always uses the 32B model
+NO_DATA_MODE = os.environ.get("QSPARC_NO_DATA_MODE", "template")
+if NO_DATA_MODE not in NO_DATA_MODES:
+    raise ValueError(f"QSPARC_NO_DATA_MODE must be one of {list(NO_DATA_MODES)}")
+NO_DATA_MIN_RELEVANCE = float(os.environ.get("QSPARC_NO_DATA_MIN_RELEVANCE", DEFAULT_MIN_RELEVANCE))
+
+# Layout of retrieved rows in the prompt: "sentences" (one paragraph per row) or
+# "compact" (deduplicated pipe-delimited table with CURIEs; see context_format.py)
+CONTEXT_FORMAT = os.environ.get("QSPARC_CONTEXT_FORMAT", "sentences")
+if CONTEXT_FORMAT not in CONTEXT_FORMATTERS:
+    raise ValueError(f"QSPARC_CONTEXT_FORMAT must be one of {sorted(CONTEXT_FORMATTERS)}")
+
+# Data Configuration
+DATA_FILE_PATH = os.environ.get("QSPARC_DATA_FILE", '/hpc/fxu244/Documents/Code/LLMs/a-b-via-c.json')
+# Named SCKAN exports (species / releases) selectable per request; see index_registry.py.
+# Each export may have sidecar files next to it: <export>.entities.pkl (entity
+# dictionary) and <export>.answers.qsas (built with `python answer_store.py --data ...`).
+# A path may instead name an index bundle directory built offline with
+# `python lc_vector_offiline.py --data ... --out <dir>`, which is memory-mapped
+# rather than embedded at startup.
+DATASETS = load_dataset_config(DATA_FILE_PATH)
+DEFAULT_DATASET = os.environ.get("QSPARC_DEFAULT_DATASET")
+# Estimated memory loaded indexes may use before idle ones are evicted (MB, unset = no cap)
+INDEX_MEMORY_CAP_MB = os.environ.get("QSPARC_INDEX_MEMORY_CAP_MB")
+# Vector search over bundles: unset = exact float32, "int8" or "binary" = quantized
+# scan with float32 rescoring (compare recall with `retrieval_bench.py --backends bundle bundle_int8 bundle_binary`)
+VECTOR_QUANTIZATION = os.environ.get("QSPARC_VECTOR_QUANTIZATION") or None
+
+# Session histories are saved here every SESSION_SNAPSHOT_INTERVAL_S seconds and
+# at shutdown, and restored lazily after a restart (unset keeps them in memory only)
+SESSION_SNAPSHOT_PATH = os.environ.get("QSPARC_SESSION_SNAPSHOT")
+SESSION_SNAPSHOT_INTERVAL_S = float(os.environ.get("QSPARC_SESSION_SNAPSHOT_INTERVAL_S", "60"))
+# Sessions unused this long (seconds) are dropped at the next snapshot, and at most
+# SESSION_MAX_SESSIONS (the most recently used) are kept
+SESSION_TTL_S = float(os.environ.get("QSPARC_SESSION_TTL_S", str(7 * 24 * 3600)))
+SESSION_MAX_SESSIONS = int(os.environ.get("QSPARC_SESSION_MAX_SESSIONS", "50000"))
+
+# Token expected in the X-Admin-Token header of admin routes (unset disables them)
+ADMIN_TOKEN = os.environ.get("QSPARC_ADMIN_TOKEN")
+# Local copy of the whole-rat flatmap served with highlighted structures
+FLATMAP_SVG_PATH = os.environ.get(
+    "QSPARC_FLATMAP_SVG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "tutorials", "example", "whole-rat.svg"),
+)
 
-def load_and_process_documents() -> List[Document]:
-    """
-    Loads data from a JSON file, processes it into a structured format,
-    and creates LangChain Document objects ready for embedding.
-    """
-    file_path = '/hpc/fxu244/Documents/Code/LLMs/a-b-via-c.json'
-    jq_schema = '.results.bindings[]'
-    
-    print("Loading raw data from JSON...")
-    loader = JSONLoader(
-        file_path=file_path,
-        jq_schema=jq_schema,
-        text_content=False
-    )
-    raw_docs = loader.load()
-    
-    final_documents = []
-    print(f"Processing {len(raw_docs)} records...")
-    for doc in raw_docs:
-        record = json.loads(doc.page_content)
-
-        clean_data = {
-            "Neuron_ID": get_val(record, "Neuron_ID"),
-            "A_L1_ID": get_val(record, "A_L1_ID"),
-            "A_L1": get_val(record, "A_L1"),
-            "A_L2_ID": get_val(record, "A_L2_ID"),
-            "A_L2": get_val(record, "A_L2"),
-            "A_L3_ID": get_val(record, "A_L3_ID"),
-            "A_L3": get_val(record, "A_L3"),
-            "A_ID": get_val(record, "A_ID"),
-            "A": get_val(record, "A"),
-            "C_ID": get_val(record, "C_ID"),
-            "C": get_val(record, "C"),
-            "C_Type": get_val(record, "C_Type"),
-            "B_ID": get_val(record, "B_ID"),
-            "B": get_val(record, "B"),
-            "Target_Organ_IRI": get_val(record, "Target_Organ_IRI"),
-            "Target_Organ": get_val(record, "Target_Organ"),
-        }
-        
-        # Create meaningful text content for semantic search
-        page_content = (
-            f"Neuron Connection Info: Neuron ID is {clean_data['Neuron_ID']}. "
-            f"It connects from {clean_data['A']} (A_ID: {clean_data['A_ID']}) "
-            f"to {clean_data['B']} (B_ID: {clean_data['B_ID']}) "
-            f"via {clean_data['C']} (C_ID: {clean_data['C_ID']}). "
-            f"The target organ is {clean_data['Target_Organ']} (IRI: {clean_data['Target_Organ_IRI']}). "
-            f"The connection type C_Type is {clean_data['C_Type']}. "
-            f"Hierarchical structure: A_L1: {clean_data['A_L1']} (ID: {clean_data['A_L1_ID']}), "
-            f"A_L2: {clean_data['A_L2']} (ID: {clean_data['A_L2_ID']}), "
-            f"A_L3: {clean_data['A_L3']} (ID: {clean_data['A_L3_ID']})."
-        )
+# --- 2. Data Loading and Vector Store Creation (Executed on Server Startup) ---
+# The loaders live in sckan_index.py so offline tools can share them.
+
+# --- Dataset Indexes (default dataset loaded on startup, others on first use) ---
+index_registry = IndexRegistry(
+    DATASETS,
+    default=DEFAULT_DATASET,
+    memory_cap_bytes=int(INDEX_MEMORY_CAP_MB) * 2**20 if INDEX_MEMORY_CAP_MB else None,
+    loader=functools.partial(load_dataset_index, quantization=VECTOR_QUANTIZATION),
+)
+index_registry.preload(index_registry.default)
+RETRIEVAL_K = 20 # Retrieve top 20 most similar documents
 
-        # Store both the text and the structured data
-        final_documents.append(
-            Document(page_content=page_content, metadata=clean_data)
-        )
-        
-    print("Document processing complete.")
-    return final_documents
+def retrieve_docs(inputs: Dict[str, Any]) -> List[Document]:
+    """Vector search in the dataset index leased for this request."""
+    return inputs["index"].retrieve(inputs["input"], RETRIEVAL_K)
 
-def create_vector_store(documents: List[Document]) -> Chroma:
-    """
-    Initializes an embedding model and creates a Chroma vector store
-    from the processed documents.
-    """
-    print("Initializing embedding model...")
-    # Use a sentence-transformer model for creating embeddings. It runs locally.
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    
-    print("Creating Chroma vector store in memory...")
-    # Chroma is used as the vector store. It's fast and efficient for this use case.
-    vector_store = Chroma.from_documents(
-        documents=documents,
-        embedding=embeddings
-    )
-    print("Vector store created successfully!")
-    return vector_store
+# History-aware variants of the question, searched concurrently
+retriever = fanout_retriever(RETRIEVAL_K) if QUERY_FANOUT else RunnableLambda(retrieve_docs)
 
-# --- Global Vector Store and Retriever (Initialized once) ---
-processed_docs = load_and_process_documents()
-vector_store = create_vector_store(processed_docs)
-retriever = vector_store.as_retriever(search_kwargs={"k": 20}) # Retrieve top 20 most similar documents
+# Flatmap highlighting (optional; needs the local SVG)
+flatmap_service = None
+if os.path.exists(FLATMAP_SVG_PATH):
+    flatmap_service = FlatmapService(FLATMAP_SVG_PATH)
+    print(f"Flatmap ready with {len(flatmap_service.elements)} named elements.")
 
 # --- 3. Conversation History Management ---
-# This dictionary will store conversation histories for different sessions.
-store = {}
+# This store keeps conversation histories for different sessions, snapshotted
+# to SESSION_SNAPSHOT_PATH so they survive restarts (see session_snapshot.py).
+store = SessionStore(SESSION_SNAPSHOT_PATH, ttl_s=SESSION_TTL_S, max_sessions=SESSION_MAX_SESSIONS)
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
     """
-    Retrieves the chat history for a given session ID. If the session
-    doesn't exist, a new one is created.
+    Retrieves the chat history for a given session ID. A session saved before
+    a restart is restored on first access; otherwise a new one is created.
     """
-    if session_id not in store:
-        store[session_id] = ChatMessageHistory()
-    return store[session_id]
+    return store.get(session_id)
 
 # --- 4. LangChain Runnable/Chain Construction ---
 
@@ -390,15 +458,14 @@ This comprehensive list outlines the various anatomical structures that can be s
 
 
 system_prompt = """You are an expert assistant specializing in neuroscience and neural pathways. 
-Answer the user's question based on the following context and the chat history.Be concise and clear,do not output thinking stage and do not output repeat or redudant results.
+Answer the user's question based on the following context and the chat history.Be concise and clear, do not output repeat or redudant results.
 
-Do not output thinking stage, like <think> or </think>
 After completing the text answer, you must show the table (alignment) from the related database by following these rules:
 1.  Use markdown format for the table.
 2.  Ensure the data rows shown are unique.
 3.  For the long URLs in the `Origin (A_ID)`, `Destination (B_ID)`, and `Via (C_ID)` columns, replace them with short, unique aliases (e.g., A1, B1, C1). Each unique URL should have its own alias.
 4.  Immediately after the table, provide a "Legend" section that lists each alias and its corresponding full URL.
-
+""" + CONTEXT_INSTRUCTIONS[CONTEXT_FORMAT] + """
 CONTEXT:
 {context}
 """
@@ -414,35 +481,229 @@ prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-# Initialize the LLM
-model = ChatOpenAI(base_url=BASE_URL, api_key=API_KEY, model=MODEL_ID)
+# Initialize the LLMs, one client per configured endpoint. Streaming is always
+# on so that time-to-first-token can be measured, and stream_usage asks vLLM for
+# token counts in the final chunk. Qwen3 thinking is disabled through the chat
+# template unless the endpoint opts in, so no decode time goes to reasoning.
+def make_chat_model(name: str, endpoint: Dict[str, Any]) -> ChatOpenAI:
+    enable_thinking = bool(endpoint.get("enable_thinking", False))
+    return ChatOpenAI(
+        base_url=endpoint["base_url"],
+        api_key=endpoint.get("api_key", API_KEY),
+        model=endpoint["model"],
+        streaming=True,
+        stream_usage=True,
+        extra_body=thinking_request_kwargs(enable_thinking),
+        callbacks=[LatencyCallbackHandler(endpoint=name, thinking=enable_thinking)],
+    )
+
+chat_models = {name: make_chat_model(name, endpoint) for name, endpoint in MODEL_ENDPOINTS.items()}
+
+# One fair-share scheduler per endpoint; requests queue here instead of at vLLM
+schedulers = {
+    name: FairScheduler(
+        name,
+        max_concurrency=int(endpoint.get("max_concurrency", 16)),
+        per_session_limit=int(endpoint.get("per_session_limit", 2)),
+        max_wait_s=SCHEDULER_MAX_WAIT_S,
+    )
+    for name, endpoint in MODEL_ENDPOINTS.items()
+}
+model = chat_models["large"]
 
 # Standard output parser
 parser = StrOutputParser()
 
 def format_docs(docs: List[Document]) -> str:
     """Helper function to format retrieved documents into a single string."""
-    return "\n\n".join(doc.page_content for doc in docs)
+    with trace_stage("format_context"):
+        return CONTEXT_FORMATTERS[CONTEXT_FORMAT](docs)
+
+# Preflight size check against each endpoint's max_model_len (see prompt_guard.py)
+prompt_guard = PromptGuard(system_prompt, few_shot_examples, format_docs)
+
+def fit_prompt(inputs: Dict[str, Any], limit: int) -> Dict[str, Any]:
+    """Drops old history, then the lowest-scored rows, until the prompt fits."""
+    return prompt_guard.fit(inputs, limit) if PROMPT_GUARD else inputs
+
+def record_endpoint(inputs: Dict[str, Any], endpoint: str) -> Dict[str, Any]:
+    """Notes the generating endpoint in the request's "origin" (used by /chain/continue)."""
+    origin = inputs.get("origin")
+    if origin is not None:
+        origin["endpoint"] = endpoint
+    return inputs
+
+def build_prompt(inputs: Dict[str, Any]):
+    """Renders the chat prompt (system, few-shot, history, question)."""
+    with trace_stage("prompt_build"):
+        return prompt.invoke(inputs)
+
+# Prompt -> budgeted model -> text (reasoning spans stripped), built once per
+# (endpoint, question class) pair
+generation_chains = {}
+
+def generation_chain(endpoint: str, question_class: str):
+    key = (endpoint, question_class)
+    if key not in generation_chains:
+        max_tokens = output_budget(OUTPUT_BUDGETS, endpoint, question_class)
+        limit = prompt_token_limit(MODEL_ENDPOINTS[endpoint], max_tokens)
+        generation_chains[key] = (
+            RunnableLambda(lambda inputs: fit_prompt(record_endpoint(inputs, endpoint), limit))
+            | RunnableLambda(build_prompt)
+            | scheduled(chat_models[endpoint].bind(max_tokens=max_tokens), schedulers[endpoint])
+            | budget_parser(endpoint, question_class)
+            | think_filter(endpoint)
+        )
+    return generation_chains[key]
+
+def check_evidence(inputs: Dict[str, Any]):
+    """Pre-generation check of whether the retrieved rows can answer the question."""
+    with trace_stage("evidence_check"):
+        return assess_evidence(
+            inputs["input"],
+            inputs["docs"],
+            inputs["index"].entity_matcher,
+            has_history=bool(inputs.get("history")),
+            min_relevance=NO_DATA_MIN_RELEVANCE,
+        )
+
+def is_no_data(inputs: Dict[str, Any]) -> bool:
+    return NO_DATA_MODE != "off" and not inputs["evidence"].has_data
+
+def templated_no_data_answer(inputs: Dict[str, Any]) -> str:
+    record_early_answer(inputs["evidence"], "template")
+    return no_data_answer(inputs["evidence"])
+
+def route_request(inputs: Dict[str, Any]) -> RouteDecision:
+    """
+    Classifies the request (which also selects its output budget) and chooses
+    the endpoint that generates the answer.
+    """
+    decision = classify_request(inputs["input"], inputs["docs"], inputs["evidence"].entities, MODEL_ROUTES)
+    if not MODEL_ROUTING:
+        decision = decision._replace(endpoint="large")
+    record_route(decision)
+    return decision
+
+def generate(inputs: Dict[str, Any]):
+    """Hands the request to the generation chain of its routed endpoint."""
+    route = inputs["route"]
+    return generation_chain(route.endpoint, route.route)
+
+# Full generation path: retrieved rows -> context -> prompt -> routed model
+answer_chain = (
+    RunnablePassthrough.assign(
+        context=lambda x: format_docs(x["docs"]),
+        route=RunnableLambda(route_request),
+    )
+    | RunnableLambda(generate)
+)
+
+# "No results" path: a fixed reply, or the same prompt on the small model
+if NO_DATA_MODE == "small_model":
+    def mark_small_model_answer(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        record_early_answer(inputs["evidence"], "small_model")
+        return inputs
+
+    no_data_chain = (
+        RunnableLambda(mark_small_model_answer)
+        | RunnablePassthrough.assign(context=lambda x: format_docs(x["docs"]))
+        | generation_chain("small", "simple")
+    )
+else:
+    no_data_chain = RunnableLambda(templated_no_data_answer)
+
+# Retrieval-Augmented Generation path
+retrieval_chain = (
+    RunnablePassthrough.assign(docs=retriever)
+    | RunnablePassthrough.assign(evidence=RunnableLambda(check_evidence))
+    | RunnableBranch(
+        (is_no_data, no_data_chain),
+        answer_chain,
+    )
+)
+
+def lookup_precomputed(inputs: Dict[str, Any]):
+    """
+    Stored answer when a history-free question matches a canonical template,
+    else None (a follow-up may depend on earlier turns).
+    """
+    if inputs.get("history"):
+        return None
+    with trace_stage("precomputed_lookup"):
+        return precomputed_answer(inputs["index"].answer_store, inputs["input"])
 
 # Create the main RAG (Retrieval-Augmented Generation) chain
-# This chain orchestrates the entire process.
+# This chain orchestrates the entire process: template questions are answered
+# from the precomputed store, everything else goes through retrieval.
 rag_chain = (
-    RunnablePassthrough.assign(
-        context=RunnableLambda(lambda x: x["input"]) | retriever | format_docs
+    RunnablePassthrough.assign(precomputed=RunnableLambda(lookup_precomputed))
+    | RunnableBranch(
+        (lambda x: x["precomputed"] is not None, lambda x: x["precomputed"]),
+        retrieval_chain,
     )
-    | prompt
-    | model
-    | parser
 )
 
+# --- Single-flight coalescing of identical questions ---
+single_flight = SingleFlight()
+
+# Session id -> {"dataset", "endpoint"} of its last generated answer, so
+# /chain/continue resumes it with the same model over the same dataset
+answer_origins: Dict[str, Dict[str, str]] = {}
+
+def record_origin(config, origin: Dict[str, str]) -> None:
+    session_id = ((config or {}).get("configurable") or {}).get("session_id")
+    if session_id is not None and "endpoint" in origin:
+        answer_origins[session_id] = origin
+
+def rag_transform(inputs: Iterator[Dict[str, Any]], config) -> Iterator[str]:
+    """Synchronous path: no coalescing, stream the chain directly."""
+    request = list(inputs)[-1]
+    origin = {"dataset": index_registry.resolve(request.get("dataset"))}
+    with index_registry.lease(origin["dataset"]) as index:
+        for chunk in rag_chain.stream({**request, "index": index, "origin": origin}, config):
+            yield chunk
+    record_origin(config, origin)
+
+async def leased_rag_stream(request: Dict[str, Any], config) -> AsyncIterator[str]:
+    """
+    Streams the RAG chain against the selected dataset. The lease is held for
+    the whole generation, so a hot-swapped index stays open until it is done.
+    """
+    async with index_registry.alease(request.get("dataset")) as index:
+        async for chunk in rag_chain.astream({**request, "index": index}, config):
+            yield chunk
+
+async def rag_atransform(inputs: AsyncIterator[Dict[str, Any]], config) -> AsyncIterator[str]:
+    """
+    Streams the RAG chain. Requests without chat history are keyed by their
+    dataset and normalized question so concurrent duplicates share one generation.
+    """
+    request = None
+    async for item in inputs:
+        request = item
+    origin = {"dataset": index_registry.resolve(request.get("dataset"))}
+    request = {**request, "dataset": origin["dataset"], "origin": origin}
+    if not REQUEST_COALESCING or request.get("history"):
+        async for chunk in leased_rag_stream(request, config):
+            yield chunk
+    else:
+        key = f"{origin['dataset']}|{normalize_question(request['input'])}"
+        async for chunk in single_flight.stream(key, lambda: leased_rag_stream(request, config), origin):
+            yield chunk
+    record_origin(config, origin)
+
+coalesced_rag_chain = RunnableGenerator(rag_transform, rag_atransform)
+
 # Define the input type for the final chain, making it compatible with LangServe
 class InputChat(TypedDict):
     """Input for the chat endpoint."""
     input: str
+    dataset: NotRequired[str]  # configured dataset name; the default one if omitted
 
 # Wrap the RAG chain with history management
 chain_with_history = RunnableWithMessageHistory(
-    rag_chain,
+    coalesced_rag_chain,
     get_session_history,
     input_messages_key="input",
     history_messages_key="history",
@@ -456,6 +717,280 @@ app = FastAPI(
     description="An API server for querying neural connection data with conversational history.",
 )
 
+# Stop retrieval and generation for /chain and /chat requests whose client disconnected.
+# Added first so it runs inside the trace middleware and can mark the trace.
+app.add_middleware(CancelOnDisconnectMiddleware, prefixes=("/chain", "/chat"))
+
+# Sampling profiler for requests selected via POST /admin/profiling; runs
+# inside the trace middleware so profiles carry the request's stage timings
+profiler = SamplingProfiler()
+app.add_middleware(ProfilingMiddleware, profiler=profiler, prefixes=("/chain", "/chat"))
+
+# Per-stage timing for every /chain and /chat request, exported below at /metrics
+app.add_middleware(RequestTraceMiddleware, prefixes=("/chain", "/chat"), priorities=tuple(DEFAULT_CLASS_WEIGHTS))
+
+async def snapshot_sessions_periodically() -> None:
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL_S)
+        try:
+            await asyncio.to_thread(store.save)
+        except Exception:
+            logging.getLogger("qsparc.sessions").exception("Session snapshot failed")
+
+@app.on_event("startup")
+async def start_session_snapshots() -> None:
+    if SESSION_SNAPSHOT_PATH:
+        app.state.snapshot_task = asyncio.create_task(snapshot_sessions_periodically())
+
+@app.on_event("shutdown")
+async def save_sessions_on_shutdown() -> None:
+    """Runs on SIGTERM too: uvicorn shuts down gracefully and fires this hook."""
+    task = getattr(app.state, "snapshot_task", None)
+    if task is not None:
+        task.cancel()
+    if SESSION_SNAPSHOT_PATH:
+        await asyncio.to_thread(store.save)
+
+@app.exception_handler(SchedulerTimeout)
+async def scheduler_timeout_handler(request: Request, exc: SchedulerTimeout) -> JSONResponse:
+    """Queue wait exceeded: tell the client to retry later instead of failing with 500."""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
+
+@app.exception_handler(PromptTooLarge)
+async def prompt_too_large_handler(request: Request, exc: PromptTooLarge) -> JSONResponse:
+    """Question too long for the model even without history and rows."""
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+@app.exception_handler(UnknownDataset)
+async def unknown_dataset_handler(request: Request, exc: UnknownDataset) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={"detail": f"Unknown dataset {exc.args[0]!r}", "datasets": sorted(DATASETS)},
+    )
+
+def require_admin(request: Request) -> None:
+    """Dependency of admin routes: the X-Admin-Token header must match QSPARC_ADMIN_TOKEN."""
+    token = request.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required.")
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+class ContinueRequest(BaseModel):
+    """
+    Input for the continuation endpoint. `endpoint` and `dataset` default to
+    the ones that produced the truncated answer.
+    """
+    session_id: str
+    endpoint: Optional[str] = None
+    dataset: Optional[str] = None
+
+@app.post("/chain/continue")
+async def continue_answer(request: ContinueRequest) -> Dict[str, Any]:
+    """
+    Resumes the last answer of a session that stopped at its output budget.
+    The partial answer is sent back as the final assistant message and vLLM
+    continues it in place; the stored history is updated with the result.
+    """
+    history = get_session_history(request.session_id)
+    messages = history.messages
+    if len(messages) < 2 or not isinstance(messages[-1], AIMessage) or not is_truncated(messages[-1].content):
+        return {"output": "", "truncated": False, "detail": "The last answer in this session was not truncated."}
+
+    origin = answer_origins.get(request.session_id, {})
+    endpoint_name = request.endpoint or origin.get("endpoint", "large")
+    if endpoint_name not in MODEL_ENDPOINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown endpoint {endpoint_name!r}; configured: {sorted(MODEL_ENDPOINTS)}",
+        )
+    question = messages[-2].content
+    partial = strip_truncation_marker(messages[-1].content)
+    async with index_registry.alease(request.dataset or origin.get("dataset")) as index:
+        # Same retrieval as the original answer (fan-out over the earlier turns)
+        docs = await retriever.ainvoke({"input": question, "history": messages[:-2], "index": index})
+    endpoint = MODEL_ENDPOINTS[endpoint_name]
+    max_tokens = output_budget(OUTPUT_BUDGETS, endpoint_name, "synthesis")
+    # The partial answer is part of the prompt as well
+    limit = prompt_token_limit(endpoint, max_tokens) - segment_tokens(partial)
+    inputs = fit_prompt({"input": question, "history": messages[:-2], "docs": docs}, limit)
+    if "context" not in inputs:
+        inputs["context"] = format_docs(docs)
+    prompt_value = await RunnableLambda(build_prompt).ainvoke(inputs)
+
+    continuation_model = chat_models[endpoint_name].bind(
+        max_tokens=max_tokens,
+        extra_body={
+            **thinking_request_kwargs(bool(endpoint.get("enable_thinking", False))),
+            "add_generation_prompt": False,
+            "continue_final_message": True,
+        },
+    )
+    # No think filter here: it would trim the leading whitespace of the continuation
+    continuation_chain = continuation_model | budget_parser(endpoint_name, "continuation")
+    _, priority = request_identity(None)
+    async with schedulers[endpoint_name].slot(request.session_id, priority):
+        continuation = await continuation_chain.ainvoke(
+            prompt_value.to_messages() + [AIMessage(content=partial)]
+        )
+
+    messages[-1] = AIMessage(content=partial + continuation)
+    return {"output": continuation, "truncated": is_truncated(continuation)}
+
+class FlatmapRequest(BaseModel):
+    """Structures to highlight, given by name or as a response table."""
+    structures: List[str] = Field(default_factory=list)
+    table_data: Optional[Dict[str, Any]] = None
+
+FLATMAP_CACHE_HEADERS = {"Cache-Control": "public, max-age=86400, immutable"}
+
+@app.post("/flatmap")
+def highlight_flatmap(request: FlatmapRequest) -> Dict[str, Any]:
+    """
+    Highlights the given structures on the flatmap and returns cacheable URLs
+    of the result, instead of clients fetching and restyling the full SVG.
+    """
+    if flatmap_service is None:
+        return JSONResponse(status_code=404, content={"detail": "No flatmap SVG is configured."})
+    variant = flatmap_service.highlight(request.structures + structures_from_table(request.table_data))
+    return {
+        "svg_url": f"/flatmap/{variant.key}.svg",
+        "thumbnail_url": f"/flatmap/{variant.key}.png" if variant.png is not None else None,
+        "highlighted": sorted(variant.ids),
+    }
+
+@app.get("/flatmap/{key}.svg")
+def flatmap_svg(key: str, request: Request) -> Response:
+    variant = flatmap_service.get(key) if flatmap_service is not None else None
+    if variant is None:
+        return JSONResponse(status_code=404, content={"detail": "Unknown flatmap variant."})
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(
+            variant.svg_gzip,
+            media_type="image/svg+xml",
+            headers={**FLATMAP_CACHE_HEADERS, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return Response(gzip.decompress(variant.svg_gzip), media_type="image/svg+xml", headers=FLATMAP_CACHE_HEADERS)
+
+@app.get("/flatmap/{key}.png")
+def flatmap_thumbnail(key: str) -> Response:
+    variant = flatmap_service.get(key) if flatmap_service is not None else None
+    if variant is None or variant.png is None:
+        return JSONResponse(status_code=404, content={"detail": "No thumbnail for this flatmap variant."})
+    return Response(variant.png, media_type="image/png", headers=FLATMAP_CACHE_HEADERS)
+
+class BatchQuestion(BaseModel):
+    """One question of a batch; `id` is echoed back to match results to questions."""
+    input: str
+    id: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    """Input for the batch endpoint: plain strings or {"input", "id"} objects."""
+    questions: List[Union[str, BatchQuestion]]
+    dataset: Optional[str] = None
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchRequest) -> StreamingResponse:
+    """
+    Answers many history-free questions in one request. Template questions
+    come from the precomputed store, the rest share one vectorized retrieval
+    pass and then generate concurrently under the model schedulers. Results
+    stream back as NDJSON lines {"index", "id", "output", "source"} (or
+    {"index", "id", "error"}) in completion order.
+    """
+    if len(request.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch.")
+    items = [
+        {"index": i, "input": q, "id": None} if isinstance(q, str) else {"index": i, "input": q.input, "id": q.id}
+        for i, q in enumerate(request.questions)
+    ]
+    # Unknown datasets are a 404 before the stream starts, not a truncated stream
+    dataset = index_registry.resolve(request.dataset)
+    BATCH_SIZE.observe(len(items))
+    trace = current_trace()
+    if trace is not None:
+        trace.set(priority="batch", batch_size=len(items))
+    lanes = [f"batch-{trace.request_id if trace is not None else id(request)}-{n}" for n in range(BATCH_LANES)]
+    endpoint_slots = min(int(e.get("per_session_limit", 2)) for e in MODEL_ENDPOINTS.values())
+
+    async def stream() -> AsyncIterator[bytes]:
+        async with AsyncExitStack() as stack:
+            # Failures of the shared steps become an error line for each item they affect
+            index = None
+            try:
+                index = await stack.enter_async_context(index_registry.alease(dataset))
+                for item in items:
+                    item["precomputed"] = lookup_precomputed({"input": item["input"], "index": index})
+            except Exception as exc:
+                logging.getLogger("qsparc.requests").exception("Batch setup failed for dataset %s", dataset)
+                for item in items:
+                    item["error"] = exc
+            pending = [item for item in items if "error" not in item and item["precomputed"] is None]
+            if pending:
+                try:
+                    retrieved = await asyncio.to_thread(
+                        index.retrieve_many, [item["input"] for item in pending], RETRIEVAL_K)
+                    for item, docs in zip(pending, retrieved):
+                        item["docs"] = docs
+                except Exception as exc:
+                    logging.getLogger("qsparc.requests").exception("Batch retrieval failed for dataset %s", dataset)
+                    for item in pending:
+                        item["error"] = exc
+
+            async def answer(item: Dict[str, Any]) -> Dict[str, Any]:
+                if "error" in item:
+                    raise item["error"]
+                if item["precomputed"] is not None:
+                    return {"output": item["precomputed"], "source": "precomputed"}
+                config = {"configurable": {"session_id": lanes[item["index"] % len(lanes)]}}
+                inputs = {"input": item["input"], "history": [], "docs": item["docs"], "index": index}
+                inputs["evidence"] = check_evidence(inputs)
+                if is_no_data(inputs):
+                    return {"output": await no_data_chain.ainvoke(inputs, config), "source": "no_data"}
+                return {"output": await answer_chain.ainvoke(inputs, config), "source": "generated"}
+
+            async for line in stream_in_completion_order(items, answer, len(lanes) * endpoint_slots):
+                yield line
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/indexes")
+def list_indexes() -> List[Dict[str, Any]]:
+    """Configured datasets and the state of their indexes."""
+    return index_registry.stats()
+
+@app.post("/indexes/{name}/reload", status_code=202, dependencies=[Depends(require_admin)])
+def reload_index(name: str, background_tasks: BackgroundTasks, source_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Rebuilds a dataset index in the background and swaps it in atomically;
+    in-flight requests finish on the old generation.
+    """
+    name = index_registry.resolve(name)
+    background_tasks.add_task(index_registry.reload, name, source_path)
+    return {"dataset": name, "status": "reloading"}
+
+class ProfilingRequest(BaseModel):
+    """Profile the next `requests` requests and a `sample_rate` fraction of the rest; zeros disarm."""
+    requests: int = Field(default=0, ge=0)
+    sample_rate: float = Field(default=0.0, ge=0.0, le=1.0)
+
+@app.get("/admin/profiling", dependencies=[Depends(require_admin)])
+def profiling_status() -> Dict[str, Any]:
+    """Arming state of the profiler and the most recently written profiles."""
+    return profiler.status()
+
+@app.post("/admin/profiling", dependencies=[Depends(require_admin)])
+def arm_profiling(request: ProfilingRequest) -> Dict[str, Any]:
+    """
+    Turns on sampling profiling for the selected /chain and /chat requests.
+    Each one is written to QSPARC_PROFILE_DIR as <stem>.collapsed and
+    <stem>.speedscope.json; the request ID is recorded inside the JSON.
+    """
+    return profiler.arm(request.requests, request.sample_rate)
+
 # Add the runnable to the FastAPI app, making it available at the /chain endpoint
 add_routes(
     app,
@@ -0,0 +1,229 @@
+import os
+import json
+import mmap
+import zlib
+import time
+import struct
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_community.chat_message_histories import ChatMessageHistory
+
+from request_metrics import Counter, Gauge
+
+try:
+    import msgpack
+except ImportError:  # JSON is used instead
+    msgpack = None
+
+# --- Session history snapshots ---
+# Chat histories live in memory, so a redeploy used to drop every
+# conversation. SessionStore replaces the plain dict of histories: it writes
+# a snapshot file periodically and at shutdown (uvicorn turns SIGTERM into a
+# graceful shutdown), and after a restart it memory-maps the last snapshot
+# and only decodes a session when that session is first used, so boot time
+# does not grow with the snapshot.
+#
+# File layout (same scheme as answer_store.py): MAGIC, 8-byte little-endian
+# offset of the index, one zlib-compressed blob per session back to back,
+# then the zlib-compressed JSON index
+# {"codec", "sessions": {id: [offset, length, last used (unix time)]}}.
+# A blob is the session's [[type, content], ...] list in msgpack, or JSON
+# when msgpack is not installed. Sessions never touched since the restart are
+# copied into the next snapshot as raw bytes, without decoding.
+#
+# Each save also expires sessions: those unused for longer than `ttl_s` are
+# dropped from memory and from the snapshot, and beyond `max_sessions` the
+# least recently used ones go first.
+
+MAGIC = b"QSSS1\n"
+_HEADER = struct.Struct("<Q")
+_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+logger = logging.getLogger("qsparc.sessions")
+
+SESSION_RESTORES = Counter(
+    "qsparc_session_restores_total",
+    "Session histories restored from the snapshot on first use after a restart.",
+)
+SESSIONS_IN_MEMORY = Gauge(
+    "qsparc_sessions_in_memory",
+    "Session histories currently decoded in memory.",
+)
+
+
+def _encode(messages: List[BaseMessage], codec: str) -> bytes:
+    pairs = [[m.type, m.content] for m in messages if m.type in _MESSAGE_TYPES]
+    raw = msgpack.packb(pairs, use_bin_type=True) if codec == "msgpack" else json.dumps(pairs).encode("utf-8")
+    return zlib.compress(raw, 6)
+
+
+def _decode(blob: bytes, codec: str) -> List[BaseMessage]:
+    raw = zlib.decompress(blob)
+    pairs = msgpack.unpackb(raw, raw=False) if codec == "msgpack" else json.loads(raw)
+    return [_MESSAGE_TYPES[kind](content=content) for kind, content in pairs]
+
+
+class _Snapshot:
+    """A snapshot file, memory-mapped; entries are decoded on request."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not a session snapshot")
+        (index_offset,) = _HEADER.unpack_from(self._mm, len(MAGIC))
+        index = json.loads(zlib.decompress(self._mm[index_offset:]))
+        self.codec = index["codec"]
+        # Older snapshots have no last-used time; the file's age stands in for it
+        saved_at = os.path.getmtime(path)
+        self.entries: Dict[str, Tuple[int, int]] = {}
+        self.last_used: Dict[str, float] = {}
+        for key, span in index["sessions"].items():
+            self.entries[key] = (span[0], span[1])
+            self.last_used[key] = span[2] if len(span) > 2 else saved_at
+
+    def raw(self, session_id: str) -> Optional[bytes]:
+        span = self.entries.get(session_id)
+        return None if span is None else self._mm[span[0]:span[0] + span[1]]
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class SessionStore:
+    """
+    Session id -> ChatMessageHistory, backed by an optional snapshot file.
+    `get` restores a session from the snapshot the first time it is used.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl_s: Optional[float] = None, max_sessions: Optional[int] = None):
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        self.codec = "msgpack" if msgpack is not None else "json"
+        self._sessions: Dict[str, ChatMessageHistory] = {}
+        self._last_used: Dict[str, float] = {}
+        # Session id -> (fingerprint, blob) of its last written form
+        self._encoded: Dict[str, Tuple[int, bytes]] = {}
+        self._snapshot: Optional[_Snapshot] = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                self._snapshot = _Snapshot(path)
+                logger.info("Session snapshot %s: %d sessions available", path, len(self._snapshot.entries))
+            except (OSError, ValueError, zlib.error) as exc:
+                logger.warning("Ignoring unreadable session snapshot %s: %s", path, exc)
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._sessions or (
+            self._snapshot is not None and session_id in self._snapshot.entries)
+
+    def __len__(self) -> int:
+        restorable = set(self._snapshot.entries) if self._snapshot is not None else set()
+        return len(restorable | set(self._sessions))
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        self._last_used[session_id] = time.time()
+        history = self._sessions.get(session_id)
+        if history is not None:
+            return history
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = ChatMessageHistory()
+                blob = self._snapshot.raw(session_id) if self._snapshot is not None else None
+                if blob is not None:
+                    history.add_messages(_decode(blob, self._snapshot.codec))
+                    SESSION_RESTORES.inc()
+                self._sessions[session_id] = history
+                SESSIONS_IN_MEMORY.set(len(self._sessions))
+        return history
+
+    def _blob(self, session_id: str, messages: List[BaseMessage]) -> bytes:
+        # Hash of every message, so appends and in-place rewrites (e.g. by
+        # /chain/continue) are both caught; far cheaper than re-compressing
+        fingerprint = hash(tuple((m.type, str(m.content)) for m in messages))
+        cached = self._encoded.get(session_id)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        blob = _encode(messages, self.codec)
+        self._encoded[session_id] = (fingerprint, blob)
+        return blob
+
+    def _expire(self) -> Dict[str, float]:
+        """
+        Drops expired and surplus sessions from memory; returns last-used times
+        of the sessions to keep (in memory or only in the snapshot).
+        """
+        previous = self._snapshot
+        last_used = dict(previous.last_used) if previous is not None else {}
+        for session_id in list(self._sessions):
+            last_used[session_id] = self._last_used.get(session_id, time.time())
+        keep = sorted(last_used, key=last_used.get, reverse=True)
+        if self.ttl_s is not None:
+            cutoff = time.time() - self.ttl_s
+            keep = [session_id for session_id in keep if last_used[session_id] >= cutoff]
+        if self.max_sessions is not None:
+            keep = keep[:self.max_sessions]
+        kept = {session_id: last_used[session_id] for session_id in keep}
+        expired = [session_id for session_id in last_used if session_id not in kept]
+        with self._lock:
+            for session_id in expired:
+                self._sessions.pop(session_id, None)
+                self._last_used.pop(session_id, None)
+                self._encoded.pop(session_id, None)
+            SESSIONS_IN_MEMORY.set(len(self._sessions))
+        if expired:
+            logger.info("Expired %d idle sessions", len(expired))
+        return kept
+
+    def save(self) -> int:
+        """Writes a snapshot atomically; returns the number of sessions written."""
+        if not self.path:
+            return 0
+        with self._write_lock:
+            started = time.perf_counter()
+            kept = self._expire()
+            blobs: Dict[str, bytes] = {}
+            previous = self._snapshot
+            if previous is not None:
+                for session_id in previous.entries:
+                    if session_id not in kept:
+                        continue
+                    blob = previous.raw(session_id)
+                    if previous.codec != self.codec:
+                        blob = _encode(_decode(blob, previous.codec), self.codec)
+                    blobs[session_id] = blob
+            for session_id, history in list(self._sessions.items()):
+                if session_id in kept:
+                    blobs[session_id] = self._blob(session_id, list(history.messages))
+
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            index, offset = {}, len(MAGIC) + _HEADER.size
+            with open(tmp_path, "wb") as f:
+                f.write(MAGIC)
+                f.write(_HEADER.pack(0))
+                for session_id, blob in blobs.items():
+                    f.write(blob)
+                    index[session_id] = [offset, len(blob), kept[session_id]]
+                    offset += len(blob)
+                f.write(zlib.compress(json.dumps({"codec": self.codec, "sessions": index}).encode("utf-8"), 6))
+                f.seek(len(MAGIC))
+                f.write(_HEADER.pack(offset))
+            os.replace(tmp_path, self.path)
+
+            # Later restores read the new file
+            snapshot = _Snapshot(self.path)
+            with self._lock:
+                self._snapshot = snapshot
+                if previous is not None:
+                    previous.close()
+            logger.info("Saved %d sessions to %s in %.3fs", len(blobs), self.path, time.perf_counter() - started)
+            return len(blobs)
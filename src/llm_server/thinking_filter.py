@@ -0,0 +1,133 @@
+from typing import AsyncIterator, Iterator, List
+
+from langchain_core.runnables import RunnableGenerator
+
+from request_metrics import Counter, current_trace
+from token_counter import count_tokens
+
+# --- Qwen3 reasoning control ---
+# Thinking is switched off per endpoint through vLLM's chat-template kwargs
+# (see thinking_request_kwargs). The stream filter below is the safety net:
+# it removes any residual <think>...</think> span, and any stray closing tag,
+# before text reaches clients, even when a tag is split across chunks.
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+THINK_TOKENS_STRIPPED = Counter(
+    "qsparc_think_tokens_stripped_total",
+    "Reasoning tokens removed from model output before reaching clients.",
+    ["endpoint"],
+)
+
+
+def thinking_request_kwargs(enable_thinking: bool) -> dict:
+    """extra_body for vLLM's OpenAI server that toggles Qwen3 reasoning."""
+    return {"chat_template_kwargs": {"enable_thinking": enable_thinking}}
+
+
+def _partial_tag_suffix(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of tag."""
+    for k in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:k]):
+            return k
+    return 0
+
+
+class ThinkStripper:
+    """Incremental remover of <think>...</think> spans from streamed text."""
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+        self._emitted = False
+        self.stripped: List[str] = []
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        out = []
+        while self._buffer:
+            if self._in_think:
+                idx = self._buffer.find(THINK_CLOSE)
+                if idx < 0:
+                    keep = _partial_tag_suffix(self._buffer, THINK_CLOSE)
+                    self.stripped.append(self._buffer[: len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self.stripped.append(self._buffer[:idx])
+                self._buffer = self._buffer[idx + len(THINK_CLOSE):]
+                self._in_think = False
+                continue
+
+            open_idx = self._buffer.find(THINK_OPEN)
+            close_idx = self._buffer.find(THINK_CLOSE)
+            if open_idx < 0 and close_idx < 0:
+                keep = max(
+                    _partial_tag_suffix(self._buffer, THINK_OPEN),
+                    _partial_tag_suffix(self._buffer, THINK_CLOSE),
+                )
+                out.append(self._buffer[: len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+            if close_idx >= 0 and (open_idx < 0 or close_idx < open_idx):
+                # Stray closing tag (reasoning opened in the prompt): drop the tag
+                out.append(self._buffer[:close_idx])
+                self._buffer = self._buffer[close_idx + len(THINK_CLOSE):]
+            else:
+                out.append(self._buffer[:open_idx])
+                self._buffer = self._buffer[open_idx + len(THINK_OPEN):]
+                self._in_think = True
+        return self._emit("".join(out))
+
+    def flush(self) -> str:
+        """Returns whatever is still buffered; an unterminated think span is dropped."""
+        tail, self._buffer = self._buffer, ""
+        if self._in_think:
+            self.stripped.append(tail)
+            return ""
+        return self._emit(tail)
+
+    def _emit(self, text: str) -> str:
+        # Answers should not start with the blank lines that follow </think>
+        if not self._emitted:
+            text = text.lstrip()
+            self._emitted = bool(text)
+        return text
+
+    def record(self, endpoint: str) -> None:
+        stripped = "".join(self.stripped)
+        if not stripped:
+            return
+        tokens = count_tokens(stripped)
+        THINK_TOKENS_STRIPPED.inc(endpoint, amount=tokens)
+        trace = current_trace()
+        if trace is not None:
+            trace.set(think_tokens_stripped=tokens)
+
+
+def think_filter(endpoint: str) -> RunnableGenerator:
+    """Runnable stage that strips reasoning spans from a stream of strings."""
+
+    def transform(chunks: Iterator[str]) -> Iterator[str]:
+        stripper = ThinkStripper()
+        for chunk in chunks:
+            text = stripper.feed(chunk)
+            if text:
+                yield text
+        tail = stripper.flush()
+        if tail:
+            yield tail
+        stripper.record(endpoint)
+
+    async def atransform(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        stripper = ThinkStripper()
+        async for chunk in chunks:
+            text = stripper.feed(chunk)
+            if text:
+                yield text
+        tail = stripper.flush()
+        if tail:
+            yield tail
+        stripper.record(endpoint)
+
+    return RunnableGenerator(transform, atransform)
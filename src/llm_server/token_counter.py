@@ -0,0 +1,33 @@
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+# --- Token counting with the served model's tokenizer ---
+# The tokenizer is loaded from the local model directory only (never from the
+# network). Without transformers or the model files we fall back to a regex
+# estimate that slightly over-counts, which is the safe direction for budgets.
+
+TOKENIZER_PATH = os.environ.get("QSPARC_TOKENIZER_PATH", "/hpc/fxu244/Documents/Code/LLMs/Qwen3-32B")
+
+# Words, numbers and single punctuation marks; IRIs split into many pieces
+_APPROX_TOKEN_RE = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(path: str = TOKENIZER_PATH):
+    """Returns the cached Hugging Face tokenizer, or None if unavailable."""
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(path, local_files_only=True)
+    except Exception as e:
+        print(f"Tokenizer unavailable at {path} ({e}); using approximate token counts.")
+        return None
+
+
+def count_tokens(text: str, tokenizer_path: Optional[str] = None) -> int:
+    """Number of tokens in text according to the model tokenizer."""
+    tokenizer = get_tokenizer(tokenizer_path or TOKENIZER_PATH)
+    if tokenizer is None:
+        return len(_APPROX_TOKEN_RE.findall(text))
+    return len(tokenizer.encode(text, add_special_tokens=False))
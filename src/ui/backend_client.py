@@ -0,0 +1,223 @@
+import os
+import json
+import socket
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+# --- HTTP client for the chat backend ---
+# One pooled keep-alive session per Streamlit process, shared by all browser
+# sessions. Every call has connect/read timeouts, and 429/503 responses
+# (rate limit, scheduler queue full) are retried a bounded number of times
+# with exponential backoff, honouring Retry-After. Calls run on a small thread
+# pool so the Streamlit script can poll a Future instead of blocking on the
+# network. A superseded call is aborted by shutting down the socket it is
+# waiting on, so the server sees the disconnect and stops generating; the
+# other pooled connections stay open.
+
+BACKEND_URL = os.environ.get("QSPARC_BACKEND_URL", "http://localhost:7777/chat")
+# Flatmap highlighting service of the LLM server (see llm_server/flatmap_service.py)
+FLATMAP_URL = os.environ.get("QSPARC_FLATMAP_URL", "http://localhost:1237/flatmap")
+CONNECT_TIMEOUT_S = float(os.environ.get("QSPARC_BACKEND_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT_S = float(os.environ.get("QSPARC_BACKEND_READ_TIMEOUT", "180"))
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5  # sleeps 0.5s, 1s, 2s between attempts
+RETRY_STATUSES = (429, 503)
+POOL_SIZE = 8
+
+
+class BackendError(Exception):
+    """Non-200 response from the chat backend (after retries)."""
+
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Server Error {status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+# PendingReply of the call running on the current worker thread
+_in_flight = threading.local()
+
+
+class _TrackedConnectionMixin:
+    """Registers the connection with the current thread's PendingReply before each request."""
+
+    def request(self, *args, **kwargs):
+        reply = getattr(_in_flight, "reply", None)
+        if reply is not None:
+            reply._track(self)
+        return super().request(*args, **kwargs)
+
+
+class _TrackedHTTPConnection(_TrackedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TrackedHTTPSConnection(_TrackedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TrackedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+
+class _TrackedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TrackedHTTPConnectionPool,
+            "https": _TrackedHTTPSConnectionPool,
+        }
+
+
+class PendingReply:
+    """
+    A submitted call: `future` holds its result. cancel() drops a call that
+    has not started and aborts one in flight by shutting down its socket.
+    """
+
+    def __init__(self):
+        self.future: Optional[Future] = None
+        self.cancelled = False
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self) -> Dict[str, Any]:
+        return self.future.result()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            connections, self._connections = self._connections, []
+        self.future.cancel()
+        for connection in connections:
+            _shutdown(connection)
+
+    def _track(self, connection) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._connections.append(connection)
+                return
+        _shutdown(connection)
+
+
+def _shutdown(connection) -> None:
+    # Wakes the worker blocked on the socket (it fails with a connection
+    # error) and sends the server a FIN; urllib3 then discards the connection.
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class BackendClient:
+    def __init__(
+        self,
+        url: str = BACKEND_URL,
+        timeout: Tuple[float, float] = (CONNECT_TIMEOUT_S, READ_TIMEOUT_S),
+        max_retries: int = MAX_RETRIES,
+        pool_size: int = POOL_SIZE,
+        flatmap_url: str = FLATMAP_URL,
+    ):
+        self.url = url
+        self.flatmap_url = flatmap_url
+        self.timeout = timeout
+        retry = Retry(
+            total=max_retries,
+            # POST is only safe to retry when the server did no work: a
+            # refused connection or a 429/503 from the queue. A read timeout
+            # or dropped connection may come after the answer was generated
+            # and stored, so those are never retried.
+            connect=max_retries,
+            read=0,
+            other=0,
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = _TrackedAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="qsparc-backend")
+
+    def chat(self, message: str, session_id: str) -> Dict[str, Any]:
+        """Blocking call; returns the decoded response or raises BackendError."""
+        response = self.session.post(
+            self.url,
+            json={"input": message, "session_id": session_id},
+            timeout=self.timeout,
+        )
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        result = response.json()
+        # The backend may send the payload as a JSON-encoded string
+        if isinstance(result, str):
+            result = json.loads(result)
+        return result
+
+    def flatmap_image_url(self, table_data: Optional[Dict[str, Any]]) -> Optional[str]:
+        """
+        URL of the flatmap with the table's structures highlighted: the PNG
+        thumbnail if the server can rasterize, else the cached SVG. None when
+        there is nothing to show or the service is unavailable.
+        """
+        if not table_data or not table_data.get("rows"):
+            return None
+        try:
+            response = self.session.post(
+                self.flatmap_url,
+                json={"table_data": table_data},
+                timeout=(self.timeout[0], 10),
+            )
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        urls = response.json()
+        return urljoin(self.flatmap_url, urls.get("thumbnail_url") or urls["svg_url"])
+
+    def _reply(self, reply: PendingReply, message: str, session_id: str, with_flatmap: bool) -> Dict[str, Any]:
+        _in_flight.reply = reply
+        try:
+            result = self.chat(message, session_id)
+            if with_flatmap and not reply.cancelled:
+                result["flatmap_image_url"] = self.flatmap_image_url(result.get("table_data"))
+            return result
+        finally:
+            _in_flight.reply = None
+
+    def submit(self, message: str, session_id: str, with_flatmap: bool = False) -> PendingReply:
+        """
+        Runs `chat` on the client's thread pool; with_flatmap also fetches the
+        highlighted flatmap URL for the answer's table ("flatmap_image_url").
+        """
+        reply = PendingReply()
+        reply.future = self._executor.submit(self._reply, reply, message, session_id, with_flatmap)
+        return reply
+
+
+@lru_cache(maxsize=None)
+def get_client() -> BackendClient:
+    """Process-wide client, so connections are reused across reruns and users."""
+    return BackendClient()
@@ -1,10 +1,12 @@
 import json
-import re
 
 import streamlit as st
 import requests
-import pandas as pd
 import time
+import uuid
+
+from backend_client import get_client
+from rendering import bot_image_message, bot_table_message, bot_text_message, render_history, user_message
 
 st.set_page_config(layout="centered")
 
@@ -15,66 +17,17 @@ if "chat_history" not in st.session_state:
 if "pending_bot_reply" not in st.session_state:
     st.session_state.pending_bot_reply = False
 
+# One server-side conversation history per browser session
+if "session_id" not in st.session_state:
+    st.session_state.session_id = f"ui-{uuid.uuid4().hex}"
+
 
 st.markdown("### 🤖 Ask Q-SPARC, Know More.")
 
 # Display Chat History
+# Messages carry pre-rendered HTML (see rendering.py), so a rerun only re-emits it
 with st.container():
-
-    for msg in st.session_state.chat_history:
-        if msg["role"] == "user":
-            st.markdown(f"<div style='text-align: right; background-color: #dbe9ff; padding: 10px; border-radius: 10px; margin: 5px 0;'>{msg['content']}</div>", unsafe_allow_html=True)
-        else:
-            if msg["type"] == "table":
-                data_table = msg['content']
-                df = pd.DataFrame(data_table["rows"], columns=data_table["head"])
-                # Custom CSS for styling links
-                st.markdown(
-                    """
-                    <style>
-                    .custom-link {
-                        color: blue; /* Link color */
-                        text-decoration: underline; /* Add underline */
-                    }
-                    .custom-table {
-                        width: 100%;
-                        max-width: 100%;
-                        overflow-x: auto;
-                        display: block;
-                    }
-                    .custom-table th, .custom-table td {
-                        white-space: nowrap;
-                        text-align: center;
-                    }
-                    </style>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-                # Process each element to check for URLs
-                for index, row in df.iterrows():
-                    for col in df.columns:
-                        if re.match(r'https?://', str(row[col])):  # Check if the element is a URL
-                            last_part = row[col].split("/")[-1]
-                            print(last_part)  # 输出: neuron-type-keast-3
-                            df.at[index, col] = f'<a class="custom-link" href="{row[col]}" target="_blank">{last_part}</a>'
-
-                # Set index to start from 1
-                df.index = df.index + 1
-                # Render the table with HTML links
-                st.markdown(df.to_html(classes='custom-table', escape=False, index=True), unsafe_allow_html=True)
-            elif msg["type"] == "image":
-                img_url = msg['content']
-                st.markdown(
-                    f"""
-                    <div style='text-align: left;'>
-                        <img src="{img_url}" style="max-width: 600px; height: auto;">
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-            else:
-                st.markdown(f"<div style='text-align: left; background-color: #f1f0f0; padding: 10px; border-radius: 10px; margin: 5px 0;'>{msg['content']}</div>", unsafe_allow_html=True)
+    render_history(st.session_state.chat_history)
 
     if st.session_state.pending_bot_reply:
         st.markdown("<div style='text-align: left; color: gray; font-style: italic; margin: 5px 0;'>🤖 Q-SPARC is thinking...</div>", unsafe_allow_html=True)
@@ -86,13 +39,13 @@ with st.container():
 user_input = st.chat_input("How can I help you today?")
 
 if user_input:
-    st.session_state.chat_history.append({"role": "user", "type": "text", "content": user_input})
+    st.session_state.chat_history.append(user_message(user_input, color="#dbe9ff"))
     st.session_state.pending_bot_reply = True
     st.rerun()
 
 # if submitted and user_input.strip() != "":
 #     # Append user message and trigger bot reply
-#     st.session_state.chat_history.append({"role": "user", "type": "text", "content": user_input})
+#     st.session_state.chat_history.append(user_message(user_input, color="#dbe9ff"))
 #     st.session_state.pending_bot_reply = True
 #     st.rerun()
 
@@ -102,7 +55,7 @@ if st.session_state.pending_bot_reply:
 
     payload = {
         "input": last_user_input,
-        "session_id": "user123_session456"
+        "session_id": st.session_state.session_id
     }
 
     # try:
@@ -210,24 +163,21 @@ if st.session_state.pending_bot_reply:
     flatmap_metadata = result.get("flatmap_metadata", "")
 
     bot_message = generated_text
-    st.session_state.chat_history.append({"role": "bot", "type": "text", "content": bot_message})
-    st.session_state.chat_history.append({
-            "role": "bot",
-            "type": "table",
-            "content": table_data
-        })
-    st.session_state.chat_history.append({
-        "role": "bot",
-        "type": "image",
-        "content": flatmap_metadata
-    })
+    st.session_state.chat_history.append(bot_text_message(bot_message))
+    # Links and HTML are built here, once, not on every rerun
+    table_message = bot_table_message(table_data)
+    if table_message is not None:
+        st.session_state.chat_history.append(table_message)
+    # Prefer the server's cached, highlighted flatmap over the full remote SVG
+    flatmap_image_url = get_client().flatmap_image_url(table_data) or flatmap_metadata
+    st.session_state.chat_history.append(bot_image_message(flatmap_image_url, max_width=600))
 
     #     else:
     #         error_msg = f"❌ Server Error {response.status_code}: {response.text}"
-    #         st.session_state.chat_history.append({"role": "bot", "type": "text", "content": error_msg})
+    #         st.session_state.chat_history.append(bot_text_message(error_msg))
     #
     # except Exception as e:
-    #     st.session_state.chat_history.append({"role": "bot", "type": "text", "content": f"Error: {e}"})
+    #     st.session_state.chat_history.append(bot_text_message(f"Error: {e}"))
 
     st.session_state.pending_bot_reply = False
     st.rerun()
@@ -1,13 +1,15 @@
-import json
-import re
+import uuid
 
 import streamlit as st
-import requests
-import pandas as pd
-import time
+
+from backend_client import BackendError, get_client
+from rendering import bot_image_message, bot_table_message, bot_text_message, render_history, user_message
 
 st.set_page_config(layout="centered")
 
+# How often a pending reply is checked (seconds)
+POLL_INTERVAL_S = 0.3
+
 # --- Session State Setup ---
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
@@ -15,69 +17,73 @@ if "chat_history" not in st.session_state:
 if "pending_bot_reply" not in st.session_state:
     st.session_state.pending_bot_reply = False
 
+# In-flight backend call (backend_client.PendingReply) for the pending reply
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = None
+
+# One server-side conversation history per browser session
+if "session_id" not in st.session_state:
+    st.session_state.session_id = f"ui-{uuid.uuid4().hex}"
+
+
+# --- Handle Bot Reply After Rerun ---
+# The request runs on the backend client's thread pool and await_bot_reply
+# polls it, so the script thread never blocks on the network. The full rerun
+# the fragment starts once the reply is in adds it to the history here,
+# before the history is rendered.
+if st.session_state.pending_bot_reply and st.session_state.pending_reply is None:
+    last_user_input = next((msg["content"] for msg in reversed(st.session_state.chat_history) if msg["role"] == "user"), "")
+    st.session_state.pending_reply = get_client().submit(
+        last_user_input, st.session_state.session_id, with_flatmap=True
+    )
+elif st.session_state.pending_bot_reply and st.session_state.pending_reply.done():
+    pending = st.session_state.pending_reply
+    st.session_state.pending_reply = None
+
+    try:
+        result = pending.result()
+
+        generated_text = result.get("generated_text", "")
+        table_data = result.get("table_data", None)
+        # Highlighted flatmap from the server's cache, not the full remote SVG
+        flatmap_image_url = result.get("flatmap_image_url")
+
+        bot_message = generated_text
+        st.session_state.chat_history.append(bot_text_message(bot_message))
+        # Links and HTML are built here, once, not on every rerun
+        table_message = bot_table_message(table_data)
+        if table_message is not None:
+            st.session_state.chat_history.append(table_message)
+        if flatmap_image_url:
+            st.session_state.chat_history.append(bot_image_message(flatmap_image_url))
+
+    except BackendError as e:
+        st.session_state.chat_history.append(bot_text_message(f"❌ {e}"))
+
+    except Exception as e:
+        st.session_state.chat_history.append(bot_text_message(f"Error: {e}"))
+
+    st.session_state.pending_bot_reply = False
+
+
+@st.fragment(run_every=POLL_INTERVAL_S)
+def await_bot_reply():
+    # Only this fragment reruns while the reply is pending; the history above
+    # is not re-rendered until the reply is in
+    st.markdown("<div style='text-align: left; color: gray; font-style: italic; margin: 5px 0;'>🤖 Qwen is typing...</div>", unsafe_allow_html=True)
+    if st.session_state.pending_reply.done():
+        st.rerun()
+
 
 st.markdown("### 🤖 Ask Q-SPARC, Know More.")
 
 # Display Chat History
+# Messages carry pre-rendered HTML (see rendering.py), so a rerun only re-emits it
 with st.container():
-
-    for msg in st.session_state.chat_history:
-        if msg["role"] == "user":
-            st.markdown(f"<div style='text-align: right; background-color: #dcf8c6; padding: 10px; border-radius: 10px; margin: 5px 0;'>{msg['content']}</div>", unsafe_allow_html=True)
-        else:
-            if msg["type"] == "table":
-                data_table = msg['content']
-                df = pd.DataFrame(data_table["rows"], columns=data_table["head"])
-                # Custom CSS for styling links
-                st.markdown(
-                    """
-                    <style>
-                    .custom-link {
-                        color: blue; /* Link color */
-                        text-decoration: underline; /* Add underline */
-                    }
-                    .custom-table {
-                        width: 100%;
-                        max-width: 100%;
-                        overflow-x: auto;
-                        display: block;
-                    }
-                    .custom-table th, .custom-table td {
-                        white-space: nowrap;
-                        text-align: center;
-                    }
-                    </style>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-                # Process each element to check for URLs
-                for index, row in df.iterrows():
-                    for col in df.columns:
-                        if re.match(r'https?://', str(row[col])):  # Check if the element is a URL
-                            last_part = row[col].split("/")[-1]
-                            print(last_part)  # 输出: neuron-type-keast-3
-                            df.at[index, col] = f'<a class="custom-link" href="{row[col]}" target="_blank">{last_part}</a>'
-
-                # Set index to start from 1
-                df.index = df.index + 1
-                # Render the table with HTML links
-                st.markdown(df.to_html(classes='custom-table', escape=False, index=True), unsafe_allow_html=True)
-            elif msg["type"] == "image":
-                img_url = msg['content']
-                st.markdown(
-                    f"""
-                    <div style='text-align: left;'>
-                        <img src="{img_url}" style="max-width: 300px; height: auto;">
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-            else:
-                st.markdown(f"<div style='text-align: left; background-color: #f1f0f0; padding: 10px; border-radius: 10px; margin: 5px 0;'>{msg['content']}</div>", unsafe_allow_html=True)
+    render_history(st.session_state.chat_history)
 
     if st.session_state.pending_bot_reply:
-        st.markdown("<div style='text-align: left; color: gray; font-style: italic; margin: 5px 0;'>🤖 Qwen is typing...</div>", unsafe_allow_html=True)
+        await_bot_reply()
 
 with st.form(key="chat_form", clear_on_submit=True):
     user_input = st.text_area("Your message", height=100, label_visibility="collapsed")
@@ -86,62 +92,17 @@ with st.form(key="chat_form", clear_on_submit=True):
 # user_input = st.chat_input("How can I help you today?")
 #
 # if user_input:
-#     st.session_state.chat_history.append({"role": "user", "type": "text", "content": user_input})
+#     st.session_state.chat_history.append(user_message(user_input, color="#dcf8c6"))
 #     st.session_state.pending_bot_reply = True
 #     st.rerun()
 
 if submitted and user_input.strip() != "":
-    # Append user message and trigger bot reply
-    st.session_state.chat_history.append({"role": "user", "type": "text", "content": user_input})
+    # Append user message and trigger bot reply; a reply still pending for an
+    # earlier message is aborted (the connection is closed, so the server stops
+    # generating it) in favour of the new one
+    st.session_state.chat_history.append(user_message(user_input, color="#dcf8c6"))
+    if st.session_state.pending_reply is not None:
+        st.session_state.pending_reply.cancel()
+        st.session_state.pending_reply = None
     st.session_state.pending_bot_reply = True
     st.rerun()
-
-# --- Handle Bot Reply After Rerun ---
-if st.session_state.pending_bot_reply:
-    last_user_input = next((msg["content"] for msg in reversed(st.session_state.chat_history) if msg["role"] == "user"), "")
-
-    payload = {
-        "input": last_user_input,
-        "session_id": "user123_session456"
-    }
-
-    try:
-        response = requests.post("http://localhost:7777/chat", json=payload)
-        print(f"response.status_code = {response.status_code}")
-        if response.status_code == 200:
-            result = response.json()
-            print(f"response.result = {result}")
-            try:
-                result = json.loads(result)
-                print("Converted JSON:", result)
-            except json.JSONDecodeError as e:
-                print("Invalid JSON string:", e)
-
-            generated_text = result.get("generated_text", "")
-            table_data = result.get("table_data", None)
-            print("parsed data JSON:", table_data)
-            flatmap_metadata = result.get("flatmap_metadata", "")
-
-            bot_message = generated_text
-            st.session_state.chat_history.append({"role": "bot", "type": "text", "content": bot_message})
-            st.session_state.chat_history.append({
-                    "role": "bot",
-                    "type": "table",
-                    "content": table_data
-                })
-            # st.session_state.chat_history.append({
-            #     "role": "bot",
-            #     "type": "image",
-            #     "content": flatmap_metadata
-            # })
-
-        else:
-            error_msg = f"❌ Server Error {response.status_code}: {response.text}"
-            st.session_state.chat_history.append({"role": "bot", "type": "text", "content": error_msg})
-
-    except Exception as e:
-        st.session_state.chat_history.append({"role": "bot", "type": "text", "content": f"Error: {e}"})
-
-    st.session_state.pending_bot_reply = False
-    st.rerun()
-
@@ -0,0 +1,148 @@
+import html
+import math
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import streamlit as st
+
+# --- Chat rendering shared by chatbot.py and chatbot-mock.py ---
+# Streamlit reruns the whole script on every interaction, so anything costly
+# (DataFrame construction, URL-to-link conversion, HTML generation) is done
+# once when a message arrives and kept in the message dict. A rerun then only
+# emits the cached HTML strings. Large tables are paginated, and only the most
+# recent messages are drawn unless the user asks for the older ones.
+
+TABLE_PAGE_SIZE = 50
+HISTORY_WINDOW = 30
+
+CHAT_CSS = """
+<style>
+.custom-link {
+    color: blue; /* Link color */
+    text-decoration: underline; /* Add underline */
+}
+.custom-table {
+    width: 100%;
+    max-width: 100%;
+    overflow-x: auto;
+    display: block;
+}
+.custom-table th, .custom-table td {
+    white-space: nowrap;
+    text-align: center;
+}
+</style>
+"""
+
+# Older Streamlit versions have no fragments; the page then reruns as a whole
+_fragment = getattr(st, "fragment", None) or (lambda func: func)
+
+
+def linkify_column(column: pd.Series) -> pd.Series:
+    """
+    Vectorized cell formatting: URLs become links labelled with their last
+    path segment (e.g. neuron-type-keast-3), everything else is HTML-escaped.
+    """
+    text = column.astype(str)
+    is_url = text.str.match(r"https?://")
+    escaped = text.map(html.escape)
+    links = (
+        '<a class="custom-link" href="' + escaped + '" target="_blank">'
+        + text.str.rstrip("/").str.rsplit("/", n=1).str[-1].map(html.escape)
+        + "</a>"
+    )
+    return links.where(is_url, escaped)
+
+
+def user_message(content: str, color: str = "#dcf8c6") -> Dict[str, Any]:
+    return {
+        "role": "user",
+        "type": "text",
+        "content": content,
+        "html": f"<div style='text-align: right; background-color: {color}; padding: 10px; border-radius: 10px; margin: 5px 0;'>{content}</div>",
+    }
+
+
+def bot_text_message(content: str) -> Dict[str, Any]:
+    return {
+        "role": "bot",
+        "type": "text",
+        "content": content,
+        "html": f"<div style='text-align: left; background-color: #f1f0f0; padding: 10px; border-radius: 10px; margin: 5px 0;'>{content}</div>",
+    }
+
+
+def bot_image_message(img_url: str, max_width: int = 300) -> Dict[str, Any]:
+    return {
+        "role": "bot",
+        "type": "image",
+        "content": img_url,
+        "html": f"""
+            <div style='text-align: left;'>
+                <img src="{img_url}" style="max-width: {max_width}px; height: auto;">
+            </div>
+            """,
+    }
+
+
+def bot_table_message(table_data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Table message with links already rendered. Returns None when the
+    response carried no table.
+    """
+    if not table_data or not table_data.get("rows"):
+        return None
+    df = pd.DataFrame(table_data["rows"], columns=table_data["head"])
+    df = df.apply(linkify_column)
+    # Set index to start from 1
+    df.index = df.index + 1
+    return {
+        "role": "bot",
+        "type": "table",
+        "content": table_data,
+        "frame": df,
+        "pages": {},  # page number -> cached HTML
+        "page_count": max(1, math.ceil(len(df) / TABLE_PAGE_SIZE)),
+    }
+
+
+def table_page_html(msg: Dict[str, Any], page: int) -> str:
+    """HTML of one page of a table message, rendered on first use."""
+    cached = msg["pages"].get(page)
+    if cached is None:
+        start = (page - 1) * TABLE_PAGE_SIZE
+        frame = msg["frame"].iloc[start:start + TABLE_PAGE_SIZE]
+        cached = msg["pages"][page] = frame.to_html(classes="custom-table", escape=False, index=True)
+    return cached
+
+
+@_fragment
+def render_table(msg: Dict[str, Any], key: str) -> None:
+    page = 1
+    if msg["page_count"] > 1:
+        page = st.number_input(
+            f"Page (of {msg['page_count']}, {len(msg['frame'])} rows)",
+            min_value=1,
+            max_value=msg["page_count"],
+            value=1,
+            step=1,
+            key=f"{key}_page",
+        )
+    st.markdown(table_page_html(msg, int(page)), unsafe_allow_html=True)
+
+
+def render_history(history: List[Dict[str, Any]]) -> None:
+    """Draws the chat history from the cached HTML of each message."""
+    st.markdown(CHAT_CSS, unsafe_allow_html=True)
+
+    start = 0
+    if len(history) > HISTORY_WINDOW:
+        hidden = len(history) - HISTORY_WINDOW
+        if not st.toggle(f"Show {hidden} earlier messages", key="show_earlier_messages"):
+            start = hidden
+
+    for i, msg in enumerate(history[start:], start):
+        if msg["type"] == "table":
+            render_table(msg, key=f"msg{i}")
+        else:
+            st.markdown(msg["html"], unsafe_allow_html=True)